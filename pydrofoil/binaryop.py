@@ -61,8 +61,8 @@ class __extend__(pairtype(types.Tuple, types.Tuple)):
     def convert((from_, to), ast, codegen):
         if from_ is to:
             return ast.to_code(codegen)
-        with codegen.cached_declaration((from_, to), "convert_%s_%s" % (from_.pyname, to.pyname)) as pyname:
-            with codegen.emit_indent("def %s(t1):" % pyname), codegen.enter_scope(parse.Function(None, None, None)):
+        with codegen.cached_declaration((from_, to), "convert_tuple") as pyname:
+            with codegen.emit_indent("def %s(t1): # %s -> %s" % (pyname, from_.pyname, to.pyname)), codegen.enter_scope(parse.Function(None, None, None)):
                 codegen.add_local("t1", "t1", from_, None)
                 codegen.emit("res = %s()" % (to.pyname, ))
                 for i, (typfrom, typto) in enumerate(zip(from_.elements, to.elements)):
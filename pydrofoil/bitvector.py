@@ -11,13 +11,20 @@ from rpython.rlib.rstring import (
 def from_ruint(size, val):
     if size <= 64:
         return SmallBitVector(size, val, True)
-    return GenericBitVector(size, rbigint.fromrarith_int(val), True)
+    data = [r_uint(0)] * nlimbs(size)
+    data[0] = val
+    return GenericBitVector(size, data)
 
 @always_inline
 def from_bigint(size, rval):
     if size <= 64:
         return SmallBitVector(size, BitVector.rbigint_mask(size, rval).touint())
-    return GenericBitVector(size, rval, True)
+    return GenericBitVector.frombigint(size, rval)
+
+def from_limbs(size, data):
+    if size <= 64:
+        return SmallBitVector(size, data[0], True)
+    return GenericBitVector(size, data, True)
 
 class BitVector(object):
     _attrs_ = ['size']
@@ -41,8 +48,16 @@ class BitVector(object):
     def tolong(self): # only for tests:
         return self.tobigint().tolong()
 
+    def append(self, other):
+        # concatenation, with the bits of other as the lowest ones
+        size = self.size + other.size
+        res = [r_uint(0)] * nlimbs(size)
+        _write_limbs(res, 0, other.size, other._limbs())
+        _write_limbs(res, other.size, self.size, self._limbs())
+        return from_limbs(size, res)
+
     def append_64(self, ui):
-        return from_bigint(self.size + 64, self.tobigint().lshift(64).or_(rbigint.fromrarith_int(ui)))
+        return self.append(SmallBitVector(64, ui))
 
 class SmallBitVector(BitVector):
     _immutable_fields_ = ['val']
@@ -57,6 +72,9 @@ class SmallBitVector(BitVector):
     def __repr__(self):
         return "<SmallBitVector %s 0x%x>" % (self.size, self.val)
 
+    def _limbs(self):
+        return [self.val]
+
     def _check_size(self, other):
         assert other.size == self.size
         assert isinstance(other, SmallBitVector)
@@ -120,7 +138,7 @@ class SmallBitVector(BitVector):
         if i == self.size:
             return self
         if i > 64:
-            return GenericBitVector._sign_extend(rbigint.fromrarith_int(self.val), self.size, i)
+            return GenericBitVector._sign_extend([self.val], self.size, i)
         assert i > self.size
         highest_bit = (self.val >> (self.size - 1)) & 1
         if not highest_bit:
@@ -181,120 +199,275 @@ class SmallBitVector(BitVector):
 
 
 class GenericBitVector(BitVector):
-    _immutable_fields_ = ['rval']
+    """ A bitvector of any size, stored as a list of r_uint limbs, the least
+    significant one first. The bits above size in the last limb are always
+    zero. rbigints are only used for the conversions from and to Integers. """
+    _immutable_fields_ = ['data[*]']
 
-    def __init__(self, size, rval, normalize=False):
+    def __init__(self, size, data, normalize=False):
         assert size > 0
+        assert len(data) == nlimbs(size)
         self.size = size
         if normalize:
-            rval = self._size_mask(rval)
-        self.rval = rval # rbigint
+            _mask_last_limb(size, data)
+        self.data = data # list of r_uint
+
+    @staticmethod
+    def frombigint(size, rval):
+        return GenericBitVector(size, _bigint_to_limbs(size, rval))
 
     def __repr__(self):
-        return "<GenericBitVector %s %r>" % (self.size, self.rval)
+        return "<GenericBitVector %s 0x%s>" % (self.size, self.tobigint().hex())
 
-    def _size_mask(self, val):
-        return self.rbigint_mask(self.size, val)
+    def _limbs(self):
+        return self.data
 
     def add_int(self, i):
-        return GenericBitVector(self.size, self._size_mask(self.rval.add(i.tobigint())))
+        return GenericBitVector(self.size, _add_limbs(
+            self.data, _integer_to_limbs(self.size, i)), True)
 
     def sub_int(self, i):
-        return GenericBitVector(self.size, self._size_mask(self.rval.sub(i.tobigint())))
+        return GenericBitVector(self.size, _add_limbs(
+            self.data, _integer_to_limbs(self.size, i), True), True)
 
     def print_bits(self):
-        print "GenericBitVector<%s, %s>" % (self.size, self.rval.hex())
+        print "GenericBitVector<%s, %s>" % (self.size, self.tobigint().hex())
 
     def lshift(self, i):
-        return GenericBitVector(self.size, self._size_mask(self.rval.lshift(i)))
+        assert i >= 0
+        data = self.data
+        res = [r_uint(0)] * len(data)
+        words = i >> 6
+        bits = i & 63
+        for j in range(len(data) - 1, words - 1, -1):
+            val = data[j - words] << bits
+            if bits and j - words > 0:
+                val |= data[j - words - 1] >> (64 - bits)
+            res[j] = val
+        return GenericBitVector(self.size, res, True)
 
     def rshift(self, i):
-        return GenericBitVector(self.size, self._size_mask(self.rval.rshift(i)))
+        assert i >= 0
+        res = [r_uint(0)] * len(self.data)
+        for j in range(len(res)):
+            res[j] = self._read_word(i + 64 * j)
+        return GenericBitVector(self.size, res)
 
     def lshift_bits(self, other):
-        return GenericBitVector(self.size, self._size_mask(self.rval.lshift(other.toint())))
+        return self.lshift(other.toint())
 
     def rshift_bits(self, other):
-        return GenericBitVector(self.size, self._size_mask(self.rval.rshift(other.toint())))
+        return self.rshift(other.toint())
 
     def xor(self, other):
-        return GenericBitVector(self.size, self._size_mask(self.rval.xor(other.tobigint())))
+        data = self.data
+        otherdata = other._limbs()
+        res = [r_uint(0)] * len(data)
+        for j in range(len(data)):
+            res[j] = data[j] ^ otherdata[j]
+        return GenericBitVector(self.size, res)
 
     def or_(self, other):
-        return GenericBitVector(self.size, self._size_mask(self.rval.or_(other.tobigint())))
+        data = self.data
+        otherdata = other._limbs()
+        res = [r_uint(0)] * len(data)
+        for j in range(len(data)):
+            res[j] = data[j] | otherdata[j]
+        return GenericBitVector(self.size, res)
 
     def and_(self, other):
-        return GenericBitVector(self.size, self._size_mask(self.rval.and_(other.tobigint())))
+        data = self.data
+        otherdata = other._limbs()
+        res = [r_uint(0)] * len(data)
+        for j in range(len(data)):
+            res[j] = data[j] & otherdata[j]
+        return GenericBitVector(self.size, res)
 
     def invert(self):
-        return GenericBitVector(self.size, self._size_mask(self.rval.invert()))
+        data = self.data
+        res = [r_uint(0)] * len(data)
+        for j in range(len(data)):
+            res[j] = ~data[j]
+        return GenericBitVector(self.size, res, True)
+
+    def _read_word(self, start):
+        # the 64 bits starting at bit start, zeros above size
+        data = self.data
+        words = start >> 6
+        if words >= len(data):
+            return r_uint(0)
+        bits = start & 63
+        val = data[words] >> bits
+        if bits and words + 1 < len(data):
+            val |= data[words + 1] << (64 - bits)
+        return val
 
     def subrange(self, n, m):
         width = n - m + 1
-        if m == 0:
-            return from_bigint(width, self.rval)
-        if width < 64: # somewhat annoying that 64 doesn't work
-            mask = (r_uint(1) << width) - 1
-            res = self.rval.abs_rshift_and_mask(r_ulonglong(m), intmask(mask))
-            return SmallBitVector(width, r_uint(res))
-        return from_bigint(width, self.rval.rshift(m))
+        if width <= 64:
+            return SmallBitVector(width, self._read_word(m), True)
+        res = [r_uint(0)] * nlimbs(width)
+        for j in range(len(res)):
+            res[j] = self._read_word(m + 64 * j)
+        return GenericBitVector(width, res, True)
 
     def sign_extend(self, i):
         if i == self.size:
             return self
         assert i > self.size
-        return self._sign_extend(self.rval, self.size, i)
+        return self._sign_extend(self.data, self.size, i)
 
     @staticmethod
-    def _sign_extend(rval, size, target_size):
-        highest_bit = rval.rshift(size - 1).int_and_(1).toint()
-        if not highest_bit:
-            return GenericBitVector(target_size, rval)
-        else:
-            extra_bits = target_size - size
-            bits = rbigint.fromint(1).lshift(extra_bits).int_sub(1).lshift(size)
-            return GenericBitVector(target_size, bits.or_(rval))
+    def _sign_extend(data, size, target_size):
+        res = [r_uint(0)] * nlimbs(target_size)
+        for j in range(len(data)):
+            res[j] = data[j]
+        if (data[(size - 1) >> 6] >> ((size - 1) & 63)) & 1:
+            # set all the bits from size upwards
+            j = size >> 6
+            bits = size & 63
+            if bits:
+                res[j] |= ~r_uint(0) << bits
+                j += 1
+            while j < len(res):
+                res[j] = ~r_uint(0)
+                j += 1
+        return GenericBitVector(target_size, res, True)
 
     def read_bit(self, pos):
-        return bool(self.rval.abs_rshift_and_mask(r_ulonglong(pos), 1))
+        assert 0 <= pos < self.size
+        return (self.data[pos >> 6] >> (pos & 63)) & 1
 
     def update_bit(self, pos, bit):
-        mask = rbigint.fromint(1).lshift(pos)
+        assert 0 <= pos < self.size
+        res = self.data[:]
+        mask = r_uint(1) << (pos & 63)
         if bit:
-            return GenericBitVector(self.size, self.rval.or_(mask))
+            res[pos >> 6] |= mask
         else:
-            return GenericBitVector(self.size, self._size_mask(self.rval.and_(mask.invert())))
+            res[pos >> 6] &= ~mask
+        return GenericBitVector(self.size, res)
 
     def update_subrange(self, n, m, s):
         width = s.size
         assert width == n - m + 1
-        mask = rbigint.fromint(1).lshift(width).int_sub(1).lshift(m).invert()
-        return GenericBitVector(self.size, self.rval.and_(mask).or_(s.tobigint().lshift(m)))
+        res = self.data[:]
+        _write_limbs(res, m, width, s._limbs())
+        return GenericBitVector(self.size, res)
 
     def signed(self):
-        n = self.size
-        assert n > 0
-        u1 = rbigint.fromint(1)
-        m = u1.lshift(n - 1)
-        op = self.rval
-        op = op.and_((u1.lshift(n)).int_sub(1)) # mask off higher bits to be sure
-        return Integer.frombigint(op.xor(m).sub(m))
+        rval = self.tobigint()
+        if self.read_bit(self.size - 1):
+            rval = rval.sub(rbigint.fromint(1).lshift(self.size))
+        return Integer.frombigint(rval)
 
     def unsigned(self):
-        return Integer.frombigint(self.rval)
+        return Integer.frombigint(self.tobigint())
 
     def eq(self, other):
         assert self.size == other.size
-        return self.rval.eq(other.tobigint())
+        data = self.data
+        otherdata = other._limbs()
+        for j in range(len(data)):
+            if data[j] != otherdata[j]:
+                return False
+        return True
+
+    def _high_limbs_zero(self):
+        for j in range(1, len(self.data)):
+            if self.data[j]:
+                return False
+        return True
 
     def toint(self):
-        return self.rval.toint()
+        if self._high_limbs_zero() and not self.data[0] >> 63:
+            return intmask(self.data[0])
+        return self.tobigint().toint() # raises OverflowError
 
     def touint(self):
-        return self.rval.touint()
+        if self._high_limbs_zero():
+            return self.data[0]
+        return self.tobigint().touint() # raises OverflowError
 
     def tobigint(self):
-        return self.rval
+        data = self.data
+        res = rbigint.fromrarith_int(data[len(data) - 1])
+        for j in range(len(data) - 2, -1, -1):
+            res = res.lshift(64).or_(rbigint.fromrarith_int(data[j]))
+        return res
+
+
+# helpers for lists of limbs
+
+def nlimbs(size):
+    return (size + 63) >> 6
+
+def _mask_last_limb(size, data):
+    bits = size & 63
+    if bits:
+        last = len(data) - 1
+        data[last] &= (r_uint(1) << bits) - 1
+
+LIMB_MASK = rbigint.fromint(1).lshift(64).int_sub(1)
+
+def _bigint_to_limbs(size, rval):
+    # negative values are stored as two's complement
+    res = [r_uint(0)] * nlimbs(size)
+    rval = BitVector.rbigint_mask(size, rval)
+    for j in range(len(res)):
+        res[j] = rval.and_(LIMB_MASK).touint()
+        rval = rval.rshift(64)
+    return res
+
+def _integer_to_limbs(size, i):
+    if isinstance(i, SmallInteger):
+        res = [r_uint(0)] * nlimbs(size)
+        res[0] = r_uint(i.val)
+        if i.val < 0:
+            for j in range(1, len(res)):
+                res[j] = ~r_uint(0)
+        _mask_last_limb(size, res)
+        return res
+    return _bigint_to_limbs(size, i.tobigint())
+
+def _add_limbs(a, b, subtract=False):
+    # a + b, or a - b if subtract is True, modulo the size of a
+    res = [r_uint(0)] * len(a)
+    carry = r_uint(subtract)
+    for j in range(len(a)):
+        y = b[j]
+        if subtract:
+            y = ~y
+        x = a[j] + y
+        c1 = r_uint(x < y)
+        x += carry
+        carry = c1 | r_uint(x < carry)
+        res[j] = x
+    return res
+
+def _write_word(data, start, width, val):
+    # write the width (<= 64) lowest bits of val at bit start
+    if width == 64:
+        mask = ~r_uint(0)
+    else:
+        mask = (r_uint(1) << width) - 1
+    val &= mask
+    words = start >> 6
+    bits = start & 63
+    data[words] = (data[words] & ~(mask << bits)) | (val << bits)
+    if bits and bits + width > 64:
+        data[words + 1] = ((data[words + 1] & ~(mask >> (64 - bits))) |
+                           (val >> (64 - bits)))
+
+def _write_limbs(data, start, width, src):
+    # write the width lowest bits of the limbs src at bit start
+    j = 0
+    while width > 0:
+        chunk = min(width, 64)
+        _write_word(data, start, chunk, src[j])
+        start += 64
+        width -= 64
+        j += 1
 
 
 class Integer(object):
@@ -0,0 +1,338 @@
+""" Analysis of the control flow graph of a function, which is given as a
+dictionary {pc: [list of operations]} as produced by
+Function._prepare_blocks: every list of operations ends with a Goto, End,
+Failure or Arbitrary, and can contain ConditionalJumps in the middle. """
+
+from pydrofoil import parse
+
+
+class CantStructure(Exception):
+    pass
+
+
+class Graph(object):
+    """ A control flow graph where every node ends with at most one
+    ConditionalJump. The successors of a node are [target of the conditional
+    jump, fall through target] or [goto target] or [] for End, Failure and
+    Arbitrary. """
+
+    def __init__(self, blocks, startpc=0):
+        self.startpc = startpc
+        self.nodes = {} # node -> (list of operations, terminator)
+        self.successors = {}
+        self.size = 0
+        nextnode = max(blocks) + 1
+        for pc, block in sorted(blocks.items()):
+            # split the block after every conditional jump
+            node = pc
+            ops = []
+            for op in block:
+                self.size += 1
+                if isinstance(op, parse.ConditionalJump):
+                    self._add_node(node, ops, op, [op.target, nextnode])
+                    node = nextnode
+                    nextnode += 1
+                    ops = []
+                elif isinstance(op, parse.Goto):
+                    self._add_node(node, ops, op, [op.target])
+                    break
+                elif op.end_of_block:
+                    self._add_node(node, ops, op, [])
+                    break
+                else:
+                    ops.append(op)
+        self.predecessors = {node: [] for node in self.nodes}
+        for node in self._reachable():
+            for succ in self.successors[node]:
+                self.predecessors[succ].append(node)
+
+    def _add_node(self, node, ops, terminator, successors):
+        self.nodes[node] = ops, terminator
+        self.successors[node] = successors
+
+    def _reachable(self):
+        # reachable nodes in reverse postorder
+        order = []
+        seen = {self.startpc}
+        stack = [(self.startpc, iter(self.successors[self.startpc]))]
+        while stack:
+            node, successors = stack[-1]
+            for succ in successors:
+                if succ not in seen:
+                    seen.add(succ)
+                    stack.append((succ, iter(self.successors[succ])))
+                    break
+            else:
+                stack.pop()
+                order.append(node)
+        order.reverse()
+        return order
+
+    def immediate_dominators(self):
+        return _immediate_dominators(
+            self._reachable(), self.startpc, self.predecessors)
+
+    def immediate_postdominators(self):
+        """ Return a dictionary node -> immediate postdominator. The exits of
+        the function are postdominated by None. Nodes that can't reach an
+        exit are missing. """
+        # reverse graph with a virtual exit node None, which is the
+        # successor of all the nodes without successors
+        reverse_successors = {None: []}
+        for node in self._reachable():
+            if not self.successors[node]:
+                reverse_successors[None].append(node)
+            for succ in self.successors[node]:
+                reverse_successors.setdefault(succ, []).append(node)
+        order = []
+        seen = {None}
+        stack = [(None, iter(reverse_successors[None]))]
+        while stack:
+            node, successors = stack[-1]
+            for succ in successors:
+                if succ not in seen:
+                    seen.add(succ)
+                    stack.append((succ, iter(reverse_successors.get(succ, []))))
+                    break
+            else:
+                stack.pop()
+                order.append(node)
+        order.reverse()
+        reverse_predecessors = {node: [] for node in order}
+        reverse_predecessors[None] = []
+        for node in order:
+            if node is not None:
+                reverse_predecessors[node] = [succ for succ in self.successors[node]
+                                                  if succ in seen]
+        for node in reverse_successors[None]:
+            reverse_predecessors[node].append(None)
+        return _immediate_dominators(order, None, reverse_predecessors)
+
+    def find_loops(self):
+        """ Return a dictionary loop header -> set of nodes of its natural
+        loop. Raises CantStructure if the graph is irreducible. """
+        idom = self.immediate_dominators()
+        def dominates(a, b):
+            while b != a:
+                if b == self.startpc:
+                    return False
+                b = idom[b]
+            return True
+        loops = {}
+        # find the retreating edges with a depth first search, they must all
+        # be back edges, ie go to a node that dominates the source
+        onstack = {self.startpc}
+        seen = {self.startpc}
+        stack = [(self.startpc, iter(self.successors[self.startpc]))]
+        while stack:
+            node, successors = stack[-1]
+            for succ in successors:
+                if succ in onstack:
+                    if not dominates(succ, node):
+                        raise CantStructure("irreducible")
+                    loops.setdefault(succ, set()).add(node)
+                elif succ not in seen:
+                    seen.add(succ)
+                    onstack.add(succ)
+                    stack.append((succ, iter(self.successors[succ])))
+                    break
+            else:
+                stack.pop()
+                onstack.remove(node)
+        # compute the natural loops
+        for header, sources in loops.items():
+            body = {header}
+            todo = list(sources)
+            while todo:
+                node = todo.pop()
+                if node not in body:
+                    body.add(node)
+                    todo.extend(self.predecessors[node])
+            loops[header] = body
+        return loops
+
+
+_missing = object()
+
+def _immediate_dominators(order, start, predecessors):
+    # Cooper, Harvey, Kennedy: "A Simple, Fast Dominance Algorithm"
+    index = {node: i for i, node in enumerate(order)}
+    idom = {start: start}
+    def intersect(a, b):
+        while a != b:
+            while index[a] > index[b]:
+                a = idom[a]
+            while index[b] > index[a]:
+                b = idom[b]
+        return a
+    changed = True
+    while changed:
+        changed = False
+        for node in order:
+            if node == start:
+                continue
+            new = _missing
+            for pred in predecessors[node]:
+                if pred not in idom:
+                    continue
+                if new is _missing:
+                    new = pred
+                else:
+                    new = intersect(pred, new)
+            if idom.get(node, _missing) != new:
+                idom[node] = new
+                changed = True
+    del idom[start]
+    return idom
+
+# ____________________________________________________________
+# reconstruction of structured control flow
+
+class If(object):
+    def __init__(self, condition, true, false, negated=False):
+        self.condition = condition # a ConditionalJump
+        self.true = true
+        self.false = false
+        self.negated = negated
+
+class Loop(object):
+    def __init__(self, body):
+        self.body = body
+
+CONTINUE = "continue"
+BREAK = "break"
+
+
+class _LoopInfo(object):
+    def __init__(self, header, body, follow):
+        self.header = header
+        self.body = body
+        self.follow = follow
+
+
+def structure(blocks, startpc=0, maxgrowth=2, maxdepth=50):
+    """ Turn the blocks into nested ifs and loops. Returns a list of
+    operations, If and Loop instances and CONTINUE and BREAK, which can be
+    nested. Joins that are not the immediate postdominator of the branch are
+    reached by duplicating the code. Raises CantStructure if the graph is
+    irreducible, if the duplication makes the code more than maxgrowth times
+    bigger, or if the ifs and loops are nested more than maxdepth levels
+    deep (Python has a limit for the indentation depth). """
+    res = _Structurer(Graph(blocks, startpc), maxgrowth).structure()
+    if _depth(res) > maxdepth:
+        raise CantStructure("nested too deeply")
+    return res
+
+def _depth(body):
+    res = 0
+    for op in body:
+        if isinstance(op, If):
+            res = max(res, 1 + _depth(op.true), 1 + _depth(op.false))
+        elif isinstance(op, Loop):
+            res = max(res, 1 + _depth(op.body))
+    return res
+
+def _ends_in_jump(body):
+    if not body:
+        return False
+    op = body[-1]
+    if op is CONTINUE or op is BREAK:
+        return True
+    if isinstance(op, If):
+        return _ends_in_jump(op.true) and _ends_in_jump(op.false)
+    if isinstance(op, Loop):
+        return False
+    return op.end_of_block
+
+
+class _Structurer(object):
+    def __init__(self, graph, maxgrowth):
+        self.graph = graph
+        self.ipdom = graph.immediate_postdominators()
+        self.budget = graph.size * maxgrowth + 10
+        self.loops = {}
+        for header, body in graph.find_loops().items():
+            self.loops[header] = _LoopInfo(header, body, self._follow(header, body))
+
+    def _follow(self, header, body):
+        # the node where execution continues after the loop. other exits of
+        # the loop are emitted (and duplicated if needed) inside of it
+        exits = {}
+        for node in body:
+            for succ in self.graph.successors[node]:
+                if succ not in body:
+                    exits[succ] = exits.get(succ, 0) + 1
+        if not exits:
+            return None
+        follow = self.ipdom.get(header)
+        if follow in exits:
+            return follow
+        return max(sorted(exits), key=exits.get)
+
+    def structure(self):
+        res = []
+        self._walk(self.graph.startpc, None, [], res)
+        return res
+
+    def _walk(self, node, stop, loops, res, enter=False):
+        while 1:
+            if node == stop:
+                return
+            if not enter:
+                if loops and node == loops[-1].header:
+                    res.append(CONTINUE)
+                    return
+                if loops and node == loops[-1].follow:
+                    res.append(BREAK)
+                    return
+                for loop in loops:
+                    if node == loop.header or node == loop.follow:
+                        # would need a labeled continue or break
+                        raise CantStructure("jump out of nested loop")
+                if node in self.loops:
+                    loop = self.loops[node]
+                    body = []
+                    self._walk(node, None, loops + [loop], body, enter=True)
+                    res.append(Loop(body))
+                    if loop.follow is None:
+                        return
+                    node = loop.follow
+                    continue
+            enter = False
+            ops, terminator = self.graph.nodes[node]
+            self.budget -= len(ops) + 1
+            if self.budget < 0:
+                raise CantStructure("too much duplication")
+            res.extend(ops)
+            successors = self.graph.successors[node]
+            if not successors:
+                res.append(terminator)
+                return
+            if len(successors) == 1:
+                node, = successors
+                continue
+            true, false = successors
+            join = self.ipdom.get(node)
+            if join is None or (loops and (join not in loops[-1].body or
+                                           join == loops[-1].header)):
+                join = stop
+            truebody = []
+            self._walk(true, join, loops, truebody)
+            falsebody = []
+            self._walk(false, join, loops, falsebody)
+            # if one of the branches ends with a jump, there is no need for an
+            # else, which keeps the nesting depth down. if both do, put the
+            # less deeply nested one into the if
+            if _ends_in_jump(truebody) and not (
+                    _ends_in_jump(falsebody) and
+                    _depth(truebody) > _depth(falsebody)):
+                res.append(If(terminator, truebody, []))
+                res.extend(falsebody)
+            elif _ends_in_jump(falsebody):
+                res.append(If(terminator, falsebody, [], negated=True))
+                res.extend(truebody)
+            else:
+                res.append(If(terminator, truebody, falsebody))
+            if join == stop:
+                return
+            node = join
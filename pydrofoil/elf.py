@@ -25,11 +25,13 @@
 #
 # adapted for pydrofoil by cfbolz
 
+import os
 import struct
 
 from rpython.rlib.rstruct.runpack import runpack
-from rpython.rlib.rarithmetic import intmask
-from rpython.rlib import objectmodel
+from rpython.rlib.rarithmetic import intmask, r_uint
+from rpython.rlib.listsort import make_timsort_class
+from rpython.rlib import objectmodel, rmmap
 
 import binascii
 
@@ -39,6 +41,56 @@ def unpack(fmt, data):
         return runpack(fmt, data)
     return struct.unpack(fmt, data)
 
+class ElfFile(object):
+    """ The contents of an ELF file, with the seek/read interface of a file
+    object. After translation the file is mapped with rmmap, so that only
+    the parts that are read are copied. Untranslated rmmap goes through
+    ll2ctypes and is very slow, so there the file is read into a string. """
+
+    def __init__(self, fn):
+        fd = os.open(fn, os.O_RDONLY, 0)
+        try:
+            if objectmodel.we_are_translated():
+                self.mmap = rmmap.mmap(fd, 0, rmmap.MAP_PRIVATE, rmmap.PROT_READ)
+                self.data = None
+                self.size = self.mmap.size
+            else:
+                self.mmap = None
+                with os.fdopen(os.dup(fd), "rb") as f:
+                    self.data = f.read()
+                self.size = len(self.data)
+        finally:
+            os.close(fd)
+        self.pos = 0
+
+    def seek(self, pos):
+        assert 0 <= pos <= self.size
+        self.pos = pos
+
+    def read(self, num_bytes):
+        start = self.pos
+        stop = min(self.size, start + num_bytes)
+        assert 0 <= start <= stop
+        self.pos = stop
+        if objectmodel.we_are_translated():
+            # self.data is always None after translation
+            return self.mmap.getslice(start, stop - start)
+        return self.data[start:stop]
+
+    def close(self):
+        if self.mmap is not None:
+            self.mmap.close()
+            self.mmap = None
+        self.data = None
+
+class Symbol(object):
+    def __init__(self, name, addr, size):
+        self.name = name
+        self.addr = addr
+        self.size = size
+
+SymbolSort = make_timsort_class(lt=lambda a, b: a.addr < b.addr)
+
 class SparseMemoryImage(object):
     class Section(object):
         def __init__(self, name="", addr=0x00000000, data=bytearray()):
@@ -61,6 +113,8 @@ class SparseMemoryImage(object):
     def __init__(self):
         self.sections = []
         self.symbols = {}
+        # function and object symbols, sorted by address, see lookup_address
+        self.address_index = []
 
     def add_section(self, section, addr=None, data=None):
         if isinstance(section, SparseMemoryImage.Section):
@@ -95,6 +149,31 @@ class SparseMemoryImage(object):
     def get_symbol(self, symbol_name):
         return self.symbols[symbol_name]
 
+    def add_address_symbol(self, symbol_name, symbol_addr, symbol_size):
+        self.address_index.append(Symbol(symbol_name, r_uint(symbol_addr), r_uint(symbol_size)))
+
+    def sort_address_index(self):
+        SymbolSort(self.address_index).sort()
+
+    def lookup_address(self, addr):
+        # the symbol with the highest address <= addr, or None if there is
+        # none or addr is beyond its size
+        index = self.address_index
+        low = 0
+        high = len(index)
+        while low < high:
+            mid = (low + high) >> 1
+            if index[mid].addr <= addr:
+                low = mid + 1
+            else:
+                high = mid
+        if low == 0:
+            return None
+        symbol = index[low - 1]
+        if symbol.size and addr - symbol.addr >= symbol.size:
+            return None
+        return symbol
+
     def __eq__(self, other):
         return self.sections == other.sections and self.symbols == other.symbols
 
@@ -646,8 +725,9 @@ def read_header(file_obj):
     ehdr = ElfHeader(ehdr_data, is_64bit=is_64bit)
     return ehdr, is_64bit
 
-def elf_reader(file_obj):
-    # Opens and parses an ELF file into a sparse memory image object.
+def elf_reader(file_obj, load_sections=True):
+    # Opens and parses an ELF file into a sparse memory image object. With
+    # load_sections=False only the symbols are read.
     ehdr, is_64bit = read_header(file_obj)
 
     # We need to find the section string table so we can figure out the
@@ -703,6 +783,9 @@ def elf_reader(file_obj):
 
         # Read the section data if it exists
 
+        if not load_sections and shdr.type not in (ElfSectionHeader.TYPE_STRTAB,
+                                                   ElfSectionHeader.TYPE_SYMTAB):
+            continue
         if section_name not in [".sbss", ".bss"]:
             file_obj.seek(intmask(shdr.offset))
             data = file_obj.read(intmask(shdr.size))
@@ -767,9 +850,24 @@ def elf_reader(file_obj):
 
         # Add symbol to the sparse memory image
         mem_image.add_symbol(name, sym.value)
+        if sym_type != ElfSymTabEntry.TYPE_NOTYPE:
+            mem_image.add_address_symbol(name, sym.value, sym.size)
 
+    mem_image.sort_address_index()
     return mem_image
 
+def load_elf(mem, fn):
+    # Loads the process image of the ELF file fn into mem and reads its
+    # symbols, opening and mapping the file only once. Returns the entry
+    # point and a SparseMemoryImage without sections.
+    file_obj = ElfFile(fn)
+    try:
+        entrypoint = elf_read_process_image(mem, file_obj)
+        mem_image = elf_reader(file_obj, load_sections=False)
+    finally:
+        file_obj.close()
+    return entrypoint, mem_image
+
 def elf_read_process_image(mem, file_obj):
     from rpython.rlib.rarithmetic import r_uint, intmask
     ehdr, is_64bit = read_header(file_obj)
@@ -784,9 +882,8 @@ def elf_read_process_image(mem, file_obj):
         file_obj.seek(intmask(phdr.offset))
         content = file_obj.read(intmask(phdr.filesz))
         start_addr = r_uint(phdr.paddr)
-        for i in range(phdr.filesz):
-            mem.write(start_addr + i, 1, r_uint(0xff & ord(content[i])))
+        mem.write_bytes(start_addr, content)
         # fill rest with 0
-        for i in range(phdr.filesz, phdr.memsz):
-            mem.write(start_addr + i, 1, r_uint(0))
+        if phdr.memsz > phdr.filesz:
+            mem.fill(start_addr + r_uint(phdr.filesz), intmask(phdr.memsz - phdr.filesz))
     return ehdr.entry
@@ -0,0 +1,97 @@
+# building flattened device trees (the dtb format that dtc produces), see
+# the devicetree specification, chapter 5
+
+from rpython.rlib.rstring import StringBuilder
+from rpython.rlib.rarithmetic import r_uint, intmask
+
+FDT_MAGIC = 0xd00dfeed
+FDT_BEGIN_NODE = 1
+FDT_END_NODE = 2
+FDT_PROP = 3
+FDT_END = 9
+
+FDT_VERSION = 17
+FDT_LAST_COMP_VERSION = 16
+
+HEADER_SIZE = 40
+# an empty memory reservation map, only the terminating entry
+MEM_RSVMAP_SIZE = 16
+
+def _u32(value):
+    # big endian
+    value = r_uint(value)
+    return "".join([chr(intmask((value >> shift) & 0xff))
+                    for shift in [24, 16, 8, 0]])
+
+def _pad(s):
+    return s + "\0" * (-len(s) & 3)
+
+class FDTBuilder(object):
+    def __init__(self):
+        self.struct = StringBuilder()
+        self.strings = StringBuilder()
+        self.string_offsets = {}
+        self.depth = 0
+
+    def begin_node(self, name):
+        self.struct.append(_u32(FDT_BEGIN_NODE))
+        self.struct.append(_pad(name + "\0"))
+        self.depth += 1
+
+    def end_node(self):
+        assert self.depth > 0
+        self.struct.append(_u32(FDT_END_NODE))
+        self.depth -= 1
+
+    def _name_offset(self, name):
+        offset = self.string_offsets.get(name, -1)
+        if offset < 0:
+            offset = self.strings.getlength()
+            self.strings.append(name + "\0")
+            self.string_offsets[name] = offset
+        return offset
+
+    def property(self, name, value):
+        self.struct.append(_u32(FDT_PROP))
+        self.struct.append(_u32(len(value)))
+        self.struct.append(_u32(self._name_offset(name)))
+        self.struct.append(_pad(value))
+
+    def property_empty(self, name):
+        self.property(name, "")
+
+    def property_u32s(self, name, values):
+        self.property(name, "".join([_u32(value) for value in values]))
+
+    def property_u32(self, name, value):
+        self.property_u32s(name, [value])
+
+    def property_u64s(self, name, values):
+        # every value as two cells, for #address-cells = <2>. the cells are
+        # ints, like the ones that property_u32s gets from other callers
+        cells = []
+        for value in values:
+            value = r_uint(value)
+            cells.append(intmask(value >> 32))
+            cells.append(intmask(value & 0xffffffff))
+        self.property_u32s(name, cells)
+
+    def property_strings(self, name, values):
+        self.property(name, "".join([value + "\0" for value in values]))
+
+    def property_string(self, name, value):
+        self.property_strings(name, [value])
+
+    def build(self, boot_cpuid=0):
+        assert self.depth == 0
+        self.struct.append(_u32(FDT_END))
+        struct = self.struct.build()
+        strings = self.strings.build()
+        off_struct = HEADER_SIZE + MEM_RSVMAP_SIZE
+        off_strings = off_struct + len(struct)
+        totalsize = off_strings + len(strings)
+        header = [FDT_MAGIC, totalsize, off_struct, off_strings, HEADER_SIZE,
+                  FDT_VERSION, FDT_LAST_COMP_VERSION, boot_cpuid,
+                  len(strings), len(struct)]
+        return ("".join([_u32(value) for value in header]) +
+                "\0" * MEM_RSVMAP_SIZE + struct + strings)
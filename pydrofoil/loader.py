@@ -0,0 +1,67 @@
+# loading guest binaries that are not ELF files (see elf.py): raw images like
+# the Image of a Linux kernel, initrds and device tree blobs. the files are
+# read and, if they are gzip compressed, decompressed in chunks, which are
+# written to the guest memory with write_bytes
+
+import os
+
+from rpython.rlib import rzlib
+from rpython.rlib.rarithmetic import r_uint, string_to_int
+
+CHUNK_SIZE = 64 * 1024
+
+GZIP_MAGIC = "\x1f\x8b"
+ELF_MAGIC = "\x7fELF"
+
+def read_magic(fn, num_bytes=4):
+    fd = os.open(fn, os.O_RDONLY, 0)
+    try:
+        return os.read(fd, num_bytes)
+    finally:
+        os.close(fd)
+
+def is_elf(fn):
+    return read_magic(fn) == ELF_MAGIC
+
+def load_image(mem, fn, addr, decompress=True):
+    # loads the file fn to addr, decompressing it if it is gzip compressed
+    # and decompress is True. returns the number of bytes written
+    fd = os.open(fn, os.O_RDONLY, 0)
+    try:
+        if decompress and os.read(fd, len(GZIP_MAGIC)) == GZIP_MAGIC:
+            os.lseek(fd, 0, 0)
+            return _load_gzip(mem, fd, addr)
+        os.lseek(fd, 0, 0)
+        return _load_raw(mem, fd, addr)
+    finally:
+        os.close(fd)
+
+def _load_raw(mem, fd, addr):
+    size = 0
+    while True:
+        data = os.read(fd, CHUNK_SIZE)
+        if not data:
+            return size
+        mem.write_bytes(addr + r_uint(size), data)
+        size += len(data)
+
+def _load_gzip(mem, fd, addr):
+    # 16 + window size: expect a gzip header and trailer
+    stream = rzlib.inflateInit(wbits=rzlib.MAX_WBITS | 16)
+    size = 0
+    try:
+        finished = False
+        while not finished:
+            data = os.read(fd, CHUNK_SIZE)
+            if not data:
+                raise ValueError("truncated gzip file")
+            out, finished, unused_len = rzlib.decompress(stream, data, rzlib.Z_NO_FLUSH)
+            mem.write_bytes(addr + r_uint(size), out)
+            size += len(out)
+    finally:
+        rzlib.inflateEnd(stream)
+    return size
+
+def parse_address(s):
+    # decimal, or hexadecimal with 0x prefix
+    return r_uint(string_to_int(s, 0))
@@ -1,9 +1,13 @@
 from rpython.tool.pairtype import pair
 
-from pydrofoil import parse, types, binaryop, operations
+from pydrofoil import parse, types, binaryop, operations, controlflow, optimize, regprofile
 from contextlib import contextmanager
 
+import os
+import re
 import sys
+import hashlib
+import cPickle
 
 assert sys.maxint == 2 ** 63 - 1, "only 64 bit platforms are supported!"
 
@@ -18,7 +22,7 @@ class NameInfo(object):
 
 
 class Codegen(object):
-    def __init__(self, promoted_registers=frozenset()):
+    def __init__(self, promoted_registers=frozenset(), structured_control_flow=True):
         self.declarations = []
         self.runtimeinit = []
         self.code = []
@@ -27,6 +31,7 @@ class Codegen(object):
         self.globalnames = {}
         self.namedtypes = {}
         self.declarationcache = {}
+        self.declarationnames = {} # name -> (key, nameprefix)
         self.gensym = {} # prefix -> number
         self.localnames = None
         self.add_global("false", "False", types.Bool())
@@ -40,6 +45,18 @@ class Codegen(object):
         self.add_global("NULL", "None")
         self.declared_types = set()
         self.promoted_registers = promoted_registers
+        self.quasi_immutable_registers = frozenset()
+        self.immutable_registers = frozenset()
+        self.virtualizable_fields = None
+        self.register_arrays = {} # register name -> (array name, index, size)
+        self.register_arrays_first = {} # array name -> smallest index
+        self.register_fields = [] # list of (field name, initial value)
+        self.structured_control_flow = structured_control_flow
+        self.cache = None
+        self.recorded_declarations = None
+        # statistics of optimize.narrow_int_locals
+        self.int_locals = 0
+        self.narrowed_int_locals = 0
 
     def add_global(self, name, pyname, typ=None, ast=None):
         assert isinstance(typ, types.Type) or typ is None
@@ -134,8 +151,39 @@ class Codegen(object):
             num = self.gensym.get(nameprefix, 0) + 1
             self.gensym[nameprefix] = num
             name = self.declarationcache[tup] = "%s_%s" % (nameprefix, num)
+            self.declarationnames[name] = tup
+            start = len(self.declarations)
             with self.emit_code_type("declarations"):
                 yield name
+            if self.recorded_declarations is not None:
+                self.recorded_declarations.append(
+                    (key, nameprefix, name, start, len(self.declarations)))
+
+    def emit_registers_class(self):
+        fields = [("have_exception", "False"), ("throw_location", "None"),
+                  ("current_exception", "None")] + self.register_fields
+        immutable_fields = []
+        virtualizable = []
+        for field, _ in self.register_fields:
+            if self.virtualizable_fields is not None:
+                if field in self.virtualizable_fields:
+                    virtualizable.append(field)
+                    continue
+                if field + "[*]" in self.virtualizable_fields:
+                    virtualizable.append(field + "[*]")
+                    continue
+            if field in self.register_arrays_first or field in self.immutable_registers:
+                immutable_fields.append(field)
+            elif field in self.quasi_immutable_registers:
+                immutable_fields.append(field + "?")
+        with self.emit_indent("class Registers(object):"):
+            self.emit("_immutable_fields_ = %r" % (immutable_fields, ))
+            if self.virtualizable_fields is not None:
+                self.emit("_virtualizable_ = %r" % (virtualizable, ))
+            with self.emit_indent("def __init__(self):"):
+                for field, value in fields:
+                    self.emit("self.%s = %s" % (field, value))
+        self.emit("r = Registers()")
 
     def getcode(self):
         res = ["\n".join(self.declarations)]
@@ -144,9 +192,34 @@ class Codegen(object):
         return "\n\n\n".join(res)
 
 
-def parse_and_make_code(s, supportcodename="supportcode", promoted_registers=set()):
-    ast = parse.parser.parse(parse.lexer.lex(s))
-    c = Codegen(promoted_registers)
+def parse_and_make_code(s, supportcodename="supportcode", promoted_registers=set(), cachedir=None, processes=None, structured_control_flow=True, print_union_switch_report=False, quasi_immutable_registers=set(), register_profile=None):
+    if cachedir is None:
+        cache = None
+        ast = parse.parser.parse(parse.lexer.lex(s))
+    else:
+        cache = CodeCache(cachedir)
+        ast = cache.parse(s)
+    immutable_registers = find_immutable_registers(ast)
+    register_arrays = find_register_arrays(ast, promoted_registers)
+    virtualizable_fields = None
+    if register_profile is not None:
+        if isinstance(register_profile, str):
+            register_profile = regprofile.RegisterProfile.read(register_profile)
+        promoted_registers, quasi_immutable_registers, virtualizable_fields = \
+            choose_from_profile(ast, register_profile, register_arrays,
+                                immutable_registers, promoted_registers,
+                                quasi_immutable_registers)
+    if cache is not None:
+        cache.compute_context(ast, supportcodename, promoted_registers, structured_control_flow)
+    c = Codegen(promoted_registers, structured_control_flow)
+    c.cache = cache
+    c.quasi_immutable_registers = frozenset(quasi_immutable_registers)
+    c.immutable_registers = immutable_registers
+    c.register_arrays = register_arrays
+    c.virtualizable_fields = virtualizable_fields
+    for arrayname, index, size in c.register_arrays.itervalues():
+        c.register_arrays_first[arrayname] = min(
+            index, c.register_arrays_first.get(arrayname, index))
     with c.emit_code_type("declarations"):
         c.emit("from rpython.rlib import jit")
         c.emit("from rpython.rlib import objectmodel")
@@ -155,21 +228,462 @@ def parse_and_make_code(s, supportcodename="supportcode", promoted_registers=set
         c.emit("from pydrofoil.test import %s as supportcode" % supportcodename)
         c.emit("from pydrofoil import bitvector")
         c.emit("from pydrofoil.bitvector import Integer")
-        c.emit("class Registers(object): pass")
-        c.emit("r = Registers()")
-        c.emit("r.have_exception = False")
-        c.emit("r.throw_location = None")
-        c.emit("r.current_exception = None")
         c.emit("class Lets(object): pass")
         c.emit("l = Lets()")
         c.emit("UninitInt = bitvector.Integer.fromint(-0xfefee)")
     try:
-        ast.make_code(c)
+        if processes is None:
+            ast.make_code(c)
+        else:
+            make_code_parallel(ast, c, processes)
     except Exception:
         print c.getcode()
         raise
+    with c.emit_code_type("declarations"):
+        c.emit_registers_class()
+    if cache is not None:
+        cache.save()
+    if print_union_switch_report:
+        print union_switch_report(ast)
     return c.getcode()
 
+def choose_from_profile(ast, profile, register_arrays, immutable_registers,
+                        promoted_registers=frozenset(),
+                        quasi_immutable_registers=frozenset()):
+    """ Use a register profile (see regprofile.py) to choose the promoted and
+    quasi-immutable registers and the fields of the virtualizable. The
+    registers that are given explicitly are kept. """
+    registers = set()
+    for decl in ast.declarations:
+        if (isinstance(decl, parse.Register) and
+                decl.name not in register_arrays and
+                decl.name not in immutable_registers):
+            registers.add(decl.name)
+    arrays = set([arrayname for arrayname, _, _ in register_arrays.itervalues()])
+    promoted, quasi_immutable, virtualizable = profile.choose(registers, arrays)
+    promoted = set(promoted_registers) | (promoted - set(quasi_immutable_registers))
+    quasi_immutable = (set(quasi_immutable_registers) | quasi_immutable) - promoted
+    return promoted, quasi_immutable, virtualizable - quasi_immutable
+
+REGISTER_ARRAY_MIN_SIZE = 8
+
+def find_register_arrays(ast, promoted_registers=frozenset()):
+    """ Find groups of registers that are numbered, have the same fixed-size
+    bitvector type and are stored in an array of r_uints, like the integer
+    registers x1 to x31 of RISC-V. Returns a dictionary register name ->
+    (name of the array, index, size of the array). """
+    groups = {}
+    names = set()
+    for decl in ast.declarations:
+        if not isinstance(decl, parse.Register):
+            continue
+        names.add(decl.name)
+        match = REGISTER_NUMBER_RE.match(decl.name)
+        typ = decl.typ
+        if (match is None or decl.name in promoted_registers or
+                not isinstance(typ, parse.NamedType) or
+                not typ.name.startswith("%bv") or
+                not 0 < int(typ.name[len("%bv"):] or 0) <= 64):
+            continue
+        prefix, index = match.group(1), int(match.group(2))
+        groups.setdefault((prefix, typ.name), []).append((index, decl.name))
+    res = {}
+    for (prefix, _), registers in sorted(groups.items()):
+        arrayname = prefix + "_array"
+        if len(registers) < REGISTER_ARRAY_MIN_SIZE or arrayname in names:
+            continue
+        size = max(registers)[0] + 1
+        for index, name in registers:
+            res[name] = (arrayname, index, size)
+        names.add(arrayname)
+    return res
+
+REGISTER_NUMBER_RE = re.compile(r"^(.*\D)(\d+)$")
+
+def find_immutable_registers(ast):
+    """ Return the names of the registers that are never written to by any
+    function or let. They only ever contain their initial value, or a struct
+    that is mutated in place. """
+    registers = set()
+    written = set()
+    for decl in ast.declarations:
+        if isinstance(decl, parse.Register):
+            registers.add(decl.name)
+        elif isinstance(decl, (parse.Function, parse.Let)):
+            for op in decl.body:
+                written.add(optimize.defines(op))
+    return frozenset(registers - written)
+
+def union_switch_report(ast):
+    """ Return a report of the functions that are turned into methods on the
+    union classes, one line per function. """
+    lines = []
+    for decl in ast.declarations:
+        if isinstance(decl, parse.Function):
+            switch = decl.find_union_switch(decl._prepare_blocks())
+            if switch is not None:
+                lines.append("%s: %s" % (decl.name, switch.report()))
+    lines.append("%s functions turned into methods" % (len(lines), ))
+    return "\n".join(lines)
+
+
+# ____________________________________________________________
+# caching
+
+CACHE_VERSION = 1
+
+GENERATED_NAME_RE = re.compile(r"\b[A-Za-z]\w*_\d+\b")
+
+DECLARATION_KEYWORDS = ("enum ", "union ", "struct ", "val ", "fn ", "register ", "let ")
+
+def split_declarations(s):
+    """ Split the source of a JIB file into chunks of text, one per top-level
+    declaration. Every declaration starts with a keyword at the beginning of
+    a line, everything else is indented or a closing brace. """
+    chunks = []
+    pos = 0
+    chunkstart = 0
+    while 1:
+        end = s.find("\n", pos)
+        if end < 0:
+            break
+        pos = end + 1
+        if s.startswith(DECLARATION_KEYWORDS, pos) and s[chunkstart:pos].strip():
+            chunks.append(s[chunkstart:pos])
+            chunkstart = pos
+    if s[chunkstart:].strip():
+        chunks.append(s[chunkstart:])
+    return chunks
+
+def _key_to_data(key):
+    # turn a key of Codegen.declarationcache into something picklable that
+    # does not reference any AST or type objects
+    if isinstance(key, tuple):
+        return ("tuple", ) + tuple([_key_to_data(x) for x in key])
+    if not isinstance(key, types.Type):
+        assert isinstance(key, (int, long, str))
+        return key
+    clsname = type(key).__name__
+    if isinstance(key, (types.Union, types.Enum, types.Struct)):
+        return (clsname, key.ast.name)
+    if isinstance(key, (types.Ref, types.Vec, types.List)):
+        return (clsname, _key_to_data(key.typ))
+    if isinstance(key, types.Function):
+        return (clsname, _key_to_data(key.argtype), _key_to_data(key.restype))
+    if isinstance(key, types.Tuple):
+        return (clsname, ) + tuple([_key_to_data(x) for x in key.elements])
+    if isinstance(key, (types.FixedBitVector, types.SmallBitVector)):
+        return (clsname, key.width)
+    return (clsname, )
+
+def _data_to_key(data, codegen):
+    # inverse of _key_to_data
+    if not isinstance(data, tuple):
+        return data
+    kind = data[0]
+    args = data[1:]
+    if kind == "tuple":
+        return tuple([_data_to_key(x, codegen) for x in args])
+    if kind in ("Union", "Enum", "Struct"):
+        return codegen.get_named_type(args[0])
+    if kind in ("FixedBitVector", "SmallBitVector"):
+        return getattr(types, kind)(args[0])
+    cls = getattr(types, kind)
+    args = [_data_to_key(x, codegen) for x in args]
+    if kind == "Tuple":
+        return cls(tuple(args))
+    return cls(*args)
+
+
+def _generator_digest():
+    # the cache must not be reused after the code generator itself changed
+    h = hashlib.sha1()
+    for mod in (parse, types, binaryop, operations, controlflow, optimize, sys.modules[__name__]):
+        fn = mod.__file__
+        if fn.endswith((".pyc", ".pyo")):
+            fn = fn[:-1]
+        with open(fn, "rb") as f:
+            h.update(f.read())
+    return h.hexdigest()
+
+
+class CodeCache(object):
+    """ An on-disk cache, stored in cachedir, for the parsed declarations of a
+    JIB file and for the generated code of its functions.
+
+    Parsed declarations are keyed by the hash of their source text. The code
+    of a function is keyed by the hash of its AST together with a hash of
+    everything else the code generation of a function can depend on: all the
+    non-function declarations, the order of the function names, the name of
+    the support code module and the promoted registers. """
+
+    def __init__(self, cachedir):
+        self.cachedir = cachedir
+        self.generator_digest = _generator_digest()
+        self.asts = self._load("ast")
+        self.functions = self._load("functions")
+        self.used_asts = {}
+        self.used_functions = {}
+        self.context = None
+        self.function_hits = 0
+        self.function_misses = 0
+
+    def _filename(self, name):
+        return os.path.join(self.cachedir, "%s-%s.pickle" % (name, CACHE_VERSION))
+
+    def _load(self, name):
+        try:
+            with open(self._filename(name), "rb") as f:
+                digest, data = cPickle.load(f)
+        except (IOError, EOFError, ValueError, cPickle.UnpicklingError):
+            return {}
+        if digest != self.generator_digest:
+            return {}
+        return data
+
+    def _store(self, name, data):
+        # write to a temporary file first, to never leave a half-written
+        # cache behind
+        fn = self._filename(name)
+        tmpfn = "%s.%s.tmp" % (fn, os.getpid())
+        with open(tmpfn, "wb") as f:
+            cPickle.dump((self.generator_digest, data), f, 2)
+        os.rename(tmpfn, fn)
+
+    def save(self):
+        if not os.path.isdir(self.cachedir):
+            os.makedirs(self.cachedir)
+        # only keep the entries that were used in this run, to stop the
+        # cache from growing without bounds
+        self._store("ast", self.used_asts)
+        self._store("functions", self.used_functions)
+        print "cache: reused the code of %s functions, regenerated %s" % (
+            self.function_hits, self.function_misses)
+
+    def parse(self, s):
+        declarations = []
+        for chunk in split_declarations(s):
+            key = hashlib.sha1(chunk).hexdigest()
+            data = self.asts.get(key)
+            if data is None:
+                decls = parse.parser.parse(parse.lexer.lex(chunk)).declarations
+                data = cPickle.dumps(decls, 2)
+            else:
+                # always unpickle, the code generation mutates the ASTs
+                decls = cPickle.loads(data)
+            self.used_asts[key] = data
+            declarations.extend(decls)
+        return parse.File(declarations)
+
+    def compute_context(self, ast, supportcodename, promoted_registers, structured_control_flow=True):
+        # must be called before the code generation, which mutates the ASTs
+        h = hashlib.sha1()
+        h.update("%s\n%s\n%r\n%s\n" % (CACHE_VERSION, supportcodename, sorted(promoted_registers), structured_control_flow))
+        self.function_keys = {}
+        for decl in ast.declarations:
+            if isinstance(decl, parse.Function):
+                h.update("fn %s\n" % (decl.name, ))
+            else:
+                h.update("%r\n" % (decl, ))
+        self.context = h.hexdigest()
+        for decl in ast.declarations:
+            if isinstance(decl, parse.Function):
+                key = hashlib.sha1("%s\n%r" % (self.context, decl)).hexdigest()
+                self.function_keys[id(decl)] = key
+
+    def make_function_code(self, func, codegen, pyname):
+        key = self.function_keys[id(func)]
+        entry = self.functions.get(key)
+        if entry is not None and replay_function_code(entry, codegen):
+            self.function_hits += 1
+            self.used_functions[key] = entry
+            return
+        self.function_misses += 1
+        self.add_function_code(func, record_function_code(func, codegen, pyname))
+
+    def has_function_code(self, func):
+        return self.function_keys[id(func)] in self.functions
+
+    def add_function_code(self, func, entry):
+        key = self.function_keys[id(func)]
+        self.functions[key] = self.used_functions[key] = entry
+
+
+def record_function_code(func, codegen, pyname):
+    """ Generate the code of func and return it in a form that can later be
+    added to a different codegen with replay_function_code. """
+    start = len(codegen.code)
+    assert codegen.recorded_declarations is None
+    codegen.recorded_declarations = recorded = []
+    try:
+        func._make_code(codegen, pyname)
+    finally:
+        codegen.recorded_declarations = None
+    declarations = []
+    created = set()
+    alllines = codegen.code[start:]
+    # nested declarations are recorded before the outer ones. their lines
+    # are removed from the lines of the outer declaration, to be able to
+    # replay the outer one without the nested one
+    nested = []
+    for key, nameprefix, name, declstart, declend in recorded:
+        lines = []
+        index = declstart
+        for nestedstart, nestedend in nested:
+            if declstart <= nestedstart and nestedend <= declend:
+                lines.extend(codegen.declarations[index:nestedstart])
+                index = nestedend
+        lines.extend(codegen.declarations[index:declend])
+        nested = [(nestedstart, nestedend) for nestedstart, nestedend in nested
+                      if not declstart <= nestedstart < declend]
+        nested.append((declstart, declend))
+        declarations.append((_key_to_data(key), nameprefix, name, lines))
+        created.add(name)
+        alllines.extend(lines)
+    # the code can also mention declarations that were made before, eg
+    # tuple classes. their names depend on the order of declarations
+    dependencies = []
+    for name in sorted(set(GENERATED_NAME_RE.findall("\n".join(alllines)))):
+        tup = codegen.declarationnames.get(name)
+        if tup is None or name in created:
+            continue
+        key, nameprefix = tup
+        dependencies.append((name, _key_to_data(key), nameprefix))
+    return declarations, dependencies, codegen.code[start:]
+
+def replay_function_code(entry, codegen):
+    """ Add the code of a function that was recorded with
+    record_function_code to codegen. The declarations that the code makes or
+    mentions can have different names in codegen, they are renamed. Returns
+    False if the code cannot be used, because a declaration it depends on
+    does not exist in codegen. """
+    declarations, dependencies, code = entry
+    renames = {}
+    try:
+        for name, data, nameprefix in dependencies:
+            tup = _data_to_key(data, codegen), nameprefix
+            if tup not in codegen.declarationcache:
+                return False
+            renames[name] = codegen.declarationcache[tup]
+        keys = [_data_to_key(data, codegen) for data, _, _, _ in declarations]
+    except KeyError:
+        return False
+    # allocate the new names in the order in which the original names were
+    # allocated, which is not the recorded order for nested declarations
+    order = sorted(range(len(declarations)),
+                   key=lambda i: int(declarations[i][2].rsplit("_", 1)[1]))
+    new = [False] * len(declarations)
+    for i in order:
+        key = keys[i]
+        data, nameprefix, name, lines = declarations[i]
+        tup = key, nameprefix
+        if tup in codegen.declarationcache:
+            renames[name] = codegen.declarationcache[tup]
+            continue
+        new[i] = True
+        num = codegen.gensym.get(nameprefix, 0) + 1
+        codegen.gensym[nameprefix] = num
+        newname = renames[name] = codegen.declarationcache[tup] = "%s_%s" % (nameprefix, num)
+        codegen.declarationnames[newname] = tup
+        if isinstance(key, (types.Tuple, types.List)):
+            key.pyname = newname
+            if isinstance(key, types.Tuple):
+                key.uninitialized_value = "%s()" % (newname, )
+    newlines = []
+    for i, (data, nameprefix, name, lines) in enumerate(declarations):
+        if new[i]:
+            newlines.extend(lines)
+    for name, newname in renames.items():
+        if name == newname:
+            del renames[name]
+    if renames:
+        def rename(match):
+            name = match.group(0)
+            return renames.get(name, name)
+        newlines = [GENERATED_NAME_RE.sub(rename, line) for line in newlines]
+        code = [GENERATED_NAME_RE.sub(rename, line) for line in code]
+    codegen.declarations.extend(newlines)
+    codegen.code.extend(code)
+    return True
+
+
+# ____________________________________________________________
+# parallel code generation
+
+_worker_state = None
+
+def _make_function_code_in_worker(index):
+    codegen, functions = _worker_state
+    func = functions[index]
+    gensym = codegen.gensym.copy()
+    codestart = len(codegen.code)
+    declstart = len(codegen.declarations)
+    entry = record_function_code(func, codegen, func.pyname)
+    # undo the declarations of the function, all functions have to be
+    # generated starting from the state after the global pass
+    for data, nameprefix, name, lines in entry[0]:
+        del codegen.declarationcache[codegen.declarationnames.pop(name)]
+    codegen.gensym = gensym
+    del codegen.code[codestart:]
+    del codegen.declarations[declstart:]
+    return entry
+
+def make_code_parallel(ast, codegen, processes):
+    """ Generate the code for all the declarations of ast. First everything
+    apart from the function bodies is generated, in order. Then the function
+    bodies are generated in a pool of processes, starting from the state
+    after that global pass. Their code is merged in the order of the
+    declarations. """
+    global _worker_state
+    import multiprocessing
+    pieces = [] # functions or (code, declarations) of the other declarations
+    functions = []
+    cache = codegen.cache
+    for decl in ast.declarations:
+        if isinstance(decl, parse.Function):
+            if decl.declare(codegen):
+                pieces.append(decl)
+                if cache is None or not cache.has_function_code(decl):
+                    functions.append(decl)
+            pieces.append(([''], []))
+        else:
+            start = len(codegen.code)
+            declstart = len(codegen.declarations)
+            decl.make_code(codegen)
+            codegen.emit()
+            pieces.append((codegen.code[start:], codegen.declarations[declstart:]))
+            del codegen.code[start:]
+            del codegen.declarations[declstart:]
+    _worker_state = codegen, functions
+    try:
+        pool = multiprocessing.Pool(processes)
+        try:
+            entries = pool.map(_make_function_code_in_worker,
+                               range(len(functions)), chunksize=8)
+        finally:
+            pool.terminate()
+    finally:
+        _worker_state = None
+    results = {}
+    for func, entry in zip(functions, entries):
+        results[id(func)] = entry
+    for piece in pieces:
+        if isinstance(piece, tuple):
+            code, declarations = piece
+            codegen.code.extend(code)
+            codegen.declarations.extend(declarations)
+            continue
+        func = piece
+        entry = results.get(id(func))
+        if entry is None:
+            func.make_body_code(codegen)
+            continue
+        res = replay_function_code(entry, codegen)
+        assert res
+        if cache is not None:
+            cache.function_misses += 1
+            cache.add_function_code(func, entry)
+
 
 # ____________________________________________________________
 # declarations
@@ -318,47 +832,130 @@ class __extend__(parse.GlobalVal):
 class __extend__(parse.Register):
     def make_code(self, codegen):
         typ = self.typ.resolve_type(codegen)
+        if self.name in codegen.register_arrays:
+            arrayname, index, size = codegen.register_arrays[self.name]
+            field = "%s[%s]" % (arrayname, index)
+            if index == codegen.register_arrays_first[arrayname]:
+                codegen.register_fields.append(
+                    (arrayname, "[%s] * %s" % (typ.uninitialized_value, size)))
+        else:
+            field = self.name
+            codegen.register_fields.append((field, typ.uninitialized_value))
         if self.name in codegen.promoted_registers:
-            pyname = "jit.promote(r.%s)" % self.name
+            pyname = "jit.promote(r.%s)" % field
         else:
-            pyname = "r.%s" % self.name
+            pyname = "r.%s" % field
         codegen.add_global(self.name, pyname, typ, self)
         with codegen.emit_code_type("declarations"):
             codegen.emit("# %s" % (self, ))
-            codegen.emit("r.%s = %s" % (self.name, typ.uninitialized_value))
+
+
+class UnionSwitch(object):
+    """ A switch on the variant of the argument argname of a function. blocks
+    are the blocks of the function, where the first check of the switch is
+    split off into its own block at switchpc. setup is the set of the pcs of
+    the blocks that run before the switch, params are the names of the
+    variables that are passed from the setup code to the methods. switches is
+    the chain of checks, a list of (block, pc, check), the last check is None
+    for the default case. """
+
+    def __init__(self, argname, blocks, switchpc, setup, params, decls, switches):
+        self.argname = argname
+        self.blocks = blocks
+        self.switchpc = switchpc
+        self.setup = setup
+        self.params = params
+        self.decls = decls
+        self.switches = switches
+
+    def dispatch_blocks(self, funcname):
+        # the blocks of the function that runs the setup code and then calls
+        # the method
+        res = {pc: self.blocks[pc] for pc in self.setup}
+        res[self.switchpc] = [
+            parse.Operation('return', '$meth_' + funcname,
+                            [parse.Var(name) for name in self.params]),
+            parse.End()]
+        return res
+
+    def report(self):
+        setupops = 0
+        for pc in self.setup:
+            for op in self.blocks[pc]:
+                if not isinstance(op, (parse.LocalVarDeclaration, parse.Goto)):
+                    setupops += 1
+        return "switch on %s, %s variants, %s operations of setup code, passing %s" % (
+            self.argname, len(self.switches) - 1, setupops, ", ".join(self.params))
 
 
 class __extend__(parse.Function):
     def make_code(self, codegen):
+        if self.declare(codegen):
+            self.make_body_code(codegen)
+
+    def declare(self, codegen):
         pyname = "func_" + self.name
         if codegen.globalnames[self.name].pyname is not None:
             print "duplicate!", self.name, codegen.globalnames[self.name].pyname
-            return
+            return False
         codegen.update_global_pyname(self.name, pyname)
         self.pyname = pyname
+        return True
+
+    def make_body_code(self, codegen):
+        if codegen.cache is not None:
+            codegen.cache.make_function_code(self, codegen, self.pyname)
+        else:
+            self._make_code(codegen, self.pyname)
+
+    def _make_code(self, codegen, pyname):
         blocks = self._prepare_blocks()
-        entrycounts = self._compute_entrycounts(blocks)
-        if self.detect_union_switch(blocks[0]) and entrycounts[0] == 1:
+        switch = self.find_union_switch(blocks)
+        if switch is not None:
             print "making method!", self.name
+            blocks = switch.dispatch_blocks(self.name)
             with self._scope(codegen, pyname):
-                codegen.emit("return %s.meth_%s(%s)" % (self.args[0], self.name, ", ".join(self.args[1:])))
-            self._emit_methods(blocks, entrycounts, codegen)
+                blocks = self._optimize(blocks, codegen)
+                entrycounts = self._compute_entrycounts(blocks)
+                self._emit_blocks(blocks, codegen, entrycounts)
+            self._emit_methods(switch, codegen)
             return
         with self._scope(codegen, pyname):
+            blocks = self._optimize(blocks, codegen)
+            entrycounts = self._compute_entrycounts(blocks)
             if entrycounts == {0: 1}:
-                assert self.body[-1].end_of_block
-                self.emit_block_ops(self.body, codegen)
+                assert blocks[0][-1].end_of_block
+                self.emit_block_ops(blocks[0], codegen)
             else:
                 self._emit_blocks(blocks, codegen, entrycounts, )
         codegen.emit()
 
+    def _optimize(self, blocks, codegen, startpc=0):
+        # must be called in the scope of the function
+        for block in blocks.itervalues():
+            for op in block:
+                if isinstance(op, parse.LocalVarDeclaration):
+                    codegen.add_local(op.name, op.name, op.typ.resolve_type(codegen), op)
+        blocks = optimize.propagate_values(blocks, codegen, startpc)
+        blocks = optimize.unbox_bitvectors(blocks, codegen)
+        # the boxings that are dead now would get in the way of coalescing
+        blocks = optimize.remove_dead_code(blocks)
+        blocks = optimize.narrow_int_locals(blocks, codegen)
+        # the narrowed locals can have constants propagated into them now
+        blocks = optimize.propagate_values(blocks, codegen, startpc)
+        blocks = optimize.coalesce_temporaries(blocks, codegen)
+        return optimize.remove_dead_code(blocks)
+
     @contextmanager
-    def _scope(self, codegen, pyname):
+    def _scope(self, codegen, pyname, args=None, argtyps=None):
         typ = codegen.globalnames[self.name].typ
-        with codegen.enter_scope(self), codegen.emit_indent("def %s(%s):" % (pyname, ", ".join(self.args))):
+        if args is None:
+            args = self.args
+            argtyps = typ.argtype.elements
+        with codegen.enter_scope(self), codegen.emit_indent("def %s(%s):" % (pyname, ", ".join(args))):
             codegen.add_local('return', 'return_', typ.restype, self)
-            for i, arg in enumerate(self.args):
-                codegen.add_local(arg, arg, typ.argtype.elements[i], self)
+            for arg, argtyp in zip(args, argtyps):
+                codegen.add_local(arg, arg, argtyp, self)
             yield
 
     def _prepare_blocks(self):
@@ -394,42 +991,110 @@ class __extend__(parse.Function):
                     entrycounts[op.target] = entrycounts.get(op.target, 0) + 1
         return entrycounts
 
-    def _find_first_non_decl(self, block):
-        # return first operation that's not a declaration
-        for op in block:
-            if isinstance(op, parse.LocalVarDeclaration):
-                continue
-            return op
-
-    def detect_union_switch(self, block):
-        # heuristic: if the function starts with a switch on the first
-        # argument, turn it into a method
-        op = self._find_first_non_decl(block)
-        if self._is_union_switch(op):
-            return op
-        else:
+    def find_union_switch(self, blocks):
+        """ Look for a switch on the variant of one of the arguments that
+        dominates the rest of the function, ie the code after the first check
+        of the switch can only be reached through it. The function is then
+        turned into a method per variant on the union classes. Returns a
+        UnionSwitch or None. """
+        for pc, block in sorted(blocks.items()):
+            for index, op in enumerate(block):
+                if self._is_union_switch(op):
+                    switch = self._make_union_switch(
+                        blocks, pc, index, op.condition.var.name)
+                    if switch is not None:
+                        return switch
+        return None
+
+    def _make_union_switch(self, blocks, pc, index, argname):
+        # split the check off into its own block
+        switchpc = max(blocks) + 1
+        blocks = blocks.copy()
+        block = blocks[pc]
+        blocks[pc] = block[:index] + [parse.Goto(switchpc)]
+        blocks[switchpc] = block[index:]
+        setup = self._reachable_blocks(blocks, 0, switchpc)
+        rest = self._reachable_blocks(blocks, switchpc)
+        if setup & rest:
             return None
+        if self._compute_entrycounts(blocks).get(switchpc) != 1:
+            return None # the switch is in a loop
+        for restpc in rest:
+            for op in blocks[restpc]:
+                if optimize.defines(op) == argname:
+                    return None
+        # the local variables that are live are passed to the methods, the
+        # other declarations of the setup code are copied into them
+        live = optimize.compute_liveness(blocks)[switchpc]
+        if 'return' in live:
+            return None
+        decls = {}
+        for setuppc in setup:
+            for op in blocks[setuppc]:
+                if isinstance(op, parse.LocalVarDeclaration):
+                    decls[op.name] = op
+        params = [argname] + [arg for arg in self.args
+                                  if arg in live and arg != argname]
+        params += sorted(live & set(decls))
+        blocks[switchpc] = [parse.LocalVarDeclaration(decl.name, decl.typ)
+                                for name, decl in sorted(decls.items())
+                                    if name not in live] + blocks[switchpc]
+        # find the chain of checks of the switch
+        switches = []
+        curr_offset = switchpc
+        while 1:
+            curr_block = blocks[curr_offset]
+            op = self.detect_union_switch(curr_block, argname)
+            switches.append((curr_block, curr_offset, op))
+            if op is None:
+                break
+            curr_offset = op.target
+        return UnionSwitch(argname, blocks, switchpc, setup, params, decls,
+                           switches)
 
+    @staticmethod
+    def _reachable_blocks(blocks, startpc, stoppc=None):
+        # the set of the pcs of the blocks reachable from startpc, without
+        # going through stoppc
+        res = {startpc}
+        todo = [startpc]
+        while todo:
+            for op in blocks[todo.pop()]:
+                if isinstance(op, (parse.Goto, parse.ConditionalJump)):
+                    if op.target != stoppc and op.target not in res:
+                        res.add(op.target)
+                        todo.append(op.target)
+        return res
 
-    def _is_union_switch(self, op):
+    def detect_union_switch(self, block, argname):
+        # return the check of the variant of argname that the block ends
+        # with, after some straight-line code that doesn't write argname
+        for op in block:
+            if isinstance(op, parse.ConditionalJump):
+                if self._is_union_switch(op, argname):
+                    return op
+                return None
+            if op.end_of_block or optimize.defines(op) == argname:
+                return None
+        return None
+
+    def _is_union_switch(self, op, argname=None):
         return (isinstance(op, parse.ConditionalJump) and
                 isinstance(op.condition, parse.UnionVariantCheck) and
                 isinstance(op.condition.var, parse.Var) and
-                op.condition.var.name == self.args[0])
+                op.condition.var.name in self.args and
+                (argname is None or op.condition.var.name == argname))
 
-    def _emit_methods(self, blocks, entrycounts, codegen):
+    def _emit_methods(self, switch, codegen):
         typ = codegen.globalnames[self.name].typ
-        uniontyp = typ.argtype.elements[0]
-        switches = []
-        curr_offset = 0
-        while 1:
-            curr_block = blocks[curr_offset]
-            op = self.detect_union_switch(curr_block)
-            if op is None:
-                switches.append((curr_block, curr_offset, None))
-                break
-            switches.append((curr_block, curr_offset, op))
-            curr_offset = op.target
+        uniontyp = typ.argtype.elements[self.args.index(switch.argname)]
+        paramtyps = []
+        for name in switch.params:
+            if name in self.args:
+                paramtyps.append(typ.argtype.elements[self.args.index(name)])
+            else:
+                paramtyps.append(switch.decls[name].typ.resolve_type(codegen))
+        switches = switch.switches
         generated_for_class = set()
         for i, (block, oldpc, cond) in enumerate(switches):
             if cond is not None:
@@ -442,7 +1107,7 @@ class __extend__(parse.Function):
                 continue
             generated_for_class.add(clsname)
             copyblock = []
-            # add all var declarations of all the previous blocks
+            # add all the operations before the checks of the previous blocks
             for prevblock, _, prevcond in switches[:i]:
                 copyblock.extend(prevblock[:prevblock.index(prevcond)])
             # now add all operations except the condition
@@ -450,21 +1115,22 @@ class __extend__(parse.Function):
             if cond:
                 del b[block.index(cond)]
             copyblock.extend(b)
-            local_blocks = self._find_reachable(copyblock, oldpc, blocks, known_cls)
-            # recompute entrycounts
-            local_entrycounts = self._compute_entrycounts(local_blocks)
+            local_blocks = self._find_reachable(copyblock, oldpc, switch.blocks, known_cls, switch.argname)
             pyname = self.name + "_" + (cond.condition.variant if cond else "default")
-            with self._scope(codegen, pyname):
+            with self._scope(codegen, pyname, switch.params, paramtyps):
+                local_blocks = self._optimize(local_blocks, codegen, oldpc)
+                # recompute entrycounts
+                local_entrycounts = self._compute_entrycounts(local_blocks)
                 self._emit_blocks(local_blocks, codegen, local_entrycounts, startpc=oldpc)
             codegen.emit("%s.meth_%s = %s" % (clsname, self.name, pyname))
 
-    def _find_reachable(self, block, blockpc, blocks, known_cls=None):
-        # return all the blocks reachable from "block", where self.args[0] is
+    def _find_reachable(self, block, blockpc, blocks, known_cls, argname):
+        # return all the blocks reachable from "block", where argname is
         # know to be an instance of known_cls
         def process(index, current):
             current = current[:]
             for i, op in enumerate(current):
-                if self._is_union_switch(op):
+                if self._is_union_switch(op, argname):
                     if op.condition.variant == known_cls:
                         # always True: can remove
                         current[i] = None
@@ -490,6 +1156,15 @@ class __extend__(parse.Function):
 
 
     def _emit_blocks(self, blocks, codegen, entrycounts, startpc=0):
+        if codegen.structured_control_flow:
+            try:
+                body = controlflow.structure(blocks, startpc)
+            except controlflow.CantStructure:
+                pass
+            else:
+                self._emit_structured(body, codegen)
+                return
+        # fall back to a loop that dispatches on the pc
         codegen.emit("pc = %s" % startpc)
         with codegen.emit_indent("while 1:"):
             for blockpc, block in sorted(blocks.items()):
@@ -497,21 +1172,57 @@ class __extend__(parse.Function):
                     # inlined by emit_block_ops
                     continue
                 with codegen.emit_indent("if pc == %s:" % blockpc):
-                    self.emit_block_ops(block, codegen, entrycounts, blockpc, blocks)
+                    self.emit_block_ops(block, codegen, entrycounts, blockpc, blocks, pcloop=True)
+
+    def _emit_structured(self, body, codegen):
+        # body is the result of controlflow.structure
+        for i, op in enumerate(body):
+            if isinstance(op, controlflow.If):
+                cond = op.condition.condition.to_code(codegen)
+                if op.negated:
+                    cond = "not (%s)" % (cond, )
+                with codegen.emit_indent("if %s:" % (cond, )):
+                    if op.true:
+                        self._emit_structured(op.true, codegen)
+                    else:
+                        codegen.emit("pass")
+                if op.false:
+                    with codegen.emit_indent("else:"):
+                        self._emit_structured(op.false, codegen)
+            elif isinstance(op, controlflow.Loop):
+                with codegen.emit_indent("while 1:"):
+                    self._emit_structured(op.body, codegen)
+            elif op is controlflow.CONTINUE or op is controlflow.BREAK:
+                codegen.emit(op)
+            else:
+                self._emit_op(op, body, i, codegen)
+
+    def _emit_op(self, op, block, i, codegen, pcloop=False):
+        if (isinstance(op, parse.LocalVarDeclaration) and
+                i + 1 < len(block) and
+                isinstance(block[i + 1], (parse.Assignment, parse.Operation)) and
+                op.name == block[i + 1].result):
+            op.make_op_code(codegen, False)
+        elif (isinstance(op, parse.LocalVarDeclaration) and
+                not op.need_default_init and not pcloop):
+            # in the pc loop all the variables are merged at the start of the
+            # loop, so they need to be initialized even if they are dead
+            op.make_op_code(codegen, False)
+        elif isinstance(op, parse.Arbitrary):
+            codegen.emit("# arbitrary")
+            codegen.emit("return %s" % (codegen.gettyp(self.name).restype.uninitialized_value, ))
+        else:
+            codegen.emit("# %s" % (op, ))
+            op.make_op_code(codegen)
 
-    def emit_block_ops(self, block, codegen, entrycounts=(), offset=0, blocks=None):
+    def emit_block_ops(self, block, codegen, entrycounts=(), offset=0, blocks=None, pcloop=False):
         for i, op in enumerate(block):
-            if (isinstance(op, parse.LocalVarDeclaration) and
-                    i + 1 < len(block) and
-                    isinstance(block[i + 1], (parse.Assignment, parse.Operation)) and
-                    op.name == block[i + 1].result):
-                op.make_op_code(codegen, False)
-            elif isinstance(op, parse.ConditionalJump):
+            if isinstance(op, parse.ConditionalJump):
                 with codegen.emit_indent("if %s:" % (op.condition.to_code(codegen))):
                     if entrycounts[op.target] == 1:
                         # can inline!
                         codegen.emit("# inline pc=%s" % op.target)
-                        self.emit_block_ops(blocks[op.target], codegen, entrycounts, op.target, blocks)
+                        self.emit_block_ops(blocks[op.target], codegen, entrycounts, op.target, blocks, pcloop)
                         blocks[op.target][:] = [None]
                     else:
                         codegen.emit("pc = %s" % (op.target, ))
@@ -522,12 +1233,8 @@ class __extend__(parse.Function):
                 if op.target < i:
                     codegen.emit("continue")
                 return
-            elif isinstance(op, parse.Arbitrary):
-                codegen.emit("# arbitrary")
-                codegen.emit("return %s" % (codegen.gettyp(self.name).restype.uninitialized_value, ))
             else:
-                codegen.emit("# %s" % (op, ))
-                op.make_op_code(codegen)
+                self._emit_op(op, block, i, codegen, pcloop)
             if op.end_of_block:
                 return
 
@@ -593,6 +1300,19 @@ class __extend__(parse.Operation):
         elif name.startswith("$zinternal_vector_update"):
             codegen.emit("%s = supportcode.vector_update_inplace(%s, %s, %s, %s)" % (result, result, sargs[0], sargs[1], sargs[2]))
             return
+        elif name.startswith("$meth_"): # dispatch of a union switch
+            codegen.emit("%s = %s.%s(%s)" % (result, sargs[0], name[1:], ", ".join(sargs[1:])))
+            return
+
+        if argtyps and optimize._unboxable_positions(self, codegen) is not None:
+            # fast path for bitvectors of a width known statically and for
+            # machine ints
+            funcname = codegen.globalnames[name].pyname[len("supportcode."):]
+            meth = getattr(argtyps[0], "make_op_code_supportcode_" + funcname, None)
+            code = meth(self, codegen) if meth is not None else None
+            if code is not None:
+                codegen.emit("%s = %s" % (result, code))
+                return
 
         if not sargs:
             args = '()'
@@ -5,6 +5,9 @@ from rpython.rlib import jit
 from rpython.rlib import rmmap
 from rpython.rtyper.lltypesystem import rffi, lltype
 
+# rffi.UNSIGNEDP, which older versions of rpython don't have
+UNSIGNEDP = rffi.CArrayPtr(lltype.Unsigned)
+
 class MemBase(object):
     def close(self):
         pass
@@ -57,6 +60,64 @@ class MemBase(object):
     def mark_page_executable(self, start_addr):
         pass
 
+    # bulk writes, used for loading images
+
+    def write_bytes(self, start_addr, data):
+        self._write_bulk(start_addr, len(data), data, r_uint(0))
+
+    def fill(self, start_addr, size, byte=0):
+        self._write_bulk(start_addr, size, None, r_uint(byte) * FILL_PATTERN)
+
+    def _write_bulk(self, start_addr, size, data, fillword):
+        # the unaligned bytes at the start and end are written one by one,
+        # the words between them by _write_words
+        index = 0
+        while index < size and not self.is_aligned(start_addr + r_uint(index)):
+            self._write_bulk_byte(start_addr + r_uint(index), data, index, fillword)
+            index += 1
+        numwords = (size - index) >> 3
+        if numwords > 0:
+            self._write_words(start_addr + r_uint(index), numwords, data, index, fillword)
+            index += numwords << 3
+        while index < size:
+            self._write_bulk_byte(start_addr + r_uint(index), data, index, fillword)
+            index += 1
+
+    def _write_bulk_byte(self, addr, data, index, fillword):
+        if data is None:
+            value = fillword & 0xff
+        else:
+            value = r_uint(ord(data[index]))
+        self._aligned_write(addr, 1, value)
+
+    def _write_words(self, start_addr, numwords, data, index, fillword):
+        # data is None when filling with fillword, otherwise the words are
+        # read from data, starting at index
+        for i in range(numwords):
+            self._aligned_write(start_addr + r_uint(i << 3), 8, _bulk_word(data, index + (i << 3), fillword))
+
+    # copy-on-write snapshots. after snapshot() the old contents of every
+    # page are saved when the page is first written to, restore() copies
+    # only those pages back
+
+    def snapshot(self):
+        raise NotImplementedError
+
+    def restore(self):
+        raise NotImplementedError
+
+FILL_PATTERN = r_uint(0x0101010101010101)
+
+@always_inline
+def _bulk_word(data, index, fillword):
+    if data is None:
+        return fillword
+    # little endian
+    value = r_uint(0)
+    for i in range(7, -1, -1):
+        value = (value << 8) | r_uint(ord(data[index + i]))
+    return value
+
 MEM_STATUS_IMMUTABLE = 'i'
 MEM_STATUS_NORMAL = 'n'
 MEM_STATUS_MUTABLE = 'm'
@@ -64,6 +125,20 @@ MEM_STATUS_MUTABLE = 'm'
 class Version(object):
     pass
 
+class PageState(object):
+    # writes to an immutable page make it mutable, it becomes immutable again
+    # after quiet_period fetches from it without writes. the quiet period is
+    # doubled every time, to not keep invalidating pages that change often
+    _immutable_fields_ = ['version?']
+
+    QUIET_PERIOD = 1000
+    MAX_QUIET_PERIOD = 1 << 30
+
+    def __init__(self):
+        self.version = Version()
+        self.quiet_fetches = 0
+        self.quiet_period = self.QUIET_PERIOD
+
 
 class FlatMemory(MemBase):
     SIZE = 64 * 1024 * 1024 // 8 # 64 MB
@@ -72,7 +147,7 @@ class FlatMemory(MemBase):
     PAGE_SIZE = 1 << 9
     PAGE_MASK = PAGE_SIZE - 1
 
-    _immutable_fields_ = ['mem?', 'version?', 'status']
+    _immutable_fields_ = ['mem?', 'status', 'pages[*]']
 
     def __init__(self, mmap=False, size=SIZE):
         self.size = size
@@ -87,15 +162,26 @@ class FlatMemory(MemBase):
                 nc(rmmap.PROT_READ | rmmap.PROT_WRITE),
                 nc(rmmap.MAP_PRIVATE | rmmap.MAP_ANONYMOUS),
                 nc(-1), nc(0))
-            mem = rffi.cast(rffi.UNSIGNEDP, mem)
+            mem = rffi.cast(UNSIGNEDP, mem)
         else:
             mem = [r_uint(0)] * (size // 8)
         self.mem = mem
-        self.status = [MEM_STATUS_NORMAL] * size
-        self.version = Version()
+        numpages = (size // 8 + self.PAGE_MASK) >> self.PAGE_BITS
+        # one char per page, stored as a byte array after translation
+        self.status = [MEM_STATUS_NORMAL] * numpages
+        # every page has its own version, so that a write only invalidates
+        # the traces that depend on that page
+        # not a list comprehension, pages[*] must not be resized
+        self.pages = [None] * numpages
+        for i in range(numpages):
+            self.pages[i] = PageState()
 
         self.mmap = mmap
 
+        # page number -> saved words of the page, or None. see snapshot
+        self.saved_pages = None
+        self.dirty_pages = []
+
     def close(self):
         if not self.mmap:
             return
@@ -104,11 +190,12 @@ class FlatMemory(MemBase):
         else:
             nc = lambda x: x
         rmmap.c_munmap_safe(rffi.cast(rffi.CCHARP, self.mem), nc(self.SIZE))
-        self.mem = lltype.nullptr(rffi.UNSIGNEDP.TO)
+        self.mem = lltype.nullptr(UNSIGNEDP.TO)
 
     @always_inline
     def _split_addr(self, start_addr, num_bytes):
-        mem_offset = start_addr >> 3
+        # word and page indexes are ints in all the paths, see _write_words
+        mem_offset = intmask(start_addr >> 3)
         inword_addr = start_addr & 0b111
         # little endian
         if num_bytes == 8:
@@ -122,27 +209,32 @@ class FlatMemory(MemBase):
             jit.promote(start_addr)
         mem_offset, inword_addr, mask = self._split_addr(start_addr, num_bytes)
 
-        if (executable_flag and
-                self._get_status_page(mem_offset, self.version) == MEM_STATUS_IMMUTABLE):
-            data = self._immutable_read(mem_offset, self.version)
+        if executable_flag:
+            version = self._get_page(mem_offset).version
+            if self._get_status_page(mem_offset, version) == MEM_STATUS_IMMUTABLE:
+                data = self._immutable_read(mem_offset, version)
+            else:
+                data = self.mem[mem_offset]
+                jit.promote(data)
         else:
             data = self.mem[mem_offset]
-            if executable_flag:
-                jit.promote(data)
         if num_bytes == 8:
             assert inword_addr == 0
             return data
         return (data >> (inword_addr * 8)) & mask
 
+    def _get_page(self, mem_offset):
+        return self.pages[mem_offset >> self.PAGE_BITS]
+
     @jit.elidable_promote('all')
     def _immutable_read(self, mem_offset, version):
-        assert version is self.version
+        assert version is self._get_page(mem_offset).version
         return self.mem[mem_offset]
 
     @jit.elidable_promote('all')
     def _get_status_page(self, mem_offset, version):
-        assert version is self.version
-        return self.status[mem_offset]
+        assert version is self._get_page(mem_offset).version
+        return self.status[mem_offset >> self.PAGE_BITS]
 
     def _aligned_write(self, start_addr, num_bytes, value):
         mem_offset, inword_addr, mask = self._split_addr(start_addr, num_bytes)
@@ -157,33 +249,92 @@ class FlatMemory(MemBase):
         self._write_word(mem_offset, (olddata & ~mask) | value)
 
     def _write_word(self, mem_offset, value):
-        if self.status[mem_offset] == MEM_STATUS_IMMUTABLE:
+        status = self.status[mem_offset >> self.PAGE_BITS]
+        if status == MEM_STATUS_IMMUTABLE:
             oldval = self.mem[mem_offset]
             if oldval != value:
                 self._invalidate(mem_offset)
+        elif status == MEM_STATUS_MUTABLE:
+            self._get_page(mem_offset).quiet_fetches = 0
+        saved_pages = self.saved_pages
+        if saved_pages is not None:
+            pagenum = mem_offset >> self.PAGE_BITS
+            if saved_pages[pagenum] is None:
+                self._save_page(pagenum)
         self.mem[mem_offset] = value
 
+    def _write_words(self, start_addr, numwords, data, index, fillword):
+        mem_offset = intmask(start_addr >> 3)
+        end = mem_offset + numwords
+        while mem_offset < end:
+            pagenum = mem_offset >> self.PAGE_BITS
+            pageend = min(end, (pagenum + 1) << self.PAGE_BITS)
+            status = self.status[pagenum]
+            if status == MEM_STATUS_IMMUTABLE:
+                # might need to invalidate
+                for i in range(mem_offset, pageend):
+                    self._write_word(i, _bulk_word(data, index, fillword))
+                    index += 8
+            else:
+                if status == MEM_STATUS_MUTABLE:
+                    self.pages[pagenum].quiet_fetches = 0
+                saved_pages = self.saved_pages
+                if saved_pages is not None and saved_pages[pagenum] is None:
+                    self._save_page(pagenum)
+                for i in range(mem_offset, pageend):
+                    self.mem[i] = _bulk_word(data, index, fillword)
+                    index += 8
+            mem_offset = pageend
+
+    def snapshot(self):
+        assert (self.size // 8) & self.PAGE_MASK == 0
+        self.saved_pages = [None] * (self.size // 8 >> self.PAGE_BITS)
+        self.dirty_pages = []
+
+    def _save_page(self, pagenum):
+        pagestart = pagenum << self.PAGE_BITS
+        self.saved_pages[pagenum] = [self.mem[pagestart + i]
+                                     for i in range(self.PAGE_SIZE)]
+        self.dirty_pages.append(pagenum)
+
+    def restore(self):
+        saved_pages = self.saved_pages
+        assert saved_pages is not None
+        for pagenum in self.dirty_pages:
+            page = saved_pages[pagenum]
+            pagestart = pagenum << self.PAGE_BITS
+            for i in range(self.PAGE_SIZE):
+                self.mem[pagestart + i] = page[i]
+            saved_pages[pagenum] = None
+            if self.status[pagenum] == MEM_STATUS_IMMUTABLE:
+                # traces constant-folded the old contents
+                self.pages[pagenum].version = Version()
+        self.dirty_pages = []
+
     def _invalidate(self, mem_offset):
         print "invalidating", mem_offset
-        pagestart = mem_offset & ~self.PAGE_MASK
-        self.version = Version()
-        for bo in range(pagestart, pagestart + self.PAGE_MASK + 1):
-            self.status[bo] = MEM_STATUS_MUTABLE
+        page = self._get_page(mem_offset)
+        page.version = Version()
+        page.quiet_fetches = 0
+        self.status[mem_offset >> self.PAGE_BITS] = MEM_STATUS_MUTABLE
 
     def mark_page_executable(self, addr):
         jit.promote(addr)
         mem_offset, inword_addr, mask = self._split_addr(addr, 1)
-        status = self._get_status_page(mem_offset, self.version)
-        if status != MEM_STATUS_NORMAL:
+        page = self._get_page(mem_offset)
+        status = self._get_status_page(mem_offset, page.version)
+        if status == MEM_STATUS_IMMUTABLE:
             return
-        pagestart = mem_offset & ~self.PAGE_MASK
-        self._mark_page_executable(pagestart)
+        if status == MEM_STATUS_MUTABLE:
+            page.quiet_fetches += 1
+            if page.quiet_fetches < page.quiet_period:
+                return
+            page.quiet_period = min(page.quiet_period * 2, page.MAX_QUIET_PERIOD)
+        self._mark_page_executable(mem_offset >> self.PAGE_BITS)
 
-    def _mark_page_executable(self, pagestart):
-        self.version = Version()
-        for mem_offset in range(pagestart, pagestart + self.PAGE_MASK + 1):
-            assert self.status[mem_offset] != MEM_STATUS_MUTABLE
-            self.status[mem_offset] = MEM_STATUS_IMMUTABLE
+    def _mark_page_executable(self, pagenum):
+        self.pages[pagenum].version = Version()
+        self.status[pagenum] = MEM_STATUS_IMMUTABLE
 
 
 class BlockMemory(MemBase):
@@ -191,10 +342,15 @@ class BlockMemory(MemBase):
     BLOCK_SIZE = 2 ** ADDRESS_BITS_BLOCK
     BLOCK_MASK = BLOCK_SIZE - 1
 
+    SNAPSHOT_PAGE_BITS = 12 # 4 KB
+
     def __init__(self):
         self.blocks = {}
         self.last_block = None
         self.last_block_addr = r_uint(0)
+        # page number -> saved words of the page. see snapshot
+        self.saved_pages = None
+        self.page_bits = min(self.SNAPSHOT_PAGE_BITS, self.ADDRESS_BITS_BLOCK)
 
     def get_block(self, block_addr):
         last_block = self.last_block
@@ -240,6 +396,10 @@ class BlockMemory(MemBase):
         return (data >> (inword_addr * 8)) & mask
 
     def _aligned_write(self, start_addr, num_bytes, value):
+        if self.saved_pages is not None:
+            pagenum = start_addr >> self.page_bits
+            if pagenum not in self.saved_pages:
+                self._save_page(pagenum)
         block, block_offset, inword_addr, mask = self._split_addr(start_addr, num_bytes)
         if num_bytes == 8:
             assert inword_addr == 0
@@ -251,75 +411,330 @@ class BlockMemory(MemBase):
         value <<= inword_addr * 8
         block[block_offset] = (olddata & ~mask) | value
 
+    def _write_words(self, start_addr, numwords, data, index, fillword):
+        # chunks that are within one snapshot page, and so within one block
+        end_addr = start_addr + (r_uint(numwords) << 3)
+        while start_addr < end_addr:
+            pagenum = start_addr >> self.page_bits
+            chunk_end = min(end_addr, (pagenum + 1) << self.page_bits)
+            if self.saved_pages is not None and pagenum not in self.saved_pages:
+                self._save_page(pagenum)
+            block = self.get_block(start_addr >> self.ADDRESS_BITS_BLOCK)
+            block_offset = intmask((start_addr & self.BLOCK_MASK) >> 3)
+            for i in range(intmask((chunk_end - start_addr) >> 3)):
+                block[block_offset + i] = _bulk_word(data, index, fillword)
+                index += 8
+            start_addr = chunk_end
+
+    def snapshot(self):
+        self.saved_pages = {}
+
+    def _page_words(self, pagenum):
+        # the block of the page and the offset of its first word in it
+        start_addr = r_uint(pagenum) << self.page_bits
+        block = self.get_block(start_addr >> self.ADDRESS_BITS_BLOCK)
+        return block, intmask((start_addr & self.BLOCK_MASK) >> 3)
+
+    def _save_page(self, pagenum):
+        block, offset = self._page_words(pagenum)
+        size = (1 << self.page_bits) // 8
+        assert offset >= 0 and size > 0
+        self.saved_pages[pagenum] = block[offset: offset + size]
+
+    def restore(self):
+        assert self.saved_pages is not None
+        for pagenum, page in self.saved_pages.iteritems():
+            block, offset = self._page_words(pagenum)
+            for i in range(len(page)):
+                block[offset + i] = page[i]
+        self.saved_pages = {}
+
+
+class Page(object):
+    # like PageState, every page has its own version
+    _immutable_fields_ = ['words', 'version?']
+
+    def __init__(self, words):
+        self.words = words
+        self.status = MEM_STATUS_NORMAL
+        self.version = Version()
 
-class SplitMemory(MemBase):
-    # XXX should be generalized to N segments and auto-generated
 
-    _immutable_fields_ = ['mem1', 'address_base1', 'address_end1', 'mem2', 'address_base2', 'address_end2']
+class SparseMemory(MemBase):
+    """ Memory of any size that is made of 4 KB pages, which are only
+    allocated when they are first written to. Reading a page that was never
+    written to returns zeros. The pages of the last accesses are cached in a
+    small direct-mapped TLB, in front of the dictionary of all pages. The
+    status and the version (see FlatMemory) are kept per page. """
 
-    def __init__(self, mem1, address_base1, size1, mem2, address_base2, size2):
-        assert self.is_aligned(address_base1)
-        assert self.is_aligned(size1)
-        # fits in 63 bit
-        assert not (address_base1 + size1) & (r_uint(1) << 63)
-        self.mem1 = mem1
-        self.address_base1 = intmask(address_base1)
-        self.address_end1 = intmask(address_base1 + size1)
+    PAGE_BITS = 12 # 4 KB
+    PAGE_WORDS = (1 << PAGE_BITS) // 8
+    TLB_BITS = 6
+    TLB_SIZE = 1 << TLB_BITS
+    TLB_MASK = TLB_SIZE - 1
+    # no page has that number, since the addresses are 64 bit
+    NO_PAGE = r_uint(-1)
 
-        assert self.is_aligned(address_base2)
-        assert self.is_aligned(size2)
-        assert not (address_base2 + size2) & (r_uint(1) << 63)
-        self.mem2 = mem2
-        self.address_base2 = intmask(address_base2)
-        self.address_end2 = intmask(address_base2 + size2)
+    _immutable_fields_ = ['pages_version?', 'tlb_tags', 'tlb_pages']
 
-    def _not_huge(self, start_addr):
-        # highest bit as a unsigned int not set
-        return not (start_addr & (r_uint(1)<<63))
+    def __init__(self):
+        self.pages = {}
+        self.tlb_tags = [self.NO_PAGE] * self.TLB_SIZE
+        self.tlb_pages = [None] * self.TLB_SIZE
+        # changes when pages are removed, see _get_code_page
+        self.pages_version = Version()
+        # page number -> saved words of the page, None if the page didn't
+        # exist. see snapshot
+        self.saved_pages = None
+
+    def get_page(self, pagenum, allocate):
+        index = intmask(pagenum & self.TLB_MASK)
+        if self.tlb_tags[index] == pagenum:
+            return self.tlb_pages[index]
+        page = self.pages.get(pagenum, None)
+        if page is None:
+            if not allocate:
+                return None
+            page = self.pages[pagenum] = Page([r_uint(0)] * self.PAGE_WORDS)
+        self.tlb_tags[index] = pagenum
+        self.tlb_pages[index] = page
+        return page
 
-    def check_mem1(self, start_addr):
-        return self._not_huge(start_addr) and (self.address_base1 <= intmask(start_addr) < self.address_end1)
+    @jit.elidable_promote('all')
+    def _get_code_page(self, pagenum, pages_version):
+        # allocates the page instead of returning None, so that the result
+        # stays the same until restore removes pages
+        assert pages_version is self.pages_version
+        return self.get_page(pagenum, True)
 
-    def check_mem1_fast(self, start_addr):
-        return self._not_huge(start_addr) and (intmask(start_addr) < self.address_end1)
+    def _flush_tlb(self):
+        for i in range(self.TLB_SIZE):
+            self.tlb_tags[i] = self.NO_PAGE
+            self.tlb_pages[i] = None
 
-    def check_mem2(self, start_addr):
-        return self._not_huge(start_addr) and (self.address_base2 <= intmask(start_addr) < self.address_end2)
+    @always_inline
+    def _split_addr(self, start_addr, num_bytes):
+        pagenum = start_addr >> self.PAGE_BITS
+        page_offset = intmask((start_addr & ((1 << self.PAGE_BITS) - 1)) >> 3)
+        inword_addr = start_addr & 0b111
+        # little endian
+        if num_bytes == 8:
+            mask = r_uint(-1)
+        else:
+            mask = (r_uint(1) << (num_bytes * 8)) - 1
+        return pagenum, page_offset, inword_addr, mask
 
     def _aligned_read(self, start_addr, num_bytes, executable_flag):
         if executable_flag:
             jit.promote(start_addr)
-        if self.address_base1:
-            if self.check_mem1(start_addr):
-                return self.mem1._aligned_read(start_addr - self.address_base1, num_bytes, executable_flag)
+        pagenum, page_offset, inword_addr, mask = self._split_addr(start_addr, num_bytes)
+        if executable_flag:
+            page = self._get_code_page(pagenum, self.pages_version)
+            version = page.version
+            if self._get_status_page(page, version) == MEM_STATUS_IMMUTABLE:
+                data = self._immutable_read(page, page_offset, version)
+            else:
+                data = page.words[page_offset]
+                jit.promote(data)
         else:
-            if self.check_mem1_fast(start_addr):
-                return self.mem1._aligned_read(start_addr, num_bytes, executable_flag)
-        if self.check_mem2(start_addr):
-            return self.mem2._aligned_read(start_addr - self.address_base2, num_bytes, executable_flag)
-        raise ValueError
+            page = self.get_page(pagenum, False)
+            if page is None:
+                return r_uint(0)
+            data = page.words[page_offset]
+        if num_bytes == 8:
+            assert inword_addr == 0
+            return data
+        return (data >> (inword_addr * 8)) & mask
+
+    @jit.elidable_promote('all')
+    def _immutable_read(self, page, page_offset, version):
+        assert version is page.version
+        return page.words[page_offset]
+
+    @jit.elidable_promote('all')
+    def _get_status_page(self, page, version):
+        assert version is page.version
+        return page.status
 
     def _aligned_write(self, start_addr, num_bytes, value):
-        if self.address_base1:
-            if self.check_mem1(start_addr):
-                return self.mem1._aligned_write(start_addr - self.address_base1, num_bytes, value)
+        pagenum, page_offset, inword_addr, mask = self._split_addr(start_addr, num_bytes)
+        if self.saved_pages is not None and pagenum not in self.saved_pages:
+            self._save_page(pagenum)
+        page = self.get_page(pagenum, True)
+        if num_bytes != 8:
+            assert value & ~mask == 0
+            mask <<= inword_addr * 8
+            value = (page.words[page_offset] & ~mask) | (value << (inword_addr * 8))
         else:
-            if self.check_mem1_fast(start_addr):
-                return self.mem1._aligned_write(start_addr, num_bytes, value)
-        if self.check_mem2(start_addr):
-            return self.mem2._aligned_write(start_addr - self.address_base2, num_bytes, value)
-        raise ValueError
+            assert inword_addr == 0
+        if page.status == MEM_STATUS_IMMUTABLE and page.words[page_offset] != value:
+            page.version = Version()
+            page.status = MEM_STATUS_MUTABLE
+        page.words[page_offset] = value
 
-    def mark_page_executable(self, start_addr):
-        if self.address_base1:
-            if self.check_mem1(start_addr):
-                return self.mem1.mark_page_executable(start_addr - self.address_base1)
+    def mark_page_executable(self, addr):
+        jit.promote(addr)
+        page = self._get_code_page(addr >> self.PAGE_BITS, self.pages_version)
+        if self._get_status_page(page, page.version) != MEM_STATUS_NORMAL:
+            return
+        page.version = Version()
+        page.status = MEM_STATUS_IMMUTABLE
+
+    def snapshot(self):
+        self.saved_pages = {}
+
+    def _save_page(self, pagenum):
+        page = self.get_page(pagenum, False)
+        if page is None:
+            self.saved_pages[pagenum] = None
         else:
-            if self.check_mem1_fast(start_addr):
-                return self.mem1.mark_page_executable(start_addr)
-        if self.check_mem2(start_addr):
-            return self.mem2.mark_page_executable(start_addr - self.address_base2)
+            self.saved_pages[pagenum] = page.words[:]
+
+    def restore(self):
+        assert self.saved_pages is not None
+        removed = False
+        for pagenum, words in self.saved_pages.iteritems():
+            page = self.pages[pagenum]
+            if words is None:
+                # allocated after the snapshot
+                del self.pages[pagenum]
+                removed = True
+            else:
+                for i in range(self.PAGE_WORDS):
+                    page.words[i] = words[i]
+                if page.status == MEM_STATUS_IMMUTABLE:
+                    # traces constant-folded the old contents
+                    page.version = Version()
+        self.saved_pages = {}
+        self._flush_tlb()
+        if removed:
+            self.pages_version = Version()
+
+
+class MMIOHandler(MemBase):
+    """ Base class for memory-mapped devices, which implement _aligned_read
+    and _aligned_write. The addresses passed to them are relative to the
+    start of the region of the device. """
+
+    # the state of a device is not part of the guest memory
+    def snapshot(self):
+        pass
+
+    def restore(self):
+        pass
+
+
+class Region(object):
+    _immutable_fields_ = ['address_base', 'address_end', 'mem']
+
+    def __init__(self, address_base, size, mem):
+        # fits in 63 bit
+        assert not (address_base + size) & (r_uint(1) << 63)
+        self.address_base = intmask(address_base)
+        self.address_end = intmask(address_base + size)
+        self.mem = mem
+
+
+class RegionMap(object):
+    # sorted by address, replaced as a whole when a region is added
+    _immutable_fields_ = ['regions[*]']
+
+    def __init__(self, regions):
+        self.regions = regions
+
+    @jit.unroll_safe
+    def find(self, addr):
+        regions = self.regions
+        low = 0
+        high = len(regions)
+        while low < high:
+            mid = (low + high) >> 1
+            region = regions[mid]
+            if addr < region.address_base:
+                high = mid
+            elif addr >= region.address_end:
+                low = mid + 1
+            else:
+                return region
+        return None
+
+
+class SplitMemory(MemBase):
+    """ Maps any number of non-overlapping address ranges to backing memories
+    or MMIO handlers. The region map is quasi-immutable, so in a trace the
+    binary search is unrolled and only the guards on the address remain. """
+
+    _immutable_fields_ = ['regionmap?']
+
+    def __init__(self):
+        self.regionmap = RegionMap([])
+
+    def add_region(self, address_base, size, mem):
+        assert self.is_aligned(address_base)
+        assert self.is_aligned(size)
+        region = Region(address_base, size, mem)
+        regions = self.regionmap.regions
+        index = 0
+        while index < len(regions) and regions[index].address_base < region.address_base:
+            index += 1
+        if index > 0:
+            assert regions[index - 1].address_end <= region.address_base, "overlapping regions"
+        if index < len(regions):
+            assert region.address_end <= regions[index].address_base, "overlapping regions"
+        self.regionmap = RegionMap(regions[:index] + [region] + regions[index:])
+
+    def _find_region(self, start_addr):
+        # highest bit as a unsigned int set, not in any region
+        if start_addr & (r_uint(1) << 63):
+            return None
+        return self.regionmap.find(intmask(start_addr))
+
+    def _aligned_read(self, start_addr, num_bytes, executable_flag):
+        if executable_flag:
+            jit.promote(start_addr)
+        region = self._find_region(start_addr)
+        if region is None:
+            raise ValueError
+        return region.mem._aligned_read(start_addr - region.address_base, num_bytes, executable_flag)
+
+    def _aligned_write(self, start_addr, num_bytes, value):
+        region = self._find_region(start_addr)
+        if region is None:
+            raise ValueError
+        return region.mem._aligned_write(start_addr - region.address_base, num_bytes, value)
+
+    def _write_bulk(self, start_addr, size, data, fillword):
+        # split at the region boundaries
+        index = 0
+        while index < size:
+            addr = start_addr + r_uint(index)
+            region = self._find_region(addr)
+            if region is None:
+                raise ValueError
+            chunk = min(size - index, region.address_end - intmask(addr))
+            assert chunk > 0
+            if data is None:
+                chunk_data = None
+            elif index == 0 and chunk == size:
+                chunk_data = data
+            else:
+                chunk_data = data[index: index + chunk]
+            region.mem._write_bulk(addr - region.address_base, chunk, chunk_data, fillword)
+            index += chunk
+
+    def mark_page_executable(self, start_addr):
+        region = self._find_region(start_addr)
+        if region is not None:
+            region.mem.mark_page_executable(start_addr - region.address_base)
+
+    def snapshot(self):
+        for region in self.regionmap.regions:
+            region.mem.snapshot()
+
+    def restore(self):
+        for region in self.regionmap.regions:
+            region.mem.restore()
 
     def close(self):
-        self.mem1.close()
-        self.mem2.close()
+        for region in self.regionmap.regions:
+            region.mem.close()
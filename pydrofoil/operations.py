@@ -85,6 +85,91 @@ class __extend__(types.FixedBitVector):
         result = codegen.gettarget(ast.result)
         return "intmask(%s)" % (arg.to_code(codegen), )
 
+    # calls of the supportcode functions in optimize.UNBOXABLE_FUNCTIONS,
+    # computed on r_uints. the result is only boxed if it is stored in a %bv
+
+    def unboxed_result(self, ast, codegen, s, width=None):
+        restyp = codegen.gettyp(ast.result)
+        if isinstance(restyp, types.FixedBitVector):
+            return s
+        assert isinstance(restyp, (types.GenericBitVector, types.SmallBitVector))
+        if width is None:
+            width = self.width
+        return "bitvector.from_ruint(%s, %s)" % (width, s)
+
+    def unboxed_args(self, ast, codegen):
+        res = []
+        for arg in ast.args:
+            typ = arg.gettyp(codegen)
+            if isinstance(typ, types.FixedBitVector):
+                assert typ.width <= 64
+            elif isinstance(typ, types.Int):
+                res.append(pair(typ, types.MachineInt()).convert(arg, codegen))
+                continue
+            res.append(arg.to_code(codegen))
+        return res
+
+    def unboxed_bvop(self, ast, codegen, template):
+        self.checkwidths([arg.gettyp(codegen) for arg in ast.args])
+        return self.unboxed_result(
+            ast, codegen, template % tuple(self.unboxed_args(ast, codegen)))
+
+    def make_op_code_supportcode_eq_bits(self, ast, codegen):
+        self.checkwidths([arg.gettyp(codegen) for arg in ast.args])
+        return "%s == %s" % tuple(self.unboxed_args(ast, codegen))
+
+    def make_op_code_supportcode_xor_bits(self, ast, codegen):
+        return self.unboxed_bvop(ast, codegen, "%s ^ %s")
+
+    def make_op_code_supportcode_and_bits(self, ast, codegen):
+        return self.unboxed_bvop(ast, codegen, "%s & %s")
+
+    def make_op_code_supportcode_or_bits(self, ast, codegen):
+        return self.unboxed_bvop(ast, codegen, "%s | %s")
+
+    def make_op_code_supportcode_not_bits(self, ast, codegen):
+        return self.unboxed_bvop(ast, codegen, ruint_mask("~%s", self.width))
+
+    def make_op_code_supportcode_shiftl(self, ast, codegen):
+        sarg, si = self.unboxed_args(ast, codegen)
+        return self.unboxed_result(ast, codegen, "supportcode.shiftl_fixed(%s, %s, %s)" % (self.width, sarg, si))
+
+    def make_op_code_supportcode_shiftr(self, ast, codegen):
+        sarg, si = self.unboxed_args(ast, codegen)
+        return self.unboxed_result(ast, codegen, "supportcode.shiftr_fixed(%s, %s)" % (sarg, si))
+
+    def make_op_code_supportcode_vector_access(self, ast, codegen):
+        return "supportcode.vector_access_fixed(%s, %s)" % tuple(self.unboxed_args(ast, codegen))
+
+    def make_op_code_supportcode_vector_update(self, ast, codegen):
+        return self.unboxed_result(ast, codegen, "supportcode.update_fbits(%s, %s, %s)" % tuple(self.unboxed_args(ast, codegen)))
+
+    def make_op_code_supportcode_vector_subrange(self, ast, codegen):
+        sarg, sn, sm = self.unboxed_args(ast, codegen)
+        n, m = ast.args[1:]
+        if isinstance(n, parse.Number) and isinstance(m, parse.Number):
+            width = n.number - m.number + 1
+        else:
+            width = "%s - %s + 1" % (sn, sm)
+        return self.unboxed_result(ast, codegen, "supportcode.vector_subrange_fixed(%s, %s, %s)" % (sarg, sn, sm), width)
+
+    def make_op_code_supportcode_vector_update_subrange(self, ast, codegen):
+        sarg, sn, sm, ss = self.unboxed_args(ast, codegen)
+        return self.unboxed_result(ast, codegen, "supportcode.vector_update_subrange_fixed(%s, %s, %s, %s, %s)" % (self.width, sarg, sn, sm, ss))
+
+    def make_op_code_supportcode_sail_unsigned(self, ast, codegen):
+        sarg, = self.unboxed_args(ast, codegen)
+        if isinstance(codegen.gettyp(ast.result), types.MachineInt):
+            assert self.width < 64
+            return "intmask(%s)" % (sarg, )
+        return "Integer.from_ruint(%s)" % (sarg, )
+
+    def make_op_code_supportcode_sail_signed(self, ast, codegen):
+        sarg, = self.unboxed_args(ast, codegen)
+        s = "supportcode.fast_signed(%s, %s)" % (sarg, self.width)
+        if isinstance(codegen.gettyp(ast.result), types.MachineInt):
+            return s
+        return "Integer.fromint(%s)" % (s, )
 
 class __extend__(types.SmallBitVector):
     def make_op_code_special_eq(self, ast, (sarg1, sarg2), argtyps):
@@ -136,6 +221,75 @@ class __extend__(types.MachineInt):
     def make_op_code_special_isub(self, ast, sargs, argtyps):
         return self.machineintop("%s - %s", sargs, argtyps)
 
+    # calls of the Int functions in optimize.UNBOXABLE_FUNCTIONS, with all
+    # arguments known to be machine ints. the result is computed with an
+    # overflow check, only if it overflows a BigInteger is made
+
+    def unboxed_intop(self, ast, codegen, funcname):
+        sargs = [arg.to_code(codegen) for arg in ast.args]
+        argtyps = [arg.gettyp(codegen) for arg in ast.args]
+        if not all(isinstance(typ, types.MachineInt) for typ in argtyps):
+            return None # not unboxed
+        restyp = codegen.gettyp(ast.result)
+        if isinstance(restyp, types.MachineInt):
+            funcname += "_toint"
+        else:
+            assert isinstance(restyp, types.Int)
+        return self.machineintop("supportcode.%s(%%s, %%s)" % (funcname, ), sargs, argtyps)
+
+    def make_op_code_supportcode_add_int(self, ast, codegen):
+        return self.unboxed_intop(ast, codegen, "add_i_i")
+
+    def make_op_code_supportcode_sub_int(self, ast, codegen):
+        return self.unboxed_intop(ast, codegen, "sub_i_i")
+
+    def make_op_code_supportcode_mult_int(self, ast, codegen):
+        return self.unboxed_intop(ast, codegen, "mult_i_i")
+
+    def make_op_code_supportcode_tdiv_int(self, ast, codegen):
+        return self.unboxed_intop(ast, codegen, "tdiv_i_i")
+
+    def make_op_code_supportcode_tmod_int(self, ast, codegen):
+        return self.unboxed_intop(ast, codegen, "tmod_i_i")
+
+    def make_op_code_supportcode_max_int(self, ast, codegen):
+        return self.unboxed_minmax(ast, codegen, "max")
+
+    def make_op_code_supportcode_min_int(self, ast, codegen):
+        return self.unboxed_minmax(ast, codegen, "min")
+
+    def unboxed_minmax(self, ast, codegen, funcname):
+        sargs = [arg.to_code(codegen) for arg in ast.args]
+        argtyps = [arg.gettyp(codegen) for arg in ast.args]
+        if not all(isinstance(typ, types.MachineInt) for typ in argtyps):
+            return None # not unboxed
+        s = "%s(%s, %s)" % (funcname, sargs[0], sargs[1])
+        if isinstance(codegen.gettyp(ast.result), types.MachineInt):
+            return s
+        return "Integer.fromint(%s)" % (s, )
+
+    def unboxed_intcmp(self, ast, codegen, template):
+        sargs = [arg.to_code(codegen) for arg in ast.args]
+        argtyps = [arg.gettyp(codegen) for arg in ast.args]
+        if not all(isinstance(typ, types.MachineInt) for typ in argtyps):
+            return None # not unboxed
+        return self.machineintop(template, sargs, argtyps)
+
+    def make_op_code_supportcode_eq_int(self, ast, codegen):
+        return self.unboxed_intcmp(ast, codegen, "%s == %s")
+
+    def make_op_code_supportcode_lt(self, ast, codegen):
+        return self.unboxed_intcmp(ast, codegen, "%s < %s")
+
+    def make_op_code_supportcode_lteq(self, ast, codegen):
+        return self.unboxed_intcmp(ast, codegen, "%s <= %s")
+
+    def make_op_code_supportcode_gt(self, ast, codegen):
+        return self.unboxed_intcmp(ast, codegen, "%s > %s")
+
+    def make_op_code_supportcode_gteq(self, ast, codegen):
+        return self.unboxed_intcmp(ast, codegen, "%s >= %s")
+
 class __extend__(types.Int):
     def make_op_code_special_eq(self, ast, (sarg1, sarg2), argtyps):
         return "%s.eq(%s)" % (sarg1, sarg2)
@@ -0,0 +1,757 @@
+""" Optimizations on the blocks of a function, which are given as a dictionary
+{pc: [list of operations]} as produced by Function._prepare_blocks. The
+passes don't mutate the operations, they return new blocks. """
+
+from pydrofoil import parse, types
+
+
+class _VarCollector(parse.Visitor):
+    def __init__(self):
+        self.names = set()
+
+    def visit_Var(self, ast):
+        self.names.add(ast.name)
+
+
+def uses(op):
+    """ Return the set of variable names that op reads. """
+    collector = _VarCollector()
+    op.visit(collector)
+    res = collector.names
+    if isinstance(op, parse.End):
+        res.add('return')
+    elif isinstance(op, parse.TupleElementAssignment):
+        res.add(op.tup) # mutates the tuple
+    elif isinstance(op, parse.StructElementAssignment):
+        res.add(op.obj)
+    elif isinstance(op, parse.RefAssignment):
+        res.add(op.ref)
+    elif (isinstance(op, parse.Operation) and
+            op.name.startswith("$zinternal_vector_update")):
+        res.add(op.result) # updates the vector in place
+    return res
+
+def defines(op):
+    """ Return the name of the variable that op writes, or None. """
+    if isinstance(op, parse.LocalVarDeclaration):
+        return op.name
+    if isinstance(op, (parse.Assignment, parse.Operation, parse.TemplatedOperation)):
+        return op.result
+    return None
+
+
+def declared_locals(blocks):
+    """ Return the set of the names of the local variables declared in the
+    blocks, plus 'return'. """
+    res = {'return'}
+    for block in blocks.itervalues():
+        for op in block:
+            if isinstance(op, parse.LocalVarDeclaration):
+                res.add(op.name)
+    return res
+
+def compute_liveness(blocks):
+    """ Return a dictionary pc -> set of variable names that are live at the
+    start of the block. """
+    livein = {pc: set() for pc in blocks}
+    uses_cache = {}
+    def _uses(op):
+        res = uses_cache.get(op)
+        if res is None:
+            res = uses_cache[op] = uses(op)
+        return res
+    changed = True
+    while changed:
+        changed = False
+        for pc in sorted(blocks, reverse=True):
+            live = set()
+            for op in reversed(blocks[pc]):
+                live = _live_before(op, live, livein, _uses)
+            if live != livein[pc]:
+                livein[pc] = live
+                changed = True
+    return livein
+
+def _live_before(op, live, livein, uses=uses):
+    # the variables that are live before op, if live are the variables that
+    # are live after it. can mutate live
+    if isinstance(op, parse.Goto):
+        return set(livein[op.target])
+    if isinstance(op, parse.ConditionalJump):
+        live.update(livein[op.target])
+    elif op.end_of_block:
+        live = set()
+    name = defines(op)
+    if name is not None:
+        live.discard(name)
+    live.update(uses(op))
+    return live
+
+
+def remove_dead_code(blocks):
+    """ Remove assignments to local variables that are never read, and the
+    declarations of local variables that are not used at all. Declarations of
+    variables that are written before they are read get need_default_init
+    set to False. """
+    while 1:
+        blocks, changed = _remove_dead_stores(blocks)
+        if not changed:
+            break
+    return _remove_unused_declarations(blocks)
+
+def _remove_dead_stores(blocks):
+    locals = declared_locals(blocks)
+    livein = compute_liveness(blocks)
+    changed = False
+    res = {}
+    for pc, block in blocks.iteritems():
+        newblock = []
+        # walk the block backwards
+        live = set()
+        for op in reversed(block):
+            name = defines(op)
+            if (name is not None and name in locals and
+                    name not in live and not op.end_of_block):
+                if isinstance(op, parse.Assignment):
+                    changed = True
+                    continue
+                if isinstance(op, parse.LocalVarDeclaration) and (
+                        op.value is not None or op.need_default_init):
+                    changed = op.value is not None or changed
+                    op = parse.LocalVarDeclaration(op.name, op.typ)
+                    op.need_default_init = False
+            live = _live_before(op, live, livein)
+            newblock.append(op)
+        newblock.reverse()
+        res[pc] = newblock
+    return res, changed
+
+def _remove_unused_declarations(blocks):
+    used = set()
+    for block in blocks.itervalues():
+        for op in block:
+            if not isinstance(op, parse.LocalVarDeclaration):
+                used.update(uses(op))
+                used.add(defines(op))
+            elif op.value is not None:
+                used.update(uses(op))
+    res = {}
+    for pc, block in blocks.iteritems():
+        res[pc] = [op for op in block
+                       if not isinstance(op, parse.LocalVarDeclaration) or
+                          op.name in used]
+    return res
+
+# ____________________________________________________________
+# constant folding, constant and copy propagation
+
+CONSTANT_NAMES = ("true", "false", "bitzero", "bitone")
+
+# functions in supportcode without side effects, that can be evaluated at
+# compile time if all their arguments are constants
+PURE_FUNCTIONS = ("supportcode.not_", "supportcode.eq_bit",
+                  "supportcode.eq_bool")
+
+def is_constant(expr):
+    return isinstance(expr, (parse.Number, parse.BitVectorConstant)) or (
+        isinstance(expr, parse.Var) and expr.name in CONSTANT_NAMES)
+
+
+# types whose values are never mutated in place, so a copy of a variable of
+# one of these types can be replaced by the original variable
+COPYABLE_TYPES = (types.FixedBitVector, types.SmallBitVector,
+                  types.GenericBitVector, types.MachineInt, types.Int,
+                  types.Bool, types.Bit, types.Unit, types.String, types.Enum)
+
+def propagate_values(blocks, codegen, startpc=0):
+    """ Replace reads of local variables that are known to contain a constant
+    or a copy of another local variable by the constant or the other variable,
+    and evaluate operations and conditions whose arguments are all constants.
+    The operations are evaluated by running the code that the code generator
+    would emit for them. codegen must be in the scope of the function. """
+    locals = declared_locals(blocks)
+    # only the values of variables that are live at the start of a block need
+    # to be passed along to it, which keeps the states small
+    livein = compute_liveness(blocks)
+    # forward dataflow analysis, entrystates are dicts {name: constant or
+    # Var of the copied variable}
+    entrystates = {startpc: {}}
+    todo = [startpc]
+    while todo:
+        pc = todo.pop()
+        for target, state in _fold_block(blocks[pc], entrystates[pc], locals, codegen)[1]:
+            state = {name: value for name, value in state.iteritems()
+                         if name in livein[target]}
+            oldstate = entrystates.get(target)
+            if oldstate is None:
+                newstate = state
+            else:
+                newstate = {name: value for name, value in oldstate.iteritems()
+                                if state.get(name) == value}
+                if len(newstate) == len(oldstate):
+                    continue
+            entrystates[target] = newstate
+            if target not in todo:
+                todo.append(target)
+    res = {}
+    for pc, block in blocks.iteritems():
+        if pc in entrystates:
+            res[pc] = _fold_block(block, entrystates[pc], locals, codegen)[0]
+        else:
+            res[pc] = block # unreachable
+    return res
+
+def _fold_block(block, state, locals, codegen):
+    # returns the new block and a list of (target, state) for all the
+    # outgoing edges
+    state = state.copy()
+    copies = {} # name -> names of the variables that might be copies of it
+    for key, value in state.iteritems():
+        if isinstance(value, parse.Var):
+            copies.setdefault(value.name, []).append(key)
+    newblock = []
+    exits = []
+    for op in block:
+        op = _substitute(op, state, codegen)
+        name = defines(op)
+        if name is not None:
+            _kill(state, copies, name)
+        if isinstance(op, parse.ConditionalJump):
+            value = _evaluate(op.condition, codegen)
+            if value is True:
+                op = parse.Goto(op.target)
+            elif value is False:
+                continue
+            else:
+                exits.append((op.target, state.copy()))
+        elif isinstance(op, (parse.Operation, parse.TemplatedOperation)):
+            value = _evaluate_operation(op, codegen)
+            if value is not None:
+                op = parse.Assignment(op.result, value)
+        if name in locals and isinstance(op, (parse.Assignment, parse.LocalVarDeclaration)):
+            value = op.value
+            if value is not None and is_constant(value):
+                state[name] = value
+            elif value is not None and _is_copy(value, name, codegen):
+                state[name] = value
+                copies.setdefault(value.name, []).append(name)
+        newblock.append(op)
+        if isinstance(op, parse.Goto):
+            exits.append((op.target, state))
+            break
+        if op.end_of_block:
+            break
+    return newblock, exits
+
+def _kill(state, copies, name):
+    # name is written to, forget its value and the copies of it
+    state.pop(name, None)
+    for key in copies.pop(name, []):
+        value = state.get(key)
+        if isinstance(value, parse.Var) and value.name == name:
+            del state[key]
+
+def _is_copy(value, name, codegen):
+    if not isinstance(value, parse.Var) or value.name == name:
+        return False
+    if codegen.localnames is None or value.name not in codegen.localnames:
+        return False # globals can be changed by calls
+    typ = codegen.gettyp(value.name)
+    return isinstance(typ, COPYABLE_TYPES) and typ is codegen.gettyp(name)
+
+def _substitute(ast, state, codegen):
+    # return a copy of ast, where the variables in state are replaced by
+    # their constant values
+    if isinstance(ast, parse.Var):
+        value = state.get(ast.name)
+        if value is not None and value.gettyp(codegen) is codegen.gettyp(ast.name):
+            return value
+        return ast
+    if not state or isinstance(ast, parse.Type):
+        return ast
+    newdict = {}
+    changed = False
+    for key, value in ast.__dict__.iteritems():
+        if isinstance(value, parse.BaseAst):
+            newvalue = _substitute(value, state, codegen)
+            changed = changed or newvalue is not value
+        elif isinstance(value, list):
+            newvalue = []
+            for item in value:
+                if isinstance(item, parse.BaseAst):
+                    newitem = _substitute(item, state, codegen)
+                    changed = changed or newitem is not item
+                    item = newitem
+                newvalue.append(item)
+        else:
+            newvalue = value
+        newdict[key] = newvalue
+    if not changed:
+        return ast
+    res = object.__new__(type(ast))
+    res.__dict__.update(newdict)
+    return res
+
+def _evaluate_operation(op, codegen):
+    # returns a constant expression or None
+    if not op.args or not all(is_constant(arg) for arg in op.args):
+        return None
+    name = op.name
+    restyp = codegen.gettyp(op.result)
+    if name in codegen.globalnames:
+        pyname = codegen.globalnames[name].pyname
+        if pyname == "supportcode.eq_anything":
+            name = "@eq"
+        elif pyname in PURE_FUNCTIONS and not isinstance(op, parse.TemplatedOperation):
+            code = "%s(%s)" % (pyname, ", ".join(arg.to_code(codegen) for arg in op.args))
+            return _make_constant(_eval(code), restyp)
+    if not name.startswith("@"):
+        return None
+    argtyp = op.args[0].gettyp(codegen)
+    if isinstance(op, parse.TemplatedOperation):
+        meth = getattr(argtyp, "make_op_code_templated_" + name[1:], None)
+        args = (op, codegen)
+    else:
+        meth = getattr(argtyp, "make_op_code_special_" + name[1:], None)
+        args = (op, [arg.to_code(codegen) for arg in op.args],
+                [arg.gettyp(codegen) for arg in op.args])
+    if meth is None:
+        return None
+    try:
+        value = _eval(meth(*args))
+    except Exception:
+        return None
+    return _make_constant(value, restyp)
+
+def _evaluate(condition, codegen):
+    # returns True, False or None if the condition is not constant
+    if isinstance(condition, parse.ExprCondition):
+        if not is_constant(condition.expr):
+            return None
+    elif isinstance(condition, parse.Comparison):
+        if not condition.operation.startswith("@") or not all(
+                is_constant(arg) for arg in condition.args):
+            return None
+    else:
+        return None
+    try:
+        value = _eval(condition.to_code(codegen))
+    except Exception:
+        return None
+    if isinstance(value, bool):
+        return value
+    return None
+
+def _eval(expr):
+    from rpython.rlib.rarithmetic import r_uint, intmask
+    from pydrofoil import supportcode, bitvector
+    return eval(expr, {"r_uint": r_uint, "intmask": intmask,
+                       "supportcode": supportcode, "bitvector": bitvector})
+
+def _make_constant(value, typ):
+    from rpython.rlib.rarithmetic import r_uint
+    if isinstance(typ, types.FixedBitVector):
+        if not isinstance(value, r_uint) or value >> typ.width:
+            return None
+        if typ.width % 4 == 0:
+            return parse.BitVectorConstant("0x%0*x" % (typ.width // 4, value))
+        return parse.BitVectorConstant("0b" + bin(value)[2:].rjust(typ.width, "0"))
+    if isinstance(typ, types.MachineInt):
+        if not isinstance(value, int) or isinstance(value, bool):
+            return None
+        return parse.Number(value)
+    if isinstance(typ, types.Bool):
+        if not isinstance(value, bool):
+            return None
+        return parse.Var("true" if value else "false")
+    if isinstance(typ, types.Bit):
+        if not isinstance(value, r_uint) or value > 1:
+            return None
+        return parse.Var("bitone" if value else "bitzero")
+    return None
+
+# ____________________________________________________________
+# temporary coalescing
+
+# supportcode functions that have fast paths for bitvectors of a width known
+# statically, with the positions of their bitvector arguments. see
+# unbox_bitvectors and operations.py
+UNBOXABLE_FUNCTIONS = {
+    "supportcode.eq_bits": (0, 1),
+    "supportcode.xor_bits": (0, 1),
+    "supportcode.and_bits": (0, 1),
+    "supportcode.or_bits": (0, 1),
+    "supportcode.not_bits": (0, ),
+    "supportcode.shiftl": (0, ),
+    "supportcode.shiftr": (0, ),
+    "supportcode.vector_access": (0, ),
+    "supportcode.vector_update": (0, ),
+    "supportcode.vector_subrange": (0, ),
+    "supportcode.vector_update_subrange": (0, 3),
+    "supportcode.add_int": (0, 1),
+    "supportcode.sub_int": (0, 1),
+    "supportcode.mult_int": (0, 1),
+    "supportcode.tdiv_int": (0, 1),
+    "supportcode.tmod_int": (0, 1),
+    "supportcode.eq_int": (0, 1),
+    "supportcode.lt": (0, 1),
+    "supportcode.lteq": (0, 1),
+    "supportcode.gt": (0, 1),
+    "supportcode.gteq": (0, 1),
+    "supportcode.max_int": (0, 1),
+    "supportcode.min_int": (0, 1),
+    "supportcode.sail_unsigned": (0, ),
+    "supportcode.sail_signed": (0, ),
+}
+
+# the functions of UNBOXABLE_FUNCTIONS that return an Int
+INT_ARITHMETIC_FUNCTIONS = set([
+    "supportcode.add_int", "supportcode.sub_int", "supportcode.mult_int",
+    "supportcode.tdiv_int", "supportcode.tmod_int"])
+
+def unbox_bitvectors(blocks, codegen):
+    """ Compute the calls of the functions in UNBOXABLE_FUNCTIONS on r_uints
+    if all their %bv arguments are known to be boxed from fixed-width
+    bitvectors earlier in the same block. The arguments are replaced by the
+    fixed-width bitvectors, and %i arguments by constants where known. If the
+    result is a %bv with a width known statically, it is computed into a new
+    fixed-width local and only boxed into the %bv afterwards. The same is
+    done for the Int functions, if all their arguments are constants or %i
+    boxed from %i64 (machine ints): they are computed on machine ints with an
+    overflow check. The boxings are dead if they don't escape, conversions of
+    them back to fixed-width bitvectors or machine ints (also by storing them
+    into struct fields) are replaced by the unboxed values. codegen must be
+    in the scope of the function. """
+    res = {}
+    count = 0
+    for pc, block in blocks.iteritems():
+        # %bv variable -> fixed-width expression it was boxed from, and %i
+        # variable -> Number it was set to
+        boxed = {}
+        newblock = []
+        for op in block:
+            positions = _unboxable_positions(op, codegen)
+            if positions is not None and all(
+                    isinstance(op.args[i], parse.Number) or
+                    isinstance(op.args[i], parse.Var) and
+                    op.args[i].name in boxed for i in positions):
+                args = op.args[:]
+                for i, arg in enumerate(args):
+                    if isinstance(arg, parse.Var) and arg.name in boxed:
+                        args[i] = boxed[arg.name]
+                op = parse.Operation(op.result, op.name, args)
+                width = _unboxed_width(op, codegen)
+                if (width is not None and op.result in codegen.localnames and
+                        isinstance(codegen.gettyp(op.result), types.GenericBitVector)):
+                    name = "%s_unboxed%s" % (op.result, count)
+                    count += 1
+                    codegen.add_local(name, name, types.FixedBitVector(width), None)
+                    newblock.append(parse.LocalVarDeclaration(
+                        name, parse.NamedType("%%bv%s" % (width, ))))
+                    newblock.append(parse.Operation(name, op.name, args))
+                    op = parse.Assignment(op.result, parse.Var(name))
+            elif (isinstance(op, parse.Assignment) and
+                    isinstance(op.value, parse.Var) and op.value.name in boxed and
+                    op.result in codegen.localnames and
+                    codegen.gettyp(op.result) is boxed[op.value.name].gettyp(codegen)):
+                op = parse.Assignment(op.result, boxed[op.value.name])
+            elif (isinstance(op, parse.StructElementAssignment) and
+                    isinstance(op.value, parse.Var) and op.value.name in boxed and
+                    codegen.gettyp(op.obj).fieldtyps[op.field] is
+                        boxed[op.value.name].gettyp(codegen)):
+                op = parse.StructElementAssignment(
+                    op.obj, op.field, boxed[op.value.name])
+            name = defines(op)
+            if name is not None:
+                boxed.pop(name, None)
+                for key, value in boxed.items():
+                    if value == parse.Var(name):
+                        del boxed[key]
+                source = _boxed_source(op, codegen)
+                if source is not None:
+                    boxed[name] = source
+            newblock.append(op)
+        res[pc] = newblock
+    return res
+
+def _unboxable_positions(op, codegen):
+    if not isinstance(op, parse.Operation) or op.name not in codegen.globalnames:
+        return None
+    return UNBOXABLE_FUNCTIONS.get(codegen.globalnames[op.name].pyname, None)
+
+def _unboxed_width(op, codegen):
+    # the width of the bitvector that an unboxed call returns, if known
+    funcname = codegen.globalnames[op.name].pyname
+    if funcname in ("supportcode.eq_bits", "supportcode.vector_access"):
+        return None
+    if not isinstance(op.args[0].gettyp(codegen), types.FixedBitVector):
+        return None # Int functions
+    if funcname == "supportcode.vector_subrange":
+        n, m = op.args[1:]
+        if isinstance(n, parse.Number) and isinstance(m, parse.Number):
+            return n.number - m.number + 1
+        return None
+    return op.args[0].gettyp(codegen).width
+
+def _boxed_source(op, codegen):
+    if not isinstance(op, (parse.LocalVarDeclaration, parse.Assignment)):
+        return None
+    name = defines(op)
+    value = op.value
+    if value is None or name not in codegen.localnames:
+        return None
+    typ = codegen.gettyp(name)
+    if isinstance(typ, types.Int):
+        if isinstance(value, parse.Number):
+            return value
+        if (isinstance(value, parse.Var) and value.name in codegen.localnames and
+                isinstance(codegen.gettyp(value.name), types.MachineInt)):
+            return value
+        return None
+    if not isinstance(typ, types.GenericBitVector):
+        return None
+    if isinstance(value, parse.BitVectorConstant):
+        return value
+    if (isinstance(value, parse.Var) and value.name in codegen.localnames and
+            isinstance(codegen.gettyp(value.name), types.FixedBitVector)):
+        return value
+    return None
+
+def coalesce_temporaries(blocks, codegen):
+    """ Rewrite 'tmp = <operation>; x = tmp' into 'x = <operation>' if tmp is
+    a local variable that is not read afterwards and has the same type as x.
+    An Int tmp can also be coalesced into a machine int x if the operation is
+    Int arithmetic on machine ints, that is then computed on machine ints
+    directly (overflowing raises OverflowError, like converting tmp would).
+    A declaration of x without a value between the two is moved before the
+    operation. codegen must be in the scope of the function. """
+    locals = declared_locals(blocks)
+    livein = compute_liveness(blocks)
+    res = {}
+    for pc, block in blocks.iteritems():
+        liveafter = [None] * len(block)
+        live = set()
+        for i in range(len(block) - 1, -1, -1):
+            liveafter[i] = live
+            live = _live_before(block[i], set(live), livein)
+        newblock = []
+        for i, op in enumerate(block):
+            if (newblock and isinstance(op, parse.Assignment) and
+                    isinstance(op.value, parse.Var) and
+                    op.result in locals and op.value.name in locals):
+                prev = newblock[-1]
+                decl = None
+                if (isinstance(prev, parse.LocalVarDeclaration) and
+                        prev.name == op.result and prev.value is None and
+                        len(newblock) > 1):
+                    decl = prev
+                    prev = newblock[-2]
+                tmp = op.value.name
+                if (isinstance(prev, (parse.Operation, parse.TemplatedOperation,
+                                      parse.Assignment)) and
+                        prev.result == tmp != op.result and
+                        op.result not in uses(prev) and
+                        tmp not in liveafter[i] and
+                        (isinstance(codegen.gettyp(tmp), COPYABLE_TYPES) and
+                         codegen.gettyp(tmp) is codegen.gettyp(op.result) or
+                         _is_unboxed_int_arithmetic(prev, codegen) and
+                         isinstance(codegen.gettyp(op.result), types.MachineInt))):
+                    newop = object.__new__(type(prev))
+                    newop.__dict__.update(prev.__dict__)
+                    newop.result = op.result
+                    if decl is None:
+                        newblock[-1] = newop
+                    else:
+                        newblock[-2:] = [decl, newop]
+                    continue
+            newblock.append(op)
+        res[pc] = newblock
+    return res
+
+
+def _is_unboxed_int_arithmetic(op, codegen):
+    if (_unboxable_positions(op, codegen) is None or
+            codegen.globalnames[op.name].pyname not in INT_ARITHMETIC_FUNCTIONS):
+        return False
+    return all(isinstance(arg.gettyp(codegen), types.MachineInt)
+               for arg in op.args)
+
+
+MININT = -2 ** 63
+MAXINT = 2 ** 63 - 1
+
+# the Int functions of UNBOXABLE_FUNCTIONS that compute on machine ints if all
+# their arguments are machine ints
+MACHINE_INT_FUNCTIONS = INT_ARITHMETIC_FUNCTIONS | set([
+    "supportcode.eq_int", "supportcode.lt", "supportcode.lteq",
+    "supportcode.gt", "supportcode.gteq", "supportcode.max_int",
+    "supportcode.min_int"])
+
+def narrow_int_locals(blocks, codegen):
+    """ Value-range analysis of the %i locals of a function. The range of a
+    local is the union of the ranges of all the values that are assigned to
+    it: constants, machine ints, Int arithmetic on them and sail_unsigned and
+    sail_signed of fixed-width bitvectors. The locals whose range fits into a
+    machine int are retyped to %i64, if they are only read where machine ints
+    are accepted directly (Int arithmetic and comparisons on machine ints,
+    assignments to other machine ints, the bitvector functions computed on
+    r_uints). Then they are never boxed into Integers. Counts the %i locals
+    and the narrowed ones in codegen. codegen must be in the scope of the
+    function. """
+    ints = {}
+    for block in blocks.itervalues():
+        for op in block:
+            if (isinstance(op, parse.LocalVarDeclaration) and
+                    op.name in codegen.localnames and
+                    isinstance(codegen.gettyp(op.name), types.Int)):
+                ints[op.name] = op
+    if not ints:
+        return blocks
+    codegen.int_locals += len(ints)
+    ranges = _int_ranges(blocks, ints, codegen)
+    narrowed = set([name for name, (lo, hi) in ranges.iteritems()
+                    if lo is not None and MININT <= lo and hi <= MAXINT])
+    changed = True
+    while changed:
+        changed = False
+        for block in blocks.itervalues():
+            for op in block:
+                boxed = _needs_integers(op, narrowed, codegen)
+                if boxed:
+                    narrowed.difference_update(boxed)
+                    changed = True
+    if not narrowed:
+        return blocks
+    codegen.narrowed_int_locals += len(narrowed)
+    res = {}
+    for pc, block in blocks.iteritems():
+        newblock = []
+        for op in block:
+            if isinstance(op, parse.LocalVarDeclaration) and op.name in narrowed:
+                op = parse.LocalVarDeclaration(
+                    op.name, parse.NamedType("%i64"), op.value)
+                codegen.add_local(op.name, op.name, types.MachineInt(), op)
+            newblock.append(op)
+        res[pc] = newblock
+    return res
+
+# the range of a local that nothing is assigned to yet
+_EMPTY = (MAXINT + 1, MININT - 1)
+# the range of a value that isn't known to be bounded
+_UNBOUNDED = (None, None)
+# a local whose range grew this often is assumed to be unbounded (loops)
+_MAX_RANGE_CHANGES = 4
+
+def _int_ranges(blocks, ints, codegen):
+    # return a dictionary local -> (lo, hi) with the ranges of the locals in
+    # ints, (None, None) if a local is not bounded
+    ranges = {name: _EMPTY for name in ints}
+    numchanges = {name: 0 for name in ints}
+    changed = True
+    while changed:
+        changed = False
+        for block in blocks.itervalues():
+            for op in block:
+                name = defines(op)
+                if name not in ints:
+                    continue
+                if isinstance(op, (parse.LocalVarDeclaration, parse.Assignment)):
+                    if op.value is None:
+                        continue
+                    valuerange = _value_range(op.value, ranges, codegen)
+                else:
+                    valuerange = _operation_range(op, ranges, codegen)
+                oldrange = ranges[name]
+                newrange = _union(oldrange, valuerange)
+                if newrange != oldrange:
+                    numchanges[name] += 1
+                    if numchanges[name] > _MAX_RANGE_CHANGES:
+                        newrange = _UNBOUNDED
+                    ranges[name] = newrange
+                    changed = True
+    return ranges
+
+def _union((lo1, hi1), (lo2, hi2)):
+    if lo1 is None or lo2 is None:
+        return _UNBOUNDED
+    return (min(lo1, lo2), max(hi1, hi2))
+
+def _value_range(value, ranges, codegen):
+    if isinstance(value, parse.Number):
+        return (value.number, value.number)
+    if isinstance(value, parse.Var):
+        if value.name in ranges:
+            return ranges[value.name]
+        if isinstance(value.gettyp(codegen), types.MachineInt):
+            return (MININT, MAXINT)
+    return _UNBOUNDED
+
+def _operation_range(op, ranges, codegen):
+    if _unboxable_positions(op, codegen) is None:
+        return _UNBOUNDED
+    funcname = codegen.globalnames[op.name].pyname
+    if funcname in ("supportcode.sail_unsigned", "supportcode.sail_signed"):
+        typ = op.args[0].gettyp(codegen)
+        if not isinstance(typ, types.FixedBitVector):
+            return _UNBOUNDED
+        if funcname == "supportcode.sail_unsigned":
+            return (0, 2 ** typ.width - 1)
+        return (-2 ** (typ.width - 1), 2 ** (typ.width - 1) - 1)
+    if funcname not in MACHINE_INT_FUNCTIONS:
+        return _UNBOUNDED
+    argranges = [_value_range(arg, ranges, codegen) for arg in op.args]
+    for lo, hi in argranges:
+        if lo is None:
+            return _UNBOUNDED
+        if lo > hi:
+            return _EMPTY # an argument has no value yet
+    (lo1, hi1), (lo2, hi2) = argranges
+    if funcname == "supportcode.add_int":
+        return (lo1 + lo2, hi1 + hi2)
+    if funcname == "supportcode.sub_int":
+        return (lo1 - hi2, hi1 - lo2)
+    if funcname == "supportcode.mult_int":
+        products = [lo1 * lo2, lo1 * hi2, hi1 * lo2, hi1 * hi2]
+        return (min(products), max(products))
+    if funcname == "supportcode.tdiv_int":
+        # rounds towards zero, so the result is not bigger than the dividend
+        m = max(abs(lo1), abs(hi1))
+        return (-m, m)
+    if funcname == "supportcode.tmod_int":
+        m = max(abs(lo2), abs(hi2), 1)
+        return (-(m - 1), m - 1)
+    if funcname == "supportcode.max_int":
+        return (max(lo1, lo2), max(hi1, hi2))
+    if funcname == "supportcode.min_int":
+        return (min(lo1, lo2), min(hi1, hi2))
+    return _UNBOUNDED # comparisons
+
+def _needs_integers(op, narrowed, codegen):
+    # return the narrowed locals that op needs as Integers
+    used = uses(op) & narrowed
+    result = defines(op)
+    if isinstance(op, (parse.LocalVarDeclaration, parse.Assignment)):
+        # converted to the type of the result
+        if (result in narrowed or result in codegen.localnames and
+                isinstance(codegen.gettyp(result), types.MachineInt)):
+            return set()
+        return used
+    if isinstance(op, parse.Operation) and _unboxable_positions(op, codegen) is not None:
+        funcname = codegen.globalnames[op.name].pyname
+        if funcname not in MACHINE_INT_FUNCTIONS:
+            if isinstance(op.args[0].gettyp(codegen), types.FixedBitVector):
+                # computed on r_uints, the %i arguments are machine ints
+                return set()
+            return used | (set([result]) & narrowed)
+        for arg in op.args:
+            if not (isinstance(arg, parse.Number) or
+                    isinstance(arg, parse.Var) and (
+                        arg.name in narrowed or
+                        isinstance(arg.gettyp(codegen), types.MachineInt))):
+                # computed on Integers
+                return used | (set([result]) & narrowed)
+        return set()
+    if result in narrowed:
+        used.add(result)
+    return used
+
@@ -1,68 +1,127 @@
-from rply import LexerGenerator, LexingError, ParserGenerator, ParsingError
-from rply.token import BaseBox
+import re
 
 from rpython.tool.pairtype import extendabletype
 
 # ____________________________________________________________
 # lexer
 
-lg = LexerGenerator()
-
-alltokens = []
-
-def addtok(name, regex):
-    alltokens.append(name)
-    lg.add(name, regex)
-
-def addkeyword(kw):
-    addtok(kw.upper(), kw)
-
-addkeyword('enum')
-addkeyword('union')
-addkeyword('struct')
-addkeyword('val')
-addkeyword('fn')
-addkeyword('end')
-addkeyword('arbitrary')
-addkeyword('failure')
-addkeyword('goto')
-addkeyword('jump')
-addkeyword('register')
-addkeyword('is')
-addkeyword('as')
-addkeyword('let')
-addkeyword('undefined')
-
-addtok('PERCENTENUM', r'%enum')
-addtok('PERCENTUNION', r'%union')
-addtok('PERCENTSTRUCT', r'%struct')
-addtok('PERCENTVEC', r'%vec')
-addtok('PERCENTLIST', r'%list')
-
-addtok('BINBITVECTOR', r'0b[01]+')
-addtok('HEXBITVECTOR', r'0x[0-9a-fA-F]+')
-addtok('NUMBER', r'-?\d+')
-addtok('NAME', r'[a-zA-Z_%@$][a-zA-Z_0-9]*')
-addtok('STRING', r'"[^"]*"')
-addtok('ARROW', r'->')
-addtok('BACKTICK', r'`')
-addtok('LPAREN', r'[(]')
-addtok('RPAREN', r'[)]')
-addtok('LBRACE', r'[{]')
-addtok('RBRACE', r'[}]')
-addtok('COMMA', r'[,]')
-addtok('COLON', r'[:]')
-addtok('EQUAL', r'[=]')
-addtok('SEMICOLON', r'[;]')
-addtok('LT', r'[<]')
-addtok('GT', r'[>]')
-addtok('DOT', r'[.]')
-addtok('AMPERSAND', r'[&]')
-addtok('STAR', r'[*]')
-
-lg.ignore(r'[ \n]')
-
-lexer = lg.build()
+class SourcePosition(object):
+    def __init__(self, idx, lineno, colno):
+        self.idx = idx
+        self.lineno = lineno
+        self.colno = colno
+
+    def __repr__(self):
+        return "SourcePosition(idx=%s, lineno=%s, colno=%s)" % (self.idx, self.lineno, self.colno)
+
+
+class LexingError(Exception):
+    def __init__(self, message, sourcepos):
+        Exception.__init__(self, message, sourcepos)
+        self.message = message
+        self.sourcepos = sourcepos
+
+    def getsourcepos(self):
+        return self.sourcepos
+
+class ParsingError(LexingError):
+    pass
+
+
+class Token(object):
+    def __init__(self, name, value, idx, lineno, colno):
+        self.name = name
+        self.value = value
+        self.idx = idx
+        self.lineno = lineno
+        self.colno = colno
+
+    def gettokentype(self):
+        return self.name
+
+    def getsourcepos(self):
+        return SourcePosition(self.idx, self.lineno, self.colno)
+
+    def __repr__(self):
+        return "Token(%r, %r)" % (self.name, self.value)
+
+
+keywords = {}
+for kw in ['enum', 'union', 'struct', 'val', 'fn', 'end', 'arbitrary',
+           'failure', 'goto', 'jump', 'register', 'is', 'as', 'let',
+           'undefined']:
+    keywords[kw] = kw.upper()
+keywords['%enum'] = 'PERCENTENUM'
+keywords['%union'] = 'PERCENTUNION'
+keywords['%struct'] = 'PERCENTSTRUCT'
+keywords['%vec'] = 'PERCENTVEC'
+keywords['%list'] = 'PERCENTLIST'
+
+punctuation = {
+    '`': 'BACKTICK',
+    '(': 'LPAREN',
+    ')': 'RPAREN',
+    '{': 'LBRACE',
+    '}': 'RBRACE',
+    ',': 'COMMA',
+    ':': 'COLON',
+    '=': 'EQUAL',
+    ';': 'SEMICOLON',
+    '<': 'LT',
+    '>': 'GT',
+    '.': 'DOT',
+    '&': 'AMPERSAND',
+    '*': 'STAR',
+}
+
+# a single regular expression for all tokens, the name of the group that
+# matched determines the kind of token
+token_re = re.compile(r"""
+    (?P<WHITESPACE>[ \t\r\n]+)
+  | (?P<BINBITVECTOR>0b[01]+)
+  | (?P<HEXBITVECTOR>0x[0-9a-fA-F]+)
+  | (?P<NUMBER>-?\d+)
+  | (?P<NAME>[a-zA-Z_%@$][a-zA-Z_0-9]*)
+  | (?P<STRING>"[^"]*")
+  | (?P<ARROW>->)
+  | (?P<PUNCTUATION>[`(){},:=;<>.&*])
+""", re.VERBOSE)
+
+
+class Lexer(object):
+    def lex(self, s):
+        """ Return an iterator over the tokens of s. The tokens are produced
+        lazily, the source is never turned into a list of tokens. """
+        return self._lex(s)
+
+    def _lex(self, s):
+        match = token_re.match
+        pos = 0
+        lineno = 1
+        linestart = 0
+        end = len(s)
+        while pos < end:
+            m = match(s, pos)
+            if m is None:
+                raise LexingError("unexpected character %r" % (s[pos], ),
+                                  SourcePosition(pos, lineno, pos - linestart + 1))
+            kind = m.lastgroup
+            value = m.group(kind)
+            if kind == "NAME":
+                yield Token(keywords.get(value, kind), value, pos, lineno, pos - linestart + 1)
+            elif kind == "PUNCTUATION":
+                yield Token(punctuation[value], value, pos, lineno, pos - linestart + 1)
+            elif kind != "WHITESPACE":
+                yield Token(kind, value, pos, lineno, pos - linestart + 1)
+            if kind == "WHITESPACE" or kind == "STRING":
+                # strings can contain newlines too
+                numlines = value.count("\n")
+                if numlines:
+                    lineno += numlines
+                    linestart = pos + value.rfind("\n") + 1
+            pos = m.end()
+
+lexer = Lexer()
 
 
 # ____________________________________________________________
@@ -78,7 +137,7 @@ class Visitor(object):
     def default_visit(self, ast):
         pass
 
-class BaseAst(BaseBox):
+class BaseAst(object):
     __metaclass__ = extendabletype
 
     def __eq__(self, other):
@@ -247,6 +306,8 @@ class Statement(BaseAst):
     end_of_block = False
 
 class LocalVarDeclaration(Statement):
+    need_default_init = True
+
     def __init__(self, name, typ, value=None):
         self.name = name
         self.typ = typ
@@ -368,242 +429,307 @@ class Undefined(Expression):
 # ____________________________________________________________
 # parser
 
-pg = ParserGenerator(alltokens)
-
-@pg.production('file : declaration | file declaration')
-def file(p):
-    if len(p) == 1:
-        return File(p)
-    return File(p[0].declarations + [p[1]])
-
-@pg.production('declaration : enum | union | struct | globalval | function | register | let')
-def declaration(p):
-    return p[0]
-
-@pg.production('enum : ENUM NAME LBRACE enumcontent RBRACE')
-def enum(p):
-    p[3].name = p[1].value
-    return p[3]
-
-@pg.production('enumcontent : NAME | NAME COMMA enumcontent')
-def enumcontent(p):
-    if len(p) == 1:
-        return Enum(None, [p[0].value])
-    else:
-        return Enum(None, [p[0].value] + p[2].names)
-
-@pg.production('union : UNION NAME LBRACE unioncontent RBRACE')
-def union(p):
-    return Union(p[1].value, p[3].names, p[3].types)
-
-@pg.production('struct : STRUCT NAME LBRACE unioncontent RBRACE')
-def struct(p):
-    return Struct(p[1].value, p[3].names, p[3].types)
-
-@pg.production('unioncontent : NAME COLON type | NAME COLON type COMMA unioncontent')
-def unioncontent(p):
-    if len(p) == 3:
-        return Union(None, [p[0].value], [p[2]])
-    else:
-        return Union(None, [p[0].value] + p[4].names, [p[2]] + p[4].types)
-
-@pg.production('globalval : VAL NAME COLON type | VAL NAME EQUAL STRING COLON type')
-def globalval(p):
-    if len(p) == 4:
-        return GlobalVal(p[1].value, None, p[3])
-    else:
-        return GlobalVal(p[1].value, p[3].value, p[5])
-
-@pg.production('function : FN NAME LPAREN args RPAREN LBRACE operations RBRACE')
-def function(p):
-    return Function(p[1].value, p[3].args, p[6].body)
-
-@pg.production('args : NAME | NAME COMMA args')
-def args(p):
-    if len(p) == 1:
-        return Function(None, [p[0].value], None)
-    else:
-        return Function(None, [p[0].value] + p[2].args, None)
-
-@pg.production('register : REGISTER NAME COLON type')
-def register(p):
-    return Register(p[1].value, p[3])
-
-@pg.production('let : LET LPAREN NAME COLON type RPAREN LBRACE operations RBRACE')
-def let(p):
-    return Let(p[2].value, p[4], p[7].body)
-
-@pg.production('operations : operation SEMICOLON | operation SEMICOLON operations')
-def operations(p):
-    if len(p) == 2:
-        return Function(None, None, [p[0]])
-    else:
-        return Function(None, None, [p[0]] + p[2].body)
-
-# operations
-
-@pg.production('operation : localvardeclaration | op | templatedop | conditionaljump | goto | assignment | end | failure | arbitrary')
-def operation(p):
-    return p[0]
-
-@pg.production('localvardeclaration : NAME COLON type | NAME COLON type EQUAL expr')
-def localvardeclaration(p):
-    if len(p) == 3:
-        return LocalVarDeclaration(p[0].value, p[2])
-    return LocalVarDeclaration(p[0].value, p[2], p[4])
-
-
-@pg.production('op : NAME EQUAL NAME LPAREN opargs RPAREN')
-def op(p):
-    return Operation(p[0].value, p[2].value, p[4].args)
-
-@pg.production('templatedop : NAME EQUAL NAME COLON COLON LT expr GT LPAREN opargs RPAREN')
-def op(p):
-    return TemplatedOperation(p[0].value, p[2].value, p[6], p[9].args)
-
-@pg.production('opargs : expr | expr COMMA opargs')
-def opargs(p):
-    if len(p) == 1:
-        return Operation(None, None, [p[0]])
-    else:
-        return Operation(None, None, [p[0]] + p[2].args)
-
-@pg.production('expr : NAME | STRING | NUMBER | BINBITVECTOR | HEXBITVECTOR | UNDEFINED COLON type | expr DOT NAME | LPAREN RPAREN | expr AS NAME | AMPERSAND expr')
-def expr(p):
-    if len(p) == 1:
-        if p[0].gettokentype() == "NAME":
-            return Var(p[0].value)
-        if p[0].gettokentype() == "STRING":
-            return String(p[0].value)
-        elif p[0].gettokentype() == "BINBITVECTOR":
-            return BitVectorConstant(p[0].value)
-        elif p[0].gettokentype() == "HEXBITVECTOR":
-            return BitVectorConstant(p[0].value)
-        elif p[0].gettokentype() == "NUMBER":
-            return Number(int(p[0].value))
-    elif len(p) == 2:
-        if p[0].gettokentype() == "LPAREN":
-            return Unit()
-        elif p[0].gettokentype() == "AMPERSAND":
-            return RefOf(p[1])
-    elif len(p) == 3:
-        if p[1].gettokentype() == "COLON":
-            return Undefined(p[2])
-        elif p[1].gettokentype() == "DOT":
-            return FieldAccess(p[0], p[2].value)
-        elif p[1].gettokentype() == "AS":
-            return Cast(p[0], p[2].value)
-    assert 0
-
-@pg.production('conditionaljump : JUMP condition GOTO NUMBER BACKTICK STRING')
-def conditionaljump(p):
-    return ConditionalJump(p[1], int(p[3].value), p[5].value)
-
-@pg.production('condition : expr | NAME LPAREN opargs RPAREN | expr IS NAME ')
-def condition(p):
-    if len(p) == 1:
-        return ExprCondition(p[0])
-    if len(p) == 4:
-        return Comparison(p[0].value, p[2].args)
-    return UnionVariantCheck(p[0], p[2].value)
-
-@pg.production('goto : GOTO NUMBER')
-def op(p):
-    return Goto(int(p[1].value))
-
-@pg.production('assignment : NAME EQUAL expr | NAME STAR EQUAL expr | NAME DOT NUMBER EQUAL expr | NAME DOT NAME EQUAL expr')
-def op(p):
-    if len(p) == 3:
-        return Assignment(p[0].value, p[2])
-    if len(p) == 4:
-        return RefAssignment(p[0].value, p[3])
-    elif p[2].gettokentype() == "NUMBER":
-        return TupleElementAssignment(p[0].value, int(p[2].value), p[4])
-    else:
-        assert p[2].gettokentype() == "NAME"
-        return StructElementAssignment(p[0].value, p[2].value, p[4])
-
-
-@pg.production('end : END')
-def end(p):
-    return End()
-
-@pg.production('failure : FAILURE')
-def failure(p):
-    return Failure()
-
-@pg.production('arbitrary : ARBITRARY')
-def arbitrary(p):
-    return Arbitrary()
-
-
-
-# types
-
-@pg.production('type : simpletype  | functiontype')
-def typ(p):
-    return p[0]
-
-@pg.production('simpletype : namedtype | tupletype | enumtype | uniontype | structtype | reftype | vectype | listtype')
-def simpletype(p):
-    return p[0]
-
-@pg.production('namedtype : NAME')
-def namedtype(p):
-    return NamedType(p[0].value)
-
-@pg.production('tupletype : LPAREN tupletypecontent RPAREN')
-def tupletype(p):
-    return p[1]
-
-@pg.production('tupletypecontent : type | type COMMA tupletypecontent')
-def tupletypecontent(p):
-    if len(p) == 1:
-        return TupleType([p[0]])
-    else:
-        return TupleType([p[0]] + p[2].elements)
-
-@pg.production('enumtype : PERCENTENUM NAME')
-def enumtype(p):
-    return EnumType(p[1].value)
-
-@pg.production('uniontype : PERCENTUNION NAME')
-def uniontype(p):
-    return UnionType(p[1].value)
-
-@pg.production('structtype : PERCENTSTRUCT NAME')
-def structtype(p):
-    return StructType(p[1].value)
-
-@pg.production('listtype : PERCENTLIST type')
-def listtype(p):
-    return ListType(p[1])
-
-@pg.production('functiontype : simpletype ARROW simpletype')
-def functiontype(p):
-    return FunctionType(p[0], p[2])
-
-@pg.production('reftype : AMPERSAND LPAREN structtype RPAREN')
-def reftype(p):
-    return RefType(p[2])
-
-@pg.production('vectype : PERCENTVEC LPAREN simpletype RPAREN')
-def vectype(p):
-    return VecType(p[2])
-
-
-def print_conflicts():
-    if parser.lr_table.rr_conflicts:
-        print("rr conflicts")  
-    for rule_num, token, conflict in parser.lr_table.rr_conflicts:
-        print(rule_num, token, conflict)
+class Parser(object):
+    def parse(self, tokens):
+        return _Parser(iter(tokens)).parse_file()
+
+parser = Parser()
+
 
-    if parser.lr_table.sr_conflicts:
-        print("sr conflicts")
-    for rule_num, token, conflict in parser.lr_table.sr_conflicts:
-        print(rule_num, token, conflict)
-        
-parser = pg.build()
-print_conflicts()
+class _Parser(object):
+    """ A recursive descent parser for JIB. It needs just one token of
+    lookahead, self.tok, and pulls tokens from the lexer on demand. """
 
+    def __init__(self, tokens):
+        self.tokens = tokens
+        self.tok = None
+        self.next()
 
+    def next(self):
+        tok = self.tok
+        try:
+            self.tok = next(self.tokens)
+        except StopIteration:
+            if tok is None:
+                pos = SourcePosition(0, 1, 1)
+            else:
+                pos = tok.getsourcepos()
+            self.tok = Token("EOF", "", pos.idx, pos.lineno, pos.colno)
+        return tok
+
+    def error(self, expected=None):
+        tok = self.tok
+        if expected is None:
+            msg = "unexpected %s %r" % (tok.name, tok.value)
+        else:
+            msg = "expected %s, got %s %r" % (expected, tok.name, tok.value)
+        raise ParsingError(msg, tok.getsourcepos())
+
+    def expect(self, name):
+        if self.tok.name != name:
+            self.error(name)
+        return self.next()
+
+    def accept(self, name):
+        if self.tok.name == name:
+            return self.next()
+        return None
+
+    def expect_name(self):
+        return self.expect("NAME").value
+
+    # declarations
+
+    def parse_file(self):
+        declarations = [self.parse_declaration()]
+        while self.tok.name != "EOF":
+            declarations.append(self.parse_declaration())
+        return File(declarations)
+
+    def parse_declaration(self):
+        name = self.tok.name
+        if name == "ENUM":
+            return self.parse_enum()
+        if name == "UNION":
+            self.next()
+            name = self.expect_name()
+            names, types = self.parse_fields()
+            return Union(name, names, types)
+        if name == "STRUCT":
+            self.next()
+            name = self.expect_name()
+            names, types = self.parse_fields()
+            return Struct(name, names, types)
+        if name == "VAL":
+            return self.parse_globalval()
+        if name == "FN":
+            return self.parse_function()
+        if name == "REGISTER":
+            self.next()
+            name = self.expect_name()
+            self.expect("COLON")
+            return Register(name, self.parse_type())
+        if name == "LET":
+            return self.parse_let()
+        self.error("declaration")
+
+    def parse_enum(self):
+        self.expect("ENUM")
+        name = self.expect_name()
+        self.expect("LBRACE")
+        names = [self.expect_name()]
+        while self.accept("COMMA"):
+            names.append(self.expect_name())
+        self.expect("RBRACE")
+        return Enum(name, names)
+
+    def parse_fields(self):
+        self.expect("LBRACE")
+        names = []
+        types = []
+        while 1:
+            names.append(self.expect_name())
+            self.expect("COLON")
+            types.append(self.parse_type())
+            if not self.accept("COMMA"):
+                break
+        self.expect("RBRACE")
+        return names, types
+
+    def parse_globalval(self):
+        self.expect("VAL")
+        name = self.expect_name()
+        definition = None
+        if self.accept("EQUAL"):
+            definition = self.expect("STRING").value
+        self.expect("COLON")
+        return GlobalVal(name, definition, self.parse_type())
+
+    def parse_function(self):
+        self.expect("FN")
+        name = self.expect_name()
+        self.expect("LPAREN")
+        args = [self.expect_name()]
+        while self.accept("COMMA"):
+            args.append(self.expect_name())
+        self.expect("RPAREN")
+        return Function(name, args, self.parse_operations())
+
+    def parse_let(self):
+        self.expect("LET")
+        self.expect("LPAREN")
+        name = self.expect_name()
+        self.expect("COLON")
+        typ = self.parse_type()
+        self.expect("RPAREN")
+        return Let(name, typ, self.parse_operations())
+
+    def parse_operations(self):
+        self.expect("LBRACE")
+        operations = []
+        while 1:
+            operations.append(self.parse_operation())
+            self.expect("SEMICOLON")
+            if self.accept("RBRACE"):
+                return operations
+
+    # operations
+
+    def parse_operation(self):
+        name = self.tok.name
+        if name == "NAME":
+            return self.parse_name_operation()
+        if name == "JUMP":
+            self.next()
+            condition = self.parse_condition()
+            self.expect("GOTO")
+            target = int(self.expect("NUMBER").value)
+            self.expect("BACKTICK")
+            return ConditionalJump(condition, target, self.expect("STRING").value)
+        if name == "GOTO":
+            self.next()
+            return Goto(int(self.expect("NUMBER").value))
+        if name == "END":
+            self.next()
+            return End()
+        if name == "FAILURE":
+            self.next()
+            return Failure()
+        if name == "ARBITRARY":
+            self.next()
+            return Arbitrary()
+        self.error("operation")
+
+    def parse_name_operation(self):
+        # all the operations that start with a name
+        result = self.expect_name()
+        tokname = self.tok.name
+        if tokname == "COLON":
+            self.next()
+            typ = self.parse_type()
+            if self.accept("EQUAL"):
+                return LocalVarDeclaration(result, typ, self.parse_expr())
+            return LocalVarDeclaration(result, typ)
+        if tokname == "STAR":
+            self.next()
+            self.expect("EQUAL")
+            return RefAssignment(result, self.parse_expr())
+        if tokname == "DOT":
+            self.next()
+            if self.tok.name == "NUMBER":
+                index = int(self.next().value)
+                self.expect("EQUAL")
+                return TupleElementAssignment(result, index, self.parse_expr())
+            field = self.expect_name()
+            self.expect("EQUAL")
+            return StructElementAssignment(result, field, self.parse_expr())
+        self.expect("EQUAL")
+        if self.tok.name != "NAME":
+            return Assignment(result, self.parse_expr())
+        name = self.next().value
+        if self.accept("LPAREN"):
+            return Operation(result, name, self.parse_opargs())
+        if self.accept("COLON"):
+            self.expect("COLON")
+            self.expect("LT")
+            templateparam = self.parse_expr()
+            self.expect("GT")
+            self.expect("LPAREN")
+            return TemplatedOperation(result, name, templateparam, self.parse_opargs())
+        return Assignment(result, self.parse_expr_suffix(Var(name)))
+
+    def parse_opargs(self):
+        # the opening parenthesis has already been consumed
+        args = [self.parse_expr()]
+        while self.accept("COMMA"):
+            args.append(self.parse_expr())
+        self.expect("RPAREN")
+        return args
+
+    def parse_condition(self):
+        if self.tok.name == "NAME":
+            name = self.next().value
+            if self.accept("LPAREN"):
+                return Comparison(name, self.parse_opargs())
+            expr = self.parse_expr_suffix(Var(name))
+        else:
+            expr = self.parse_expr()
+        if self.accept("IS"):
+            return UnionVariantCheck(expr, self.expect_name())
+        return ExprCondition(expr)
+
+    # expressions
+
+    def parse_expr(self):
+        tok = self.next()
+        name = tok.name
+        if name == "NAME":
+            expr = Var(tok.value)
+        elif name == "NUMBER":
+            expr = Number(int(tok.value))
+        elif name == "BINBITVECTOR" or name == "HEXBITVECTOR":
+            expr = BitVectorConstant(tok.value)
+        elif name == "STRING":
+            expr = String(tok.value)
+        elif name == "UNDEFINED":
+            self.expect("COLON")
+            expr = Undefined(self.parse_type())
+        elif name == "LPAREN":
+            self.expect("RPAREN")
+            expr = Unit()
+        elif name == "AMPERSAND":
+            return RefOf(self.parse_expr())
+        else:
+            self.tok = tok # for the error message
+            self.error("expression")
+        return self.parse_expr_suffix(expr)
+
+    def parse_expr_suffix(self, expr):
+        while 1:
+            if self.accept("DOT"):
+                expr = FieldAccess(expr, self.expect_name())
+            elif self.accept("AS"):
+                expr = Cast(expr, self.expect_name())
+            else:
+                return expr
+
+    # types
+
+    def parse_type(self):
+        typ = self.parse_simpletype()
+        if self.accept("ARROW"):
+            return FunctionType(typ, self.parse_simpletype())
+        return typ
+
+    def parse_simpletype(self):
+        tok = self.next()
+        name = tok.name
+        if name == "NAME":
+            return NamedType(tok.value)
+        if name == "LPAREN":
+            elements = [self.parse_type()]
+            while self.accept("COMMA"):
+                elements.append(self.parse_type())
+            self.expect("RPAREN")
+            return TupleType(elements)
+        if name == "PERCENTENUM":
+            return EnumType(self.expect_name())
+        if name == "PERCENTUNION":
+            return UnionType(self.expect_name())
+        if name == "PERCENTSTRUCT":
+            return StructType(self.expect_name())
+        if name == "PERCENTLIST":
+            return ListType(self.parse_type())
+        if name == "AMPERSAND":
+            self.expect("LPAREN")
+            self.expect("PERCENTSTRUCT")
+            typ = RefType(StructType(self.expect_name()))
+            self.expect("RPAREN")
+            return typ
+        if name == "PERCENTVEC":
+            self.expect("LPAREN")
+            typ = VecType(self.parse_simpletype())
+            self.expect("RPAREN")
+            return typ
+        self.tok = tok # for the error message
+        self.error("type")
@@ -0,0 +1,103 @@
+""" Profiles of how often the fields of the Registers class of a generated
+model are read and written. They are collected by running the untranslated
+emulator and are used by parse_and_make_code to choose the registers that are
+promoted, quasi-immutable or part of the virtualizable.
+
+A profile file is a text file with a line "steps <number of steps>" followed
+by one line "<field> <reads> <writes>" per field. """
+
+# a register that is read at least this often per step is hot
+HOT_READS_PER_STEP = 1.0
+# a field that is accessed at least this often per step goes into the
+# virtualizable
+VIRTUALIZABLE_ACCESSES_PER_STEP = 0.5
+
+
+class RegisterProfile(object):
+    def __init__(self, steps=0, reads=None, writes=None):
+        self.steps = steps
+        self.reads = reads if reads is not None else {}
+        self.writes = writes if writes is not None else {}
+
+    def write(self, fn):
+        with open(fn, "w") as f:
+            f.write("steps %s\n" % (self.steps, ))
+            for field in sorted(set(self.reads) | set(self.writes)):
+                f.write("%s %s %s\n" % (field, self.reads.get(field, 0),
+                                        self.writes.get(field, 0)))
+
+    @staticmethod
+    def read(fn):
+        res = RegisterProfile()
+        with open(fn) as f:
+            for line in f:
+                parts = line.split()
+                if not parts:
+                    continue
+                if parts[0] == "steps":
+                    res.steps = int(parts[1])
+                    continue
+                field, reads, writes = parts
+                res.reads[field] = int(reads)
+                res.writes[field] = int(writes)
+        return res
+
+    def choose(self, registers, arrays=()):
+        """ Choose the registers to promote, the quasi-immutable registers and
+        the fields of the virtualizable, given the names of all the registers
+        and the names of the register arrays. Returns three sets.
+
+        - registers that are read on every step but never written to are
+          quasi-immutable
+        - registers that are read on every step and written at most half as
+          often as they are read are promoted (like the pc). counters, which
+          are read and written equally often, are not
+        - the fields that are accessed often and aren't (quasi-)immutable are
+          part of the virtualizable, arrays as 'name[*]'
+        """
+        steps = float(max(self.steps, 1))
+        promoted = set()
+        quasi_immutable = set()
+        virtualizable = set()
+        for field in set(self.reads) | set(self.writes):
+            if field not in registers and field not in arrays:
+                continue
+            reads = self.reads.get(field, 0)
+            writes = self.writes.get(field, 0)
+            if field in registers and reads / steps >= HOT_READS_PER_STEP:
+                if writes == 0:
+                    quasi_immutable.add(field)
+                    continue
+                if writes * 2 <= reads:
+                    promoted.add(field)
+            if (reads + writes) / steps >= VIRTUALIZABLE_ACCESSES_PER_STEP:
+                if field in arrays:
+                    virtualizable.add(field + "[*]")
+                else:
+                    virtualizable.add(field)
+        return promoted, quasi_immutable, virtualizable
+
+
+def start_profiling(module):
+    """ Replace the registers instance r of the generated module by one that
+    counts the reads and writes of every field. Returns the RegisterProfile
+    that is filled in, its steps need to be set by the caller. Only works
+    untranslated. """
+    profile = RegisterProfile()
+    reads = profile.reads
+    writes = profile.writes
+
+    class ProfilingRegisters(module.Registers):
+        def __getattribute__(self, name):
+            if not name.startswith("_"):
+                reads[name] = reads.get(name, 0) + 1
+            return object.__getattribute__(self, name)
+
+        def __setattr__(self, name, value):
+            writes[name] = writes.get(name, 0) + 1
+            object.__setattr__(self, name, value)
+
+    r = object.__new__(ProfilingRegisters)
+    r.__dict__.update(module.r.__dict__)
+    module.r = r
+    return profile
@@ -1,6 +1,6 @@
 from rpython.rlib import objectmodel
 from rpython.rlib.rbigint import rbigint
-from rpython.rlib.rarithmetic import r_uint, intmask
+from rpython.rlib.rarithmetic import r_uint, intmask, ovfcheck, int_c_div, int_c_mod
 from pydrofoil import bitvector
 from pydrofoil.bitvector import Integer
 
@@ -179,6 +179,67 @@ def tdiv_int(ia, ib):
 def tmod_int(ia, ib):
     return ia.tmod(ib)
 
+# the arithmetic on Ints that are known to be machine ints, see
+# optimize.unbox_bitvectors. the _i_i functions return an Integer, which is
+# only a BigInteger if the result overflows. the _toint functions are used if
+# the result is converted to a machine int right away, they raise
+# OverflowError on overflow, like Integer.toint would
+
+def add_i_i(a, b):
+    try:
+        return Integer.fromint(ovfcheck(a + b))
+    except OverflowError:
+        return Integer.fromint(a).add(Integer.fromint(b))
+
+def add_i_i_toint(a, b):
+    return ovfcheck(a + b)
+
+def sub_i_i(a, b):
+    try:
+        return Integer.fromint(ovfcheck(a - b))
+    except OverflowError:
+        return Integer.fromint(a).sub(Integer.fromint(b))
+
+def sub_i_i_toint(a, b):
+    return ovfcheck(a - b)
+
+def mult_i_i(a, b):
+    try:
+        return Integer.fromint(ovfcheck(a * b))
+    except OverflowError:
+        return Integer.fromint(a).mul(Integer.fromint(b))
+
+def mult_i_i_toint(a, b):
+    return ovfcheck(a * b)
+
+def tdiv_i_i(a, b):
+    if b == 0:
+        raise ZeroDivisionError
+    if a == -2**63 and b == -1:
+        return Integer.fromint(a).tdiv(Integer.fromint(b))
+    return Integer.fromint(int_c_div(a, b))
+
+def tdiv_i_i_toint(a, b):
+    if b == 0:
+        raise ZeroDivisionError
+    if a == -2**63 and b == -1:
+        raise OverflowError
+    return int_c_div(a, b)
+
+def tmod_i_i(a, b):
+    if b == 0:
+        raise ZeroDivisionError
+    if a == -2**63 and b == -1:
+        return Integer.fromint(0)
+    return Integer.fromint(int_c_mod(a, b))
+
+def tmod_i_i_toint(a, b):
+    if b == 0:
+        raise ZeroDivisionError
+    if a == -2**63 and b == -1:
+        return 0
+    return int_c_mod(a, b)
+
 def emod_int(ia, ib):
     a = ia.toint()
     b = ib.toint()
@@ -240,6 +301,9 @@ def sail_unsigned(gbv):
 def sail_signed(gbv):
     return gbv.signed()
 
+def append(bv1, bv2):
+    return bv1.append(bv2)
+
 def append_64(bv, v):
     return bv.append_64(v)
 
@@ -272,6 +336,44 @@ def vector_update_subrange(bv, n, m, s):
 def vector_subrange(bv, n, m):
     return bv.subrange(n.toint(), m.toint())
 
+# fast paths for bitvectors of at most 64 bits, working on r_uints. the code
+# generator uses them when the widths of the arguments are known statically,
+# see optimize.unbox_bitvectors and operations.py
+
+def ruint_mask(width, val):
+    if width == 64:
+        return val
+    assert width < 64
+    return val & ((r_uint(1) << width) - 1)
+
+def shiftl_fixed(width, val, i):
+    assert i >= 0
+    if i >= 64:
+        return r_uint(0)
+    return ruint_mask(width, val << i)
+
+def shiftr_fixed(val, i):
+    # safe_rshift is called with r_uint shifts by the bvaccess code too
+    assert i >= 0
+    return safe_rshift(val, r_uint(i))
+
+def vector_subrange_fixed(val, n, m):
+    assert m >= 0
+    return ruint_mask(n - m + 1, safe_rshift(val, r_uint(m)))
+
+def vector_update_subrange_fixed(width, val, n, m, s):
+    subwidth = n - m + 1
+    assert subwidth <= width
+    if subwidth == width:
+        return s
+    # subwidth cannot be 64 in the next line because of the if above
+    mask = ~(((r_uint(1) << subwidth) - 1) << m)
+    return ruint_mask(width, (val & mask) | (s << m))
+
+def vector_access_fixed(val, index):
+    assert 0 <= index < 64
+    return (val >> index) & 1
+
 
 def elf_tohost(_):
     return Integer.fromint(0)
@@ -0,0 +1,104 @@
+""" Microbenchmarks for the bitvector primitives of supportcode, running
+untranslated. Every primitive is run once the way the generated code called
+it before the bitvectors were unboxed (boxing the fixed-width arguments,
+calling the generic function, unboxing the result) and once with the fast
+path on r_uints that the generated code uses now. Reports the time and the
+number of allocated bitvector objects per operation.
+
+usage: python pydrofoil/test/benchbitvector.py [<number of iterations>]
+"""
+
+import os
+import sys
+import time
+
+thisdir = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(os.path.dirname(thisdir)))
+
+from rpython.rlib.rarithmetic import r_uint
+
+from pydrofoil import bitvector, supportcode
+from pydrofoil.bitvector import Integer
+
+box = bitvector.from_ruint
+a = r_uint(0x123456789abcdef0)
+b = r_uint(0xff00ff00ff00ff00)
+s = r_uint(0b1011)
+i5 = Integer.fromint(5)
+i8 = Integer.fromint(8)
+i11 = Integer.fromint(11)
+
+# name, boxed variant, unboxed variant
+primitives = [
+    ("xor_bits",
+     lambda: supportcode.xor_bits(box(64, a), box(64, b)).touint(),
+     lambda: a ^ b),
+    ("and_bits",
+     lambda: supportcode.and_bits(box(64, a), box(64, b)).touint(),
+     lambda: a & b),
+    ("not_bits",
+     lambda: supportcode.not_bits(box(32, a)).touint(),
+     lambda: (~a) & r_uint(0xffffffff)),
+    ("shiftl",
+     lambda: supportcode.shiftl(box(64, a), i5).touint(),
+     lambda: supportcode.shiftl_fixed(64, a, 5)),
+    ("shiftr",
+     lambda: supportcode.shiftr(box(64, a), i5).touint(),
+     lambda: supportcode.shiftr_fixed(a, 5)),
+    ("vector_access",
+     lambda: supportcode.vector_access(box(64, a), i5),
+     lambda: supportcode.vector_access_fixed(a, 5)),
+    ("vector_subrange",
+     lambda: supportcode.vector_subrange(box(64, a), i11, i8).touint(),
+     lambda: supportcode.vector_subrange_fixed(a, 11, 8)),
+    ("vector_update_subrange",
+     lambda: supportcode.vector_update_subrange(box(64, a), i11, i8, box(4, s)).touint(),
+     lambda: supportcode.vector_update_subrange_fixed(64, a, 11, 8, s)),
+]
+
+class AllocationCounter(object):
+    """ Counts the bitvector objects that are created while it is active. """
+    def __init__(self):
+        self.count = 0
+        self.classes = [bitvector.SmallBitVector, bitvector.GenericBitVector]
+
+    def __enter__(self):
+        self.inits = [cls.__dict__["__init__"] for cls in self.classes]
+        for cls, init in zip(self.classes, self.inits):
+            cls.__init__ = self._make_counting(init)
+        return self
+
+    def _make_counting(self, init):
+        def __init__(*args, **kwargs):
+            self.count += 1
+            init(*args, **kwargs)
+        return __init__
+
+    def __exit__(self, *args):
+        for cls, init in zip(self.classes, self.inits):
+            cls.__init__ = init
+
+def bench_one(func, iterations):
+    with AllocationCounter() as counter:
+        func()
+    allocations = counter.count
+    t1 = time.time()
+    for i in xrange(iterations):
+        func()
+    t2 = time.time()
+    return (t2 - t1) / iterations, allocations
+
+def main(argv):
+    iterations = int(argv[1]) if len(argv) > 1 else 100000
+    print "%-24s %12s %8s %12s %8s" % (
+        "primitive", "boxed", "allocs", "unboxed", "allocs")
+    for name, boxed, unboxed in primitives:
+        assert boxed() == unboxed()
+        tb, ab = bench_one(boxed, iterations)
+        tu, au = bench_one(unboxed, iterations)
+        print "%-24s %9.0f ns %8d %9.0f ns %8d   %.1fx" % (
+            name, tb * 1e9, ab, tu * 1e9, au, tb / tu)
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv))
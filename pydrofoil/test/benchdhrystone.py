@@ -0,0 +1,50 @@
+""" Benchmark for the generated RISC-V code running untranslated on top of
+the Python interpreter. Runs the first instructions of dhrystone, once with
+the functions emitted as structured ifs and loops and once with the
+`while 1: if pc == N` dispatch loop. Every variant runs in a separate
+process, since the generated module is imported.
+
+usage: python pydrofoil/test/benchdhrystone.py [<number of instructions>]
+"""
+
+import os
+import sys
+import time
+import subprocess
+
+thisdir = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(os.path.dirname(thisdir)))
+
+dhrystone = os.path.join(thisdir, "dhrystone.riscv")
+
+variants = [("pc loop", False), ("structured", True)]
+
+def bench_one(structured_control_flow, limit):
+    from pydrofoil.test.targetriscv import make_code
+    outriscv, supportcoderiscv = make_code(structured_control_flow)
+    main = supportcoderiscv.get_main()
+    t1 = time.time()
+    main(["bench", dhrystone, "--inst-limit", str(limit)])
+    t2 = time.time()
+    return t2 - t1
+
+def main(argv):
+    if len(argv) == 4 and argv[1] == "--single":
+        sys.setrecursionlimit(100000)
+        t = bench_one(argv[2] == "True", int(argv[3]))
+        print "RESULT", t
+        return 0
+    limit = int(argv[1]) if len(argv) > 1 else 20000
+    results = []
+    for name, structured_control_flow in variants:
+        out = subprocess.check_output([sys.executable, __file__, "--single",
+                                       str(structured_control_flow), str(limit)])
+        t = float(out.strip().splitlines()[-1].split()[1])
+        results.append((name, t))
+    for name, t in results:
+        print "%-12s %8.2f s %8.2f kips   %.2fx" % (
+            name, t, limit / 1000. / t, results[0][1] / t)
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv))
@@ -0,0 +1,57 @@
+""" Compares loading an image into a memory laid out like the one of the
+RISC-V model (a ROM region and a 64 MB RAM region in a SplitMemory) one byte
+at a time, which is what elf_read_process_image used to do, with the bulk
+write_bytes and fill. Runs untranslated.
+
+usage: python pydrofoil/test/benchload.py [<size in MB>]
+"""
+
+import os
+import sys
+import time
+
+thisdir = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(os.path.dirname(thisdir)))
+
+from rpython.rlib.rarithmetic import r_uint
+
+from pydrofoil import mem
+
+RAM_BASE = r_uint(0x80000000)
+RAM_SIZE = r_uint(0x4000000)
+
+def make_memory():
+    m = mem.SplitMemory()
+    rom = mem.FlatMemory(False)
+    m.add_region(r_uint(0), r_uint(rom.size), rom)
+    m.add_region(RAM_BASE, RAM_SIZE, mem.FlatMemory(False, RAM_SIZE))
+    return m
+
+def load_bytewise(m, data, bss):
+    for i in range(len(data)):
+        m.write(RAM_BASE + i, 1, r_uint(ord(data[i])))
+    for i in range(len(data), len(data) + bss):
+        m.write(RAM_BASE + i, 1, r_uint(0))
+
+def load_bulk(m, data, bss):
+    m.write_bytes(RAM_BASE, data)
+    m.fill(RAM_BASE + len(data), bss)
+
+def main(argv):
+    size = int(float(argv[1]) * 1024 * 1024) if len(argv) > 1 else 1024 * 1024
+    data = os.urandom(size)
+    bss = size // 4
+    print "loading %d bytes and filling %d bytes" % (size, bss)
+    results = {}
+    for name, load in [("bytewise", load_bytewise), ("bulk", load_bulk)]:
+        m = make_memory()
+        t1 = time.time()
+        load(m, data, bss)
+        t2 = time.time()
+        results[name] = t2 - t1
+        print "%-10s %10.3f s" % (name, t2 - t1)
+    print "speedup: %.1fx" % (results["bytewise"] / results["bulk"], )
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv))
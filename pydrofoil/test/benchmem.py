@@ -0,0 +1,78 @@
+""" Compares the memory implementations of mem.py, running untranslated: the
+resident set size after creating a 64 MB memory and after writing to a
+number of its pages, and the time of aligned 8 byte reads and writes to
+random addresses in a working set. Every memory is measured in a separate
+process, so that the RSS numbers don't influence each other.
+
+usage: python pydrofoil/test/benchmem.py [<pages written> [<accesses>]]
+"""
+
+import os
+import sys
+import time
+import random
+import subprocess
+
+thisdir = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(os.path.dirname(thisdir)))
+
+from rpython.rlib.rarithmetic import r_uint
+
+from pydrofoil import mem
+
+SIZE = 64 * 1024 * 1024
+PAGE_BYTES = 4096
+
+memories = {
+    "FlatMemory": lambda: mem.FlatMemory(False, SIZE),
+    "BlockMemory": mem.BlockMemory,
+    "SparseMemory": mem.SparseMemory,
+}
+
+def rss_kb():
+    with open("/proc/self/status") as f:
+        for line in f:
+            if line.startswith("VmRSS:"):
+                return int(line.split()[1])
+    return 0
+
+def measure(name, pages, accesses):
+    start = rss_kb()
+    m = memories[name]()
+    created = rss_kb()
+    for i in range(pages):
+        m.write(r_uint(i * PAGE_BYTES), 8, r_uint(i))
+    written = rss_kb()
+    rng = random.Random(42)
+    addresses = [r_uint(rng.randrange(pages * PAGE_BYTES) & ~7)
+                 for i in range(accesses)]
+    t1 = time.time()
+    for addr in addresses:
+        m.write(addr, 8, addr)
+    t2 = time.time()
+    for addr in addresses:
+        m.read(addr, 8)
+    t3 = time.time()
+    return (created - start, written - start, (t2 - t1) / accesses,
+            (t3 - t2) / accesses)
+
+def main(argv):
+    if len(argv) == 5 and argv[1] == "--single":
+        print "RESULT", " ".join(
+            [str(x) for x in measure(argv[2], int(argv[3]), int(argv[4]))])
+        return 0
+    pages = int(argv[1]) if len(argv) > 1 else 256
+    accesses = int(argv[2]) if len(argv) > 2 else 100000
+    print "%d pages written, %d random accesses in them" % (pages, accesses)
+    print "%-14s %14s %14s %10s %10s" % (
+        "memory", "RSS created", "RSS written", "write", "read")
+    for name in sorted(memories):
+        out = subprocess.check_output([sys.executable, __file__, "--single",
+                                       name, str(pages), str(accesses)])
+        created, written, write, read = out.strip().splitlines()[-1].split()[1:]
+        print "%-14s %11s KB %11s KB %7.0f ns %7.0f ns" % (
+            name, created, written, float(write) * 1e9, float(read) * 1e9)
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv))
@@ -0,0 +1,61 @@
+""" Counts how many of the %i locals of the RISC-V and the MIPS model are
+narrowed to machine ints by optimize.narrow_int_locals when generating the
+code (without the code cache).
+
+usage: python pydrofoil/test/benchnarrowing.py [<model> ...]
+"""
+
+import os
+import sys
+
+thisdir = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(os.path.dirname(thisdir)))
+
+from pydrofoil import makecode, optimize
+
+models = {
+    "riscv": ("riscv_model_RV64.ir", "supportcoderiscv"),
+    "mips": ("mips.ir", "supportcode"),
+}
+
+def count_one(model):
+    irname, supportcodename = models[model]
+    with open(os.path.join(thisdir, irname)) as f:
+        s = f.read()
+    codegens = []
+    narrow_int_locals = optimize.narrow_int_locals
+    def counting(blocks, codegen):
+        if not codegens:
+            codegens.append(codegen)
+        return narrow_int_locals(blocks, codegen)
+    optimize.narrow_int_locals = counting
+    stdout = sys.stdout
+    # parse_and_make_code prints the code if it fails, and prints progress
+    sys.stdout = open(os.devnull, "w")
+    error = None
+    try:
+        makecode.parse_and_make_code(s, supportcodename)
+    except Exception as e:
+        error = e
+    finally:
+        sys.stdout = stdout
+        optimize.narrow_int_locals = narrow_int_locals
+    if not codegens:
+        return 0, 0, error
+    codegen = codegens[0]
+    return codegen.int_locals, codegen.narrowed_int_locals, error
+
+def main(argv):
+    sys.setrecursionlimit(100000)
+    names = argv[1:] or sorted(models, reverse=True)
+    for model in names:
+        total, narrowed, error = count_one(model)
+        print "%-6s %6d %%i locals, %6d narrowed to machine ints (%.1f%%)" % (
+            model, total, narrowed, narrowed * 100.0 / max(total, 1))
+        if error is not None:
+            print "       code generation failed, only counted until then: %s: %s" % (
+                type(error).__name__, error)
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv))
@@ -0,0 +1,51 @@
+""" Benchmark for the JIB parser. For every IR file, reports the parsing
+throughput and the peak memory use. Every file is parsed in a separate
+process, to measure its peak memory independently of the others.
+
+usage: python pydrofoil/test/benchparse.py [<ir file> ...]
+"""
+
+import os
+import sys
+import time
+import resource
+import subprocess
+
+thisdir = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(os.path.dirname(thisdir)))
+
+irfiles = [os.path.join(thisdir, fn) for fn in
+           ["c.ir", "mips.ir", "riscv_model_RV64.ir"]]
+
+def peak_rss_mb():
+    # ru_maxrss is in kilobytes on linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.
+
+def bench_one(fn, repetitions=3):
+    from pydrofoil import parse
+    with open(fn, "rb") as f:
+        s = f.read()
+    before = peak_rss_mb()
+    best = None
+    for i in range(repetitions):
+        t1 = time.time()
+        ast = parse.parser.parse(parse.lexer.lex(s))
+        t2 = time.time()
+        del ast
+        if best is None or t2 - t1 < best:
+            best = t2 - t1
+    size = len(s) / (1024. * 1024.)
+    print "%-22s %7.2f MB %7.3f s %7.2f MB/s   peak memory +%.1f MB" % (
+        os.path.basename(fn), size, best, size / best, peak_rss_mb() - before)
+
+def main(argv):
+    if len(argv) == 3 and argv[1] == "--single":
+        sys.setrecursionlimit(100000)
+        bench_one(argv[2])
+        return 0
+    for fn in argv[1:] or irfiles:
+        subprocess.check_call([sys.executable, __file__, "--single", fn])
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv))
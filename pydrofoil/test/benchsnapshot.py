@@ -0,0 +1,46 @@
+""" Compares resetting a guest memory by allocating a new FlatMemory (what
+main() in supportcoderiscv.py used to need between iterations) with
+restoring a snapshot, after a number of pages have been written to. Runs
+untranslated.
+
+usage: python pydrofoil/test/benchsnapshot.py [<dirty pages> [<size in MB>]]
+"""
+
+import os
+import sys
+import time
+
+thisdir = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(os.path.dirname(thisdir)))
+
+from rpython.rlib.rarithmetic import r_uint
+
+from pydrofoil import mem
+
+PAGE_BYTES = mem.FlatMemory.PAGE_SIZE * 8
+
+def dirty(m, pages):
+    for i in range(pages):
+        m.write(r_uint(i * PAGE_BYTES), 8, r_uint(i + 1))
+
+def main(argv):
+    pages = int(argv[1]) if len(argv) > 1 else 16
+    size = (int(argv[2]) if len(argv) > 2 else 64) * 1024 * 1024
+    t1 = time.time()
+    m = mem.FlatMemory(False, size)
+    t2 = time.time()
+    print "allocating %d MB:          %12.1f us" % (size // 1024 // 1024, (t2 - t1) * 1e6)
+    m.snapshot()
+    dirty(m, pages)
+    t1 = time.time()
+    m.restore()
+    t2 = time.time()
+    print "restoring %4d dirty pages: %12.1f us" % (pages, (t2 - t1) * 1e6)
+    t1 = time.time()
+    m.restore()
+    t2 = time.time()
+    print "restoring 0 dirty pages:    %12.1f us" % ((t2 - t1) * 1e6, )
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv))
@@ -1,6 +1,6 @@
 from pydrofoil.supportcode import *
 from pydrofoil.bitvector import Integer
-from pydrofoil import elf
+from pydrofoil import elf, loader
 from pydrofoil import mem as mem_mod
 
 from rpython.rlib.nonconst import NonConstant
@@ -76,6 +76,17 @@ g.rv_htif_tohost = r_uint(0x80001000)
 g.rv_insns_per_tick = 100
 
 g.dtb = None
+# where the dtb is loaded to, 0 means into the rom after the reset vector
+g.dtb_addr = r_uint(0)
+
+# command line options for loading images that are not ELF files, see
+# loader.py. 0 means the default address
+g.image_addr = r_uint(0)
+g.entry = r_uint(0)
+g.initrd_file = None
+g.initrd_addr = r_uint(0)
+g.initrd_start = r_uint(0)
+g.initrd_end = r_uint(0)
 
 g.term_fd = 1
 
@@ -188,10 +199,16 @@ def is_32bit_model():
 
 def init_sail_reset_vector(entry):
     from pydrofoil.test import outriscv
-    RST_VEC_SIZE = 8
+    RST_VEC_SIZE = 10
+    rv_rom_base = DEFAULT_RSTVEC
+    dtb_addr = g.dtb_addr
+    if not dtb_addr:
+        dtb_addr = r_uint(rv_rom_base + RST_VEC_SIZE * 4)
     reset_vec = [ # 32 bit entries
         r_uint(0x297),                                      # auipc  t0,0x0
-        r_uint(0x28593 + (RST_VEC_SIZE * 4 << 20)),         # addi   a1, t0, &dtb
+        r_uint(0x0202a583)  # lw     a1,32(t0)
+        if is_32bit_model() else
+        r_uint(0x0202b583), # ld     a1,32(t0)
         r_uint(0xf1402573),                                 # csrr   a0, mhartid
         r_uint(0x0182a283)  # lw     t0,24(t0)
         if is_32bit_model() else
@@ -200,28 +217,34 @@ def init_sail_reset_vector(entry):
         r_uint(0),
         r_uint(entry & 0xffffffff),
         r_uint(entry >> 32),
+        r_uint(dtb_addr & 0xffffffff),
+        r_uint(dtb_addr >> 32),
     ]
-
-
-    rv_rom_base = DEFAULT_RSTVEC
-    addr = r_uint(rv_rom_base)
-    for i, fourbytes in enumerate(reset_vec):
+    assert len(reset_vec) == RST_VEC_SIZE
+
+    # without -b the device tree is generated from the platform globals
+    dtb = g.dtb
+    if dtb is None:
+        dtb = make_dtb()
+    rom = []
+    for fourbytes in reset_vec:
         for j in range(4):
-            write_mem(addr, fourbytes & 0xff) # little endian
-            addr += 1
+            rom.append(chr(intmask(fourbytes & 0xff))) # little endian
             fourbytes >>= 8
         assert fourbytes == 0
-    if g.dtb:
-        for i, char in enumerate(g.dtb):
-            write_mem(addr, r_uint(ord(char)))
-            addr += 1
+    if g.dtb_addr:
+        g.mem.write_bytes(g.dtb_addr, dtb)
+    else:
+        rom.append(dtb)
+    romdata = "".join(rom)
+    addr = r_uint(rv_rom_base)
+    g.mem.write_bytes(addr, romdata)
+    addr += len(romdata)
 
     align = 0x1000
     # zero-fill to page boundary
     rom_end = r_uint((addr + align - 1) / align * align)
-    for i in range(intmask(addr), rom_end):
-        write_mem(addr, 0)
-        addr += 1
+    g.mem.fill(addr, intmask(rom_end - addr))
 
     # set rom size
     rv_rom_size = rom_end - rv_rom_base
@@ -231,6 +254,77 @@ def init_sail_reset_vector(entry):
     # boot at reset vector
     outriscv.r.zPC = r_uint(rv_rom_base)
 
+CLOCK_FREQUENCY = 1000000000
+
+def make_dtb():
+    # the device tree of the platform, the same one that the OCaml emulator
+    # of the Sail model generates and passes through dtc
+    from pydrofoil.fdt import FDTBuilder
+    b = FDTBuilder()
+    b.begin_node("")
+    b.property_u32("#address-cells", 2)
+    b.property_u32("#size-cells", 2)
+    b.property_string("compatible", "ucbbar,spike-bare-dev")
+    b.property_string("model", "ucbbar,spike-bare")
+
+    b.begin_node("chosen")
+    if g.initrd_end:
+        b.property_u64s("linux,initrd-start", [g.initrd_start])
+        b.property_u64s("linux,initrd-end", [g.initrd_end])
+    b.end_node()
+
+    intc_phandle = 1
+    b.begin_node("cpus")
+    b.property_u32("#address-cells", 1)
+    b.property_u32("#size-cells", 0)
+    # mtime is incremented every rv_insns_per_tick instructions
+    b.property_u32("timebase-frequency", CLOCK_FREQUENCY // g.rv_insns_per_tick)
+    b.begin_node("cpu@0")
+    b.property_string("device_type", "cpu")
+    b.property_u32("reg", 0)
+    b.property_string("status", "okay")
+    b.property_string("compatible", "riscv")
+    isa = "rv32ima" if is_32bit_model() else "rv64ima"
+    if g.rv_enable_fdext:
+        isa += "fd"
+    if g.rv_enable_rvc:
+        isa += "c"
+    b.property_string("riscv,isa", isa)
+    b.property_string("mmu-type", "riscv,sv32" if is_32bit_model() else "riscv,sv39")
+    b.property_u32("clock-frequency", CLOCK_FREQUENCY)
+    b.begin_node("interrupt-controller")
+    b.property_u32("#interrupt-cells", 1)
+    b.property_empty("interrupt-controller")
+    b.property_string("compatible", "riscv,cpu-intc")
+    b.property_u32("phandle", intc_phandle)
+    b.end_node()
+    b.end_node()
+    b.end_node()
+
+    b.begin_node("memory@%x" % (g.rv_ram_base, ))
+    b.property_string("device_type", "memory")
+    b.property_u64s("reg", [g.rv_ram_base, g.rv_ram_size])
+    b.end_node()
+
+    b.begin_node("soc")
+    b.property_u32("#address-cells", 2)
+    b.property_u32("#size-cells", 2)
+    b.property_strings("compatible", ["ucbbar,spike-bare-soc", "simple-bus"])
+    b.property_empty("ranges")
+    b.begin_node("clint@%x" % (g.rv_clint_base, ))
+    b.property_string("compatible", "riscv,clint0")
+    # machine software and timer interrupts
+    b.property_u32s("interrupts-extended", [intc_phandle, 3, intc_phandle, 7])
+    b.property_u64s("reg", [g.rv_clint_base, g.rv_clint_size])
+    b.end_node()
+    b.end_node()
+
+    b.begin_node("htif")
+    b.property_string("compatible", "ucb,htif0")
+    b.end_node()
+    b.end_node()
+    return b.build()
+
 def parse_dump_file(fn):
     with open(fn) as f:
         content = f.read()
@@ -302,6 +396,23 @@ def main(argv):
     if blob:
         with open(blob, "rb") as f:
             g.dtb = f.read()
+    dtb_addr = parse_args(argv, "--dtb-addr")
+    if dtb_addr:
+        g.dtb_addr = loader.parse_address(dtb_addr)
+
+    # for images that are not ELF files
+    image_addr = parse_args(argv, "--image-addr")
+    if image_addr:
+        g.image_addr = loader.parse_address(image_addr)
+    entry = parse_args(argv, "--entry")
+    if entry:
+        g.entry = loader.parse_address(entry)
+    initrd = parse_args(argv, "--initrd")
+    if initrd:
+        g.initrd_file = initrd
+    initrd_addr = parse_args(argv, "--initrd-addr")
+    if initrd_addr:
+        g.initrd_addr = loader.parse_address(initrd_addr)
 
     limit = 0
     str_limit = parse_args(argv, "-l", "--inst-limit")
@@ -327,10 +438,13 @@ def main(argv):
 
     print_kips = parse_flag(argv, "--print-kips")
 
+    # untranslated only, see regprofile.py
+    profile_file = parse_args(argv, "--profile-registers")
+
     # Initialize model so that we can check or report its architecture.
     outriscv.model_init()
     if len(argv) == 1:
-        print("usage: %s <elf file>" % (argv[0], ))
+        print("usage: %s <elf file or image>" % (argv[0], ))
         return 1
     file = argv[1]
     if len(argv) == 3:
@@ -340,11 +454,25 @@ def main(argv):
     #init_logs()
 
     entry = load_sail(file)
+    if iterations > 1:
+        g.mem.snapshot()
+    profile = None
     for i in range(iterations):
-        init_sail(entry)
-        run_sail(limit, print_kips)
         if i:
+            # reset the memory to the loaded image, only the pages that the
+            # previous iteration wrote to are copied
+            g.mem.restore()
             outriscv.model_init()
+        init_sail(entry)
+        if not we_are_translated() and profile_file and profile is None:
+            from pydrofoil import regprofile
+            profile = regprofile.start_profiling(outriscv)
+        steps = run_sail(limit, print_kips)
+        if not we_are_translated() and profile is not None:
+            profile.steps += steps
+    if not we_are_translated() and profile is not None:
+        profile.write(profile_file)
+        print "register profile written to", profile_file
     #flush_logs()
     #close_logs()
     return 0
@@ -355,6 +483,10 @@ def get_printable_location(pc, do_show_times, insn_limit, tick):
         return "TICK 0x%x" % (pc, )
     if g.dump_dict and pc in g.dump_dict:
         return "0x%x: %s" % (pc, g.dump_dict[pc])
+    if g.elf_image is not None:
+        symbol = g.elf_image.lookup_address(r_uint(pc))
+        if symbol is not None:
+            return "0x%x: %s+0x%x" % (pc, symbol.name, r_uint(pc) - symbol.addr)
     return hex(pc)
 
 driver = JitDriver(
@@ -364,6 +496,7 @@ driver = JitDriver(
     virtualizables=['r'])
 
 g.dump_dict = None
+g.elf_image = None
 
 def run_sail(insn_limit, do_show_times):
     from pydrofoil.test import outriscv
@@ -432,6 +565,7 @@ def run_sail(insn_limit, do_show_times):
     print "Instructions: %s" % (step_no, )
     print "Total time (s): %s" % (interval_end - g.total_start)
     print "Perf: %s Kips" % (step_no / 1000. / (interval_end - g.total_start), )
+    return step_no
 
 
 
@@ -440,20 +574,40 @@ def load_sail(fn):
     oldmem = g.mem
     if oldmem:
         oldmem.close()
-    mem1 = mem_mod.FlatMemory(False)
-    mem2 = mem_mod.FlatMemory(False, g.rv_ram_size)
-    mem = mem_mod.SplitMemory(mem1, 0, mem1.size, mem2, g.rv_ram_base, g.rv_ram_size)
+    # the low memory contains the rom with the reset vector and the dtb
+    rom = mem_mod.FlatMemory(False)
+    ram = mem_mod.FlatMemory(False, g.rv_ram_size)
+    mem = mem_mod.SplitMemory()
+    mem.add_region(r_uint(0), r_uint(rom.size), rom)
+    mem.add_region(g.rv_ram_base, g.rv_ram_size, ram)
     g.mem = mem
-    with open(fn, "rb") as f:
-        entrypoint = elf.elf_read_process_image(mem, f) # load process image
-    with open(fn, "rb") as f:
-        img = elf.elf_reader(f) # for the symbols
+    if loader.is_elf(fn):
+        entrypoint, img = elf.load_elf(mem, fn)
+        g.elf_image = img # for get_printable_location
 
-    g.rv_htif_tohost = r_uint(img.get_symbol('tohost'))
-    print "tohost located at 0x%x" % g.rv_htif_tohost
+        g.rv_htif_tohost = r_uint(img.get_symbol('tohost'))
+        print "tohost located at 0x%x" % g.rv_htif_tohost
+    else:
+        # raw image, possibly gzip compressed
+        g.elf_image = None
+        entrypoint = g.image_addr
+        if not entrypoint:
+            entrypoint = g.rv_ram_base
+        size = loader.load_image(mem, fn, entrypoint)
+        print "image of %d bytes loaded at 0x%x" % (size, entrypoint)
+    if g.initrd_file:
+        initrd_addr = g.initrd_addr
+        if not initrd_addr:
+            initrd_addr = g.rv_ram_base + g.rv_ram_size // 2
+        # not decompressed, the kernel does that itself
+        size = loader.load_image(mem, g.initrd_file, initrd_addr, decompress=False)
+        g.initrd_start = initrd_addr
+        g.initrd_end = initrd_addr + r_uint(size)
+        print "initrd loaded at 0x%x-0x%x" % (g.initrd_start, g.initrd_end)
+    if g.entry:
+        entrypoint = g.entry
 
     print "entrypoint 0x%x" % entrypoint
-    assert entrypoint == 0x80000000 # XXX for now
     return entrypoint
 
 # printing
@@ -489,5 +643,7 @@ def get_main():
     from pydrofoil.test import outriscv
     from rpython.rlib import jit
 
-    outriscv.Registers._virtualizable_ = ['ztlb39', 'ztlb48', 'zminstret', 'zPC', 'znextPC', 'zmstatus', 'zmip', 'zmie', 'zsatp']
+    if not hasattr(outriscv.Registers, "_virtualizable_"):
+        # no register profile was used to generate the model
+        outriscv.Registers._virtualizable_ = ['ztlb39', 'ztlb48', 'zminstret', 'zPC', 'znextPC', 'zmstatus', 'zmip', 'zmie', 'zsatp']
     return main
@@ -5,12 +5,15 @@ from pydrofoil.makecode import *
 
 nandir = os.path.join(os.path.dirname(__file__), "c.ir")
 outnandpy = os.path.join(os.path.dirname(__file__), "out.py")
+# every target has its own cache, saving a cache drops the entries that
+# were not used
+cachedir = os.path.join(os.path.dirname(__file__), ".codecache", "nand")
 
 def make_code():
     print "making rpython code"
     with open(nandir, "rb") as f:
         s = f.read()
-    res = parse_and_make_code(s, "supportcode")
+    res = parse_and_make_code(s, "supportcode", cachedir=cachedir)
     with open(outnandpy, "w") as f:
         f.write(res)
     from pydrofoil.test import out, supportcode
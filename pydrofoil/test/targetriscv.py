@@ -4,15 +4,26 @@ sys.setrecursionlimit(2**31-1)
 from pydrofoil.makecode import *
 
 import os
+import multiprocessing
 
 riscvir = os.path.join(os.path.dirname(__file__), "riscv_model_RV64.ir")
 outriscvpy = os.path.join(os.path.dirname(__file__), "outriscv.py")
+# every target has its own cache, saving a cache drops the entries that
+# were not used
+cachedir = os.path.join(os.path.dirname(__file__), ".codecache", "riscv")
+# written by running untranslated with --profile-registers, see regprofile.py
+registerprofile = os.path.join(os.path.dirname(__file__), "riscv.regprofile")
 
-def make_code():
+def make_code(structured_control_flow=True):
     print "making python code"
     with open(riscvir, "rb") as f:
         s = f.read()
-    res = parse_and_make_code(s, "supportcoderiscv", {'zPC', 'znextPC', 'zMisa_chunk_0', 'zcur_privilege', 'zMstatus_chunk_0', })
+    if os.path.exists(registerprofile):
+        profile = registerprofile
+    else:
+        profile = None
+    # the struct fields can't be profiled and are promoted explicitly
+    res = parse_and_make_code(s, "supportcoderiscv", {'zPC', 'znextPC', 'zMisa_chunk_0', 'zcur_privilege', 'zMstatus_chunk_0', }, cachedir, multiprocessing.cpu_count(), structured_control_flow, print_union_switch_report=True, register_profile=profile)
     # XXX horrible hack, they should be fixed in the model!
     assert res.count("func_zread_ram(zrk") == 2
     res = res.replace("def func_zread_ram(zrk", "def func_zread_ram(executable_flag, zrk")
@@ -0,0 +1,117 @@
+import pytest
+
+from pydrofoil import parse
+from pydrofoil.controlflow import (Graph, structure, If, Loop, CONTINUE,
+        BREAK, CantStructure)
+
+def assign(name):
+    return parse.Assignment(name, parse.Number(1))
+
+def jump(var, target):
+    return parse.ConditionalJump(parse.ExprCondition(parse.Var(var)), target, "")
+
+def test_split_blocks():
+    blocks = {0: [assign("a"), jump("c", 5), assign("b"), parse.End()],
+              5: [parse.End()]}
+    graph = Graph(blocks)
+    assert graph.successors == {0: [5, 6], 5: [], 6: []}
+    assert graph.nodes[6] == ([blocks[0][2]], blocks[0][3])
+    assert graph.predecessors == {0: [], 5: [0], 6: [0]}
+
+def test_dominators():
+    # 0 -> 1, 2; 1 -> 3; 2 -> 3
+    blocks = {0: [jump("c", 2), parse.Goto(1)],
+              1: [parse.Goto(3)],
+              2: [parse.Goto(3)],
+              3: [parse.End()]}
+    graph = Graph(blocks)
+    assert graph.immediate_dominators() == {1: 4, 2: 0, 3: 0, 4: 0}
+    assert graph.immediate_postdominators() == {0: 3, 1: 3, 2: 3, 3: None, 4: 1}
+
+def test_structure_if_else():
+    a, b, c = assign("a"), assign("b"), assign("c")
+    end = parse.End()
+    blocks = {0: [jump("cond", 2), parse.Goto(1)],
+              1: [a, parse.Goto(3)],
+              2: [b, parse.Goto(3)],
+              3: [c, end]}
+    res = structure(blocks)
+    assert len(res) == 3
+    ifop, cop, endop = res
+    assert isinstance(ifop, If)
+    assert ifop.condition is blocks[0][0]
+    assert ifop.true == [b]
+    assert ifop.false == [a]
+    assert cop is c
+    assert endop is end
+
+def test_structure_loop():
+    a, b = assign("a"), assign("b")
+    end = parse.End()
+    # 0: while 1: a; if cond: break; b
+    blocks = {0: [a, jump("cond", 2), b, parse.Goto(0)],
+              2: [end]}
+    res = structure(blocks)
+    assert len(res) == 2
+    loop, endop = res
+    assert isinstance(loop, Loop)
+    assert loop.body[0] is a
+    ifop = loop.body[1]
+    assert ifop.true == [BREAK]
+    assert ifop.false == []
+    assert not ifop.negated
+    assert loop.body[2:] == [b, CONTINUE]
+    assert endop is end
+
+def test_structure_return_in_loop():
+    a = assign("a")
+    end1, end2 = parse.End(), parse.End()
+    blocks = {0: [jump("exc", 3), jump("cond", 2), a, parse.Goto(0)],
+              2: [end1],
+              3: [end2]}
+    res = structure(blocks)
+    loop, = res[:-1]
+    assert res[-1] is end1
+    assert loop.body[0].true == [end2]
+
+def test_structure_negate():
+    a, b = assign("a"), assign("b")
+    end1, end2 = parse.End(), parse.End()
+    # the deeper nested branch is not put into the if
+    blocks = {0: [jump("cond", 2), a, end1],
+              2: [b, jump("cond2", 3), parse.Goto(3)],
+              3: [end2]}
+    res = structure(blocks)
+    ifop = res[0]
+    assert ifop.negated
+    assert ifop.true == [a, end1]
+    assert ifop.false == []
+    assert res[1] is b
+    assert isinstance(res[2], If)
+
+def test_irreducible():
+    # 1 and 2 jump to each other and can both be entered from 0
+    blocks = {0: [jump("cond", 2), parse.Goto(1)],
+              1: [jump("cond", 3), parse.Goto(2)],
+              2: [parse.Goto(1)],
+              3: [parse.End()]}
+    with pytest.raises(CantStructure):
+        structure(blocks)
+
+def test_structure_too_deep():
+    blocks = {}
+    for i in range(10):
+        blocks[i * 2] = [jump("cond", i * 2 + 2), parse.Goto(i * 2 + 1)]
+        blocks[i * 2 + 1] = [assign("a"), parse.Goto(i * 2 + 2)]
+    blocks[20] = [parse.End()]
+    res = structure(blocks)
+    assert structure(blocks, maxdepth=1) # sequential ifs
+    blocks = {}
+    for i in range(10):
+        blocks[i * 2] = [jump("cond", i * 2 + 2), parse.Goto(i * 2 + 1)]
+        blocks[i * 2 + 1] = [assign("a"), parse.Goto(40)]
+    blocks[20] = [assign("b"), parse.Goto(40)]
+    blocks[40] = [parse.End()]
+    res = structure(blocks)
+    with pytest.raises(CantStructure):
+        structure(blocks, maxdepth=5)
@@ -4,6 +4,7 @@ from pydrofoil import elf
 
 elffile = os.path.join(os.path.dirname(__file__), "rv64ui-p-addi.elf")
 elffile2 = os.path.join(os.path.dirname(__file__), "rv64-linux-4.15.0-gcc-7.2.0-64mb.bbl")
+dhrystone = os.path.join(os.path.dirname(__file__), "dhrystone.riscv")
 
 def test_elf_riscv64():
     with open(elffile, "rb") as f:
@@ -15,3 +16,82 @@ def test_elf_riscv64():
     assert section1.addr == 0x80000000
     assert section2.addr == 0x80001000
 
+
+def test_elf_file():
+    f = elf.ElfFile(elffile)
+    with open(elffile, "rb") as f2:
+        content = f2.read()
+    assert f.size == len(content)
+    assert f.read(4) == "\x7fELF"
+    f.seek(100)
+    assert f.read(10) == content[100:110]
+    f.seek(f.size - 2)
+    assert f.read(10) == content[-2:]
+    img = elf.elf_reader(f)
+    assert [section.name for section in img.sections] == [".text.init", ".tohost"]
+    f.close()
+
+def test_load_elf():
+    from rpython.rlib.rarithmetic import r_uint
+    from pydrofoil import mem
+    m1 = mem.SparseMemory()
+    with open(elffile, "rb") as f:
+        entrypoint1 = elf.elf_read_process_image(m1, f)
+    with open(elffile, "rb") as f:
+        img1 = elf.elf_reader(f)
+    m2 = mem.SparseMemory()
+    entrypoint2, img2 = elf.load_elf(m2, elffile)
+    assert entrypoint1 == entrypoint2 == 0x80000000
+    assert img2.sections == [] # only the symbols are read
+    assert img2.symbols == img1.symbols
+    assert img2.get_symbol("tohost") == 0x80001000
+    assert sorted(m2.pages) == sorted(m1.pages)
+    for pagenum in m1.pages:
+        assert m2.pages[pagenum].words == m1.pages[pagenum].words
+    assert m2.read(r_uint(0x80000000), 4) != 0
+
+def test_lookup_address():
+    img = elf.SparseMemoryImage()
+    img.add_address_symbol("c", 0x3000, 0)
+    img.add_address_symbol("a", 0x1000, 0x10)
+    img.add_address_symbol("b", 0x2000, 0x800)
+    img.sort_address_index()
+    assert [symbol.name for symbol in img.address_index] == ["a", "b", "c"]
+    assert img.lookup_address(0xfff) is None
+    assert img.lookup_address(0x1000).name == "a"
+    assert img.lookup_address(0x100f).name == "a"
+    assert img.lookup_address(0x1010) is None # beyond the size of a
+    assert img.lookup_address(0x27ff).name == "b"
+    assert img.lookup_address(0x2800) is None
+    # symbols without a size extend to the next one
+    assert img.lookup_address(0x3000).name == "c"
+    assert img.lookup_address(0x123456).name == "c"
+
+def test_lookup_address_dhrystone():
+    with open(dhrystone, "rb") as f:
+        img = elf.elf_reader(f)
+    main = img.get_symbol("main")
+    assert img.lookup_address(main).name == "main"
+    symbol = img.lookup_address(main + 8)
+    assert symbol.name == "main"
+    assert symbol.addr == main
+    addrs = [symbol.addr for symbol in img.address_index]
+    assert addrs == sorted(addrs)
+
+def test_load_elf_translates():
+    from rpython.rlib.rarithmetic import r_uint
+    from rpython.translator.interactive import Translation
+    from pydrofoil import mem, loader
+    from pydrofoil.test import supportcoderiscv
+    def main(fn, dtbfn, insns_per_tick):
+        # like the command line option, makes the cells of make_dtb signed
+        supportcoderiscv.g.rv_insns_per_tick = insns_per_tick
+        m = mem.SparseMemory()
+        entrypoint, img = elf.load_elf(m, fn)
+        symbol = img.lookup_address(entrypoint)
+        if symbol is not None:
+            print symbol.name
+        m.write_bytes(r_uint(0x1000), supportcoderiscv.make_dtb())
+        return loader.load_image(m, dtbfn, r_uint(0x2000))
+    t = Translation(main, [str, str, int])
+    t.rtype() # check that it's rpython
@@ -0,0 +1,109 @@
+import struct
+
+from pydrofoil import fdt
+
+def parse_fdt(data):
+    # returns the tree as nested dicts, properties as strings, children as
+    # dicts under their names
+    (magic, totalsize, off_struct, off_strings, off_rsvmap, version,
+     last_comp_version, boot_cpuid, size_strings, size_struct) = struct.unpack(
+        ">10I", data[:40])
+    assert magic == fdt.FDT_MAGIC
+    assert totalsize == len(data)
+    assert data[off_rsvmap: off_rsvmap + 16] == "\0" * 16
+    assert off_strings + size_strings == totalsize
+    assert off_struct + size_struct == off_strings
+    strings = data[off_strings:]
+    pos = [off_struct]
+    def u32():
+        value, = struct.unpack(">I", data[pos[0]: pos[0] + 4])
+        pos[0] += 4
+        return value
+    def align():
+        pos[0] = (pos[0] + 3) & ~3
+    stack = [{}]
+    while True:
+        token = u32()
+        if token == fdt.FDT_BEGIN_NODE:
+            end = data.index("\0", pos[0])
+            name = data[pos[0]: end]
+            pos[0] = end + 1
+            align()
+            node = {}
+            stack[-1][name] = node
+            stack.append(node)
+        elif token == fdt.FDT_END_NODE:
+            stack.pop()
+        elif token == fdt.FDT_PROP:
+            size = u32()
+            nameoff = u32()
+            name = strings[nameoff: strings.index("\0", nameoff)]
+            stack[-1][name] = data[pos[0]: pos[0] + size]
+            pos[0] += size
+            align()
+        else:
+            assert token == fdt.FDT_END
+            break
+    assert pos[0] == off_strings
+    assert len(stack) == 1
+    return stack[0][""]
+
+def cells(value):
+    return list(struct.unpack(">%dI" % (len(value) // 4), value))
+
+def test_fdt_builder():
+    b = fdt.FDTBuilder()
+    b.begin_node("")
+    b.property_u32("#address-cells", 2)
+    b.property_string("model", "abc")
+    b.begin_node("memory@80000000")
+    b.property_u64s("reg", [0x80000000, 0x4000000])
+    b.property_empty("ranges")
+    b.property_strings("compatible", ["a", "bc"])
+    b.end_node()
+    b.end_node()
+    tree = parse_fdt(b.build())
+    assert cells(tree["#address-cells"]) == [2]
+    assert tree["model"] == "abc\0"
+    mem = tree["memory@80000000"]
+    assert cells(mem["reg"]) == [0, 0x80000000, 0, 0x4000000]
+    assert mem["ranges"] == ""
+    assert mem["compatible"] == "a\0bc\0"
+
+def test_fdt_builder_shares_names():
+    b = fdt.FDTBuilder()
+    b.begin_node("")
+    b.property_u32("reg", 1)
+    b.begin_node("a")
+    b.property_u32("reg", 2)
+    b.end_node()
+    b.end_node()
+    data = b.build()
+    assert data.count("reg\0") == 1
+    assert cells(parse_fdt(data)["a"]["reg"]) == [2]
+
+def test_make_dtb():
+    from pydrofoil.test import supportcoderiscv
+    g = supportcoderiscv.g
+    tree = parse_fdt(supportcoderiscv.make_dtb())
+    cpu = tree["cpus"]["cpu@0"]
+    assert cpu["riscv,isa"] == "rv64imafdc\0"
+    intc = cpu["interrupt-controller"]
+    memory = tree["memory@%x" % g.rv_ram_base]
+    assert cells(memory["reg"]) == [0, g.rv_ram_base, 0, g.rv_ram_size]
+    clint = tree["soc"]["clint@%x" % g.rv_clint_base]
+    assert cells(clint["reg"]) == [0, g.rv_clint_base, 0, g.rv_clint_size]
+    assert cells(clint["interrupts-extended"]) == [1, 3, 1, 7]
+    assert cells(intc["phandle"]) == [1]
+    assert "linux,initrd-start" not in tree["chosen"]
+    old = g.initrd_start, g.initrd_end, g.rv_enable_rvc
+    try:
+        g.initrd_start = 0x84000000
+        g.initrd_end = 0x84100000
+        g.rv_enable_rvc = False
+        tree = parse_fdt(supportcoderiscv.make_dtb())
+    finally:
+        g.initrd_start, g.initrd_end, g.rv_enable_rvc = old
+    assert cells(tree["chosen"]["linux,initrd-start"]) == [0, 0x84000000]
+    assert cells(tree["chosen"]["linux,initrd-end"]) == [0, 0x84100000]
+    assert tree["cpus"]["cpu@0"]["riscv,isa"] == "rv64imafd\0"
@@ -0,0 +1,58 @@
+import os
+import gzip
+
+import pytest
+
+from rpython.rlib.rarithmetic import r_uint
+
+from pydrofoil import loader, mem
+
+thisdir = os.path.dirname(__file__)
+elffile = os.path.join(thisdir, "rv64ui-p-addi.elf")
+
+def read_back(m, addr, size):
+    return "".join([chr(m.read(addr + r_uint(i), 1)) for i in range(size)])
+
+def test_load_raw(tmpdir):
+    data = "".join([chr(i & 0xff) for i in range(3 * 1000 + 5)])
+    fn = tmpdir.join("image.bin")
+    fn.write(data, mode="wb")
+    m = mem.SparseMemory()
+    size = loader.load_image(m, str(fn), r_uint(0x80200003))
+    assert size == len(data)
+    assert read_back(m, r_uint(0x80200003), size) == data
+    assert m.read(r_uint(0x80200002), 1) == 0
+
+def test_load_gzip(tmpdir, monkeypatch):
+    monkeypatch.setattr(loader, "CHUNK_SIZE", 100) # several chunks
+    data = "".join([chr((i * 7) & 0xff) for i in range(5000)])
+    fn = tmpdir.join("image.gz")
+    with gzip.open(str(fn), "wb") as f:
+        f.write(data)
+    m = mem.SparseMemory()
+    size = loader.load_image(m, str(fn), r_uint(0x1000))
+    assert size == len(data)
+    assert read_back(m, r_uint(0x1000), size) == data
+    # an initrd is not decompressed
+    compressed = fn.read(mode="rb")
+    size = loader.load_image(m, str(fn), r_uint(0x10000), decompress=False)
+    assert size == len(compressed)
+    assert read_back(m, r_uint(0x10000), size) == compressed
+
+def test_load_gzip_truncated(tmpdir):
+    fn = tmpdir.join("image.gz")
+    with gzip.open(str(fn), "wb") as f:
+        f.write("abc" * 100)
+    fn.write(fn.read(mode="rb")[:20], mode="wb")
+    with pytest.raises(ValueError):
+        loader.load_image(mem.SparseMemory(), str(fn), r_uint(0))
+
+def test_is_elf(tmpdir):
+    assert loader.is_elf(elffile)
+    fn = tmpdir.join("image.bin")
+    fn.write("\x7fEL", mode="wb")
+    assert not loader.is_elf(str(fn))
+
+def test_parse_address():
+    assert loader.parse_address("0x80200000") == 0x80200000
+    assert loader.parse_address("4096") == 4096
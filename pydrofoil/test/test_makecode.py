@@ -59,6 +59,249 @@ union zinstr {
     assert "class Union_zinstr_zAINST(Union_zinstr):" in res
     assert "class Union_zinstr_zCINST(Union_zinstr):" in res
 
+def test_registers():
+    import py
+    s = "".join(["register zr%s : %%bv8\n\n" % i for i in range(1, 9)]) + """
+register zcounter : %i64
+
+register zconst : %bv8
+
+val zf : (%unit) ->  %bv8
+
+fn zf(zgsz30) {
+  zr3 = 0x05;
+  zcounter = 1;
+  return = @bvadd(zr3, zconst);
+  end;
+}
+"""
+    res = parse_and_make_code(s, "supportcode")
+    # the numbered registers are stored in an array
+    assert "self.zr_array = [r_uint(0)] * 9" in res
+    assert "r.zr_array[3] = r_uint(0x05)" in res
+    assert "_immutable_fields_ = ['zr_array', 'zconst']" in res
+    d = {}
+    exec py.code.Source(res).compile() in d
+    assert d['func_zf'](()) == 5
+    assert d['r'].zcounter == 1
+    res = parse_and_make_code(s, "supportcode", quasi_immutable_registers={"zcounter"})
+    assert "_immutable_fields_ = ['zr_array', 'zcounter?', 'zconst']" in res
+
+def test_register_profile():
+    import py, types
+    from pydrofoil import regprofile
+    s = "".join(["register zr%s : %%bv8\n\n" % i for i in range(1, 9)]) + """
+register zcounter : %i64
+
+register zmode : %i64
+
+register zpc : %i64
+
+val zstep : (%unit) ->  %unit
+
+fn zstep(zgsz30) {
+  zcounter = @iadd(zcounter, zpc);
+  zr3 = 0x05;
+  zpc = @iadd(zpc, zmode);
+  return = ();
+  end;
+}
+
+val zset_mode : (%i64) ->  %unit
+
+fn zset_mode(zm) {
+  zmode = zm;
+  return = ();
+  end;
+}
+"""
+    mod = types.ModuleType("outtest")
+    exec py.code.Source(parse_and_make_code(s, "supportcode")).compile() in mod.__dict__
+    profile = regprofile.start_profiling(mod)
+    for i in range(10):
+        mod.func_zstep(())
+    profile.steps = 10
+    assert profile.writes["zcounter"] == 10
+    res = parse_and_make_code(s, "supportcode", register_profile=profile)
+    assert "jit.promote(r.zpc)" in res
+    assert "_immutable_fields_ = ['zmode?']" in res
+    assert "_virtualizable_ = ['zr_array[*]', 'zcounter', 'zpc']" in res
+    d = {}
+    exec py.code.Source(res).compile() in d
+
+def test_unboxed_bitvector_operations():
+    import py
+    from rpython.rlib.rarithmetic import r_uint
+    s = """
+val zupdate_subrange_bits = "vector_update_subrange" : (%bv, %i, %i, %bv) ->  %bv
+
+val zxor_vec = "xor_bits" : (%bv, %bv) ->  %bv
+
+val zsubrange_bits = "vector_subrange" : (%bv, %i, %i) ->  %bv
+
+val zf : (%bv8, %bv2) ->  %bv8
+
+fn zf(zx, zy) {
+  zgsz30 : %bv = zx;
+  zgsz31 : %i = 5;
+  zgsz32 : %i = 4;
+  zgsz33 : %bv = zy;
+  zgsz34 : %bv;
+  zgsz34 = zupdate_subrange_bits(zgsz30, zgsz31, zgsz32, zgsz33);
+  zgsz35 : %bv = 0xff;
+  zgsz36 : %bv;
+  zgsz36 = zxor_vec(zgsz34, zgsz35);
+  zgsz37 : %bv8;
+  zgsz37 = zgsz36;
+  zgsz38 : %bv = zgsz37;
+  zgsz39 : %bv;
+  zgsz39 = zsubrange_bits(zgsz38, zgsz31, zgsz32);
+  zgsz310 : %bv2;
+  zgsz310 = zgsz39;
+  zgsz311 : %bv = zgsz310;
+  zgsz312 : %bv = zgsz37;
+  zgsz312 = zupdate_subrange_bits(zgsz312, zgsz32, zgsz32, zgsz311);
+  return = zgsz312;
+  end;
+}
+"""
+    res = parse_and_make_code(s, "supportcode")
+    assert "supportcode.vector_update_subrange_fixed(8, zx, 5, 4, zy)" in res
+    assert "supportcode.vector_subrange_fixed(zgsz36_unboxed1, 5, 4)" in res
+    # nothing is boxed
+    assert "bitvector.from_ruint" not in res
+    d = {}
+    exec py.code.Source(res).compile() in d
+    x = 0b10000111
+    y = ((x & 0b11001111) | (0b10 << 4)) ^ 0xff
+    y = (y & ~0b10000) | ((y >> 4) & 0b11) << 4
+    assert d['func_zf'](r_uint(x), r_uint(0b10)) == y
+
+def test_unboxed_int_operations():
+    import py, sys
+    s = """
+val zadd_atom = "add_int" : (%i, %i) ->  %i
+
+val zlt_int = "lt" : (%i, %i) ->  %bool
+
+val zf : (%i64, %i64) ->  %i64
+
+fn zf(zx, zy) {
+  zgsz30 : %i = zx;
+  zgsz31 : %i = zy;
+  zgsz32 : %bool;
+  zgsz32 = zlt_int(zgsz30, zgsz31);
+  jump zgsz32 goto 9 ` "test";
+  zgsz33 : %i;
+  zgsz33 = zadd_atom(zgsz30, zgsz31);
+  return = zgsz33;
+  end;
+  return = zx;
+  end;
+}
+"""
+    res = parse_and_make_code(s, "supportcode")
+    func = res[res.index("def func_zf"):]
+    assert "supportcode.add_i_i_toint(zx, zy)" in func
+    assert "(zx < zy)" in func
+    # nothing is boxed
+    assert "Integer.fromint" not in func
+    assert ".toint()" not in func
+    d = {}
+    exec py.code.Source(res).compile() in d
+    assert d['func_zf'](1, 2) == 1
+    assert d['func_zf'](2, 1) == 3
+    with py.test.raises(OverflowError):
+        d['func_zf'](sys.maxint, 1)
+
+def test_narrow_int_locals():
+    import py
+    from rpython.rlib.rarithmetic import r_uint
+    s = """
+val zadd_atom = "add_int" : (%i, %i) ->  %i
+
+val zmult_atom = "mult_int" : (%i, %i) ->  %i
+
+val zunsigned = "sail_unsigned" : (%bv) ->  %i
+
+val zsubrange_bits = "vector_subrange" : (%bv, %i, %i) ->  %bv
+
+val zf : (%bv3, %bv16) ->  %bv1
+
+fn zf(zx, zy) {
+  zgsz30 : %bv = zx;
+  zgsz31 : %i;
+  zgsz31 = zunsigned(zgsz30);
+  zgsz32 : %i = 2;
+  zgsz33 : %i;
+  zgsz33 = zmult_atom(zgsz31, zgsz32);
+  zgsz34 : %i = 1;
+  zgsz35 : %i;
+  zgsz35 = zadd_atom(zgsz33, zgsz34);
+  zgsz36 : %bv = zy;
+  zgsz37 : %bv;
+  zgsz37 = zsubrange_bits(zgsz36, zgsz35, zgsz35);
+  zgsz38 : %bv1 = zgsz37;
+  return = zgsz38;
+  end;
+}
+"""
+    res = parse_and_make_code(s, "supportcode")
+    func = res[res.index("def func_zf"):]
+    # all the %i locals are machine ints
+    assert "Integer" not in func
+    assert ".toint()" not in func
+    assert "supportcode.mult_i_i_toint(zgsz31, 2)" in func
+    assert "supportcode.vector_subrange_fixed(zy, zgsz35, zgsz35)" in func
+    d = {}
+    exec py.code.Source(res).compile() in d
+    assert d['func_zf'](r_uint(0b101), r_uint(0b100000000000)) == 1
+    assert d['func_zf'](r_uint(0b100), r_uint(0b100000000000)) == 0
+
+def test_union_switch_after_setup():
+    import py
+    s = """
+union zval {
+  zVint: %i64,
+  zVstr: %string
+}
+
+val zconcat_str = "concat_str" : (%string, %string) ->  %string
+
+val zdescribe : (%bool, %union zval) ->  %string
+
+fn zdescribe(zverbose, zv) {
+  zprefix : %string;
+  jump zverbose goto 4 ` "a";
+  zprefix = "short: ";
+  goto 5;
+  zprefix = "long: ";
+  jump zv is zVint goto 10 ` "b";
+  zi : %i64;
+  zi = zv as zVint;
+  return = zprefix;
+  end;
+  jump zv is zVstr goto 15 ` "c";
+  zs : %string;
+  zs = zv as zVstr;
+  return = zconcat_str(zprefix, zs);
+  end;
+  arbitrary;
+}
+"""
+    res = parse_and_make_code(s, "supportcode")
+    # the switch is on the second argument, after some setup code
+    assert "return_ = zv.meth_zdescribe(zprefix)" in res
+    assert "def zdescribe_zVstr(zv, zprefix):" in res
+    d = {}
+    exec py.code.Source(res).compile() in d
+    assert d['func_zdescribe'](True, d['Union_zval_zVstr']("x")) == "long: x"
+    assert d['func_zdescribe'](False, d['Union_zval_zVint'](1)) == "short: "
+    report = union_switch_report(parse.parser.parse(parse.lexer.lex(s)))
+    assert report.splitlines() == [
+        "zdescribe: switch on zv, 2 variants, 3 operations of setup code, passing zv, zprefix",
+        "1 functions turned into methods"]
+
 def test_exceptions(capsys):
     import py
     s = """
@@ -283,6 +526,64 @@ R = 3
 """
     assert not d['r'].have_exception
 
+def test_split_declarations():
+    with open(cir, "rb") as f:
+        s = f.read()
+    chunks = split_declarations(s)
+    assert "".join(chunks) == s
+    assert len(chunks) == len(parse.parser.parse(parse.lexer.lex(s)).declarations)
+    for chunk in chunks:
+        assert chunk.startswith(DECLARATION_KEYWORDS)
+
+def test_cache(tmpdir):
+    with open(cir, "rb") as f:
+        s = f.read()
+    cachedir = str(tmpdir.join("cache"))
+    expected = parse_and_make_code(s, "supportcode")
+    res = parse_and_make_code(s, "supportcode", cachedir=cachedir)
+    assert res == expected
+    res = parse_and_make_code(s, "supportcode", cachedir=cachedir)
+    assert res == expected
+
+    # change the first function, only it is regenerated
+    index = s.index("\nfn ")
+    index = s.index("{\n", index) + 2
+    s = s[:index] + "  zunused_lz30 : (%i64, %bool);\n" + s[index:]
+    expected = parse_and_make_code(s, "supportcode")
+    cache = CodeCache(cachedir)
+    ast = cache.parse(s)
+    cache.compute_context(ast, "supportcode", set())
+    c = Codegen()
+    c.cache = cache
+    ast.make_code(c)
+    assert cache.function_misses == 1
+    assert cache.function_hits == 16
+    res = parse_and_make_code(s, "supportcode", cachedir=cachedir)
+    assert res == expected
+
+def test_target_cachedirs():
+    # saving the cache of one target must not drop the entries of another
+    from pydrofoil.test import targetnand, targetriscv
+    assert targetnand.cachedir != targetriscv.cachedir
+
+def test_parallel(tmpdir):
+    for fn in [cir, excir]:
+        with open(fn, "rb") as f:
+            s = f.read()
+        expected = parse_and_make_code(s, "supportcode")
+        res = parse_and_make_code(s, "supportcode", processes=2)
+        assert res == expected
+
+    # the code of the functions generated in parallel can be reused
+    with open(cir, "rb") as f:
+        s = f.read()
+    expected = parse_and_make_code(s, "supportcode")
+    cachedir = str(tmpdir.join("cache"))
+    res = parse_and_make_code(s, "supportcode", cachedir=cachedir, processes=2)
+    assert res == expected
+    res = parse_and_make_code(s, "supportcode", cachedir=cachedir, processes=2)
+    assert res == expected
+
 def test_full_nand():
     import py
     from pydrofoil.test import supportcode
@@ -339,6 +640,42 @@ def riscvmain():
 def test_full_riscv(riscvmain, elf):
     riscvmain(['executable', elf])
 
+def test_full_riscv_iterations(riscvmain):
+    # the memory is restored from a snapshot for the second iteration
+    riscvmain(['executable', elfs[0], '2'])
+
+def test_full_riscv_raw_image(riscvmain, tmpdir):
+    # the process image of an ELF test as a gzip compressed raw image
+    import gzip
+    from rpython.rlib.rarithmetic import r_uint
+    from pydrofoil import elf, mem
+    m = mem.SparseMemory()
+    with open(elfs[0], "rb") as f:
+        entrypoint = elf.elf_read_process_image(m, f)
+    size = (max(m.pages) + 1 - (entrypoint >> m.PAGE_BITS)) << m.PAGE_BITS
+    data = "".join([chr(m.read(r_uint(entrypoint + i), 1)) for i in range(size)])
+    fn = tmpdir.join("image.gz")
+    with gzip.open(str(fn), "wb") as f:
+        f.write(data)
+    g = riscvmain.supportcoderiscv.g
+    try:
+        riscvmain(['executable', '--image-addr', '0x80000000',
+                   '--entry', '0x80000000', str(fn)])
+    finally:
+        g.image_addr = g.entry = r_uint(0)
+    assert g.elf_image is None
+
+def test_riscv_rom(riscvmain):
+    from rpython.rlib.rarithmetic import r_uint
+    riscvmain(['executable', elfs[0]])
+    g = riscvmain.supportcoderiscv.g
+    # the reset vector, followed by the generated device tree
+    assert g.mem.read(r_uint(0x1000), 4) == 0x297
+    dtb_addr = g.mem.read(r_uint(0x1000 + 32), 8)
+    assert dtb_addr == 0x1000 + 40
+    assert g.mem.read(dtb_addr, 4) == 0xedfe0dd0 # big endian magic
+    assert g.rv_rom_size == 0x1000
+
 def test_load_dump(riscvmain):
     d = riscvmain.supportcoderiscv.parse_dump_file(os.path.join(thisdir, 'dhrystone.riscv.dump'))
     assert d[0x8000218a] == '.text: Proc_1 6100                	ld	s0,0(a0)'
@@ -14,7 +14,7 @@ class TBM(mem.BlockMemory):
     BLOCK_MASK = BLOCK_SIZE - 1
 
 
-@pytest.mark.parametrize("memcls", [TBM, mem.FlatMemory])
+@pytest.mark.parametrize("memcls", [TBM, mem.FlatMemory, mem.SparseMemory])
 def test_mem_write_read(memcls):
     mem = memcls()
     assert mem.read(r_uint(1), 1) == 0
@@ -57,39 +57,84 @@ def test_invalidation_logic():
     m.write(8, 8, 0xdeaddeaddeaddead)
     assert m._aligned_read(0, 8, False) == 0x0a1b2c3d4e5f6789
     assert set(m.status) == {mem.MEM_STATUS_NORMAL}
-    v1 = m.version
+    assert len(m.status) == len(m.pages) == m.size // 8 // m.PAGE_SIZE
+    v1 = m.pages[0].version
+    other = m.pages[1].version
 
     m.mark_page_executable(0)
-    v2 = m.version
+    v2 = m.pages[0].version
     assert v1 is not v2
-    assert m.status[:512] == [mem.MEM_STATUS_IMMUTABLE] * 512
-    assert set(m.status[512:]) == {mem.MEM_STATUS_NORMAL}
+    assert m.status[0] == mem.MEM_STATUS_IMMUTABLE
+    assert set(m.status[1:]) == {mem.MEM_STATUS_NORMAL}
 
     m.mark_page_executable(1)
-    v3 = m.version
+    v3 = m.pages[0].version
     assert v2 is v3
-    assert m.status[:512] == [mem.MEM_STATUS_IMMUTABLE] * 512
-    assert set(m.status[512:]) == {mem.MEM_STATUS_NORMAL}
+    assert m.status[0] == mem.MEM_STATUS_IMMUTABLE
+    assert set(m.status[1:]) == {mem.MEM_STATUS_NORMAL}
 
     m.write(8, 8, 0xdeaddeaddeaddead) # same value!
-    v3 = m.version
+    v3 = m.pages[0].version
     assert v2 is v3
-    assert m.status[:512] == [mem.MEM_STATUS_IMMUTABLE] * 512
-    assert set(m.status[512:]) == {mem.MEM_STATUS_NORMAL}
+    assert m.status[0] == mem.MEM_STATUS_IMMUTABLE
+    assert set(m.status[1:]) == {mem.MEM_STATUS_NORMAL}
 
     for val in [1, 2, 3, 4]:
         m.write(8, 8, val) # different value!
-        assert m.status[:512] == [mem.MEM_STATUS_MUTABLE] * 512
-        assert set(m.status[512:]) == {mem.MEM_STATUS_NORMAL}
-    v4 = m.version
+        assert m.status[0] == mem.MEM_STATUS_MUTABLE
+        assert set(m.status[1:]) == {mem.MEM_STATUS_NORMAL}
+    v4 = m.pages[0].version
     assert v4 is not v3
+    # the other pages are not invalidated
+    assert m.pages[1].version is other
 
     m.mark_page_executable(0) # re-marking as executable does nothing
-    assert m.status[:512] == [mem.MEM_STATUS_MUTABLE] * 512
-    assert set(m.status[512:]) == {mem.MEM_STATUS_NORMAL}
-    v5 = m.version
+    assert m.status[0] == mem.MEM_STATUS_MUTABLE
+    assert set(m.status[1:]) == {mem.MEM_STATUS_NORMAL}
+    v5 = m.pages[0].version
     assert v4 is v5
 
+def test_mutable_page_becomes_immutable_again():
+    m = mem.FlatMemory()
+    m.mark_page_executable(0)
+    m.write(8, 8, 1)
+    assert m.status[0] == mem.MEM_STATUS_MUTABLE
+    period = mem.PageState.QUIET_PERIOD
+    # a write resets the quiet period
+    for i in range(period - 1):
+        m.mark_page_executable(0)
+    m.write(16, 8, 2)
+    for i in range(period - 1):
+        m.mark_page_executable(0)
+    assert m.status[0] == mem.MEM_STATUS_MUTABLE
+    v1 = m.pages[0].version
+    m.mark_page_executable(0)
+    assert m.status[0] == mem.MEM_STATUS_IMMUTABLE
+    assert m.pages[0].version is not v1
+    assert m.read(16, 8, True) == 2
+    # the next quiet period is longer
+    m.write(8, 8, 3)
+    for i in range(period):
+        m.mark_page_executable(0)
+    assert m.status[0] == mem.MEM_STATUS_MUTABLE
+    for i in range(period):
+        m.mark_page_executable(0)
+    assert m.status[0] == mem.MEM_STATUS_IMMUTABLE
+
+def test_flat_memory_translates():
+    from rpython.rtyper.test.test_llinterp import interpret
+    def f(addr):
+        m = mem.FlatMemory(False, 0x10000)
+        m.snapshot()
+        m.write(r_uint(addr), 8, r_uint(addr + 1))
+        m.mark_page_executable(r_uint(addr))
+        res = intmask(m.read(r_uint(addr), 8, True))
+        m.write(r_uint(addr), 4, r_uint(7)) # invalidates the page
+        res = res * 100 + intmask(m.read(r_uint(addr), 8, True))
+        m.restore()
+        return res * 100 + intmask(m.read(r_uint(addr), 8, True))
+    assert interpret(f, [8]) == 90700
+
 def test_immutable_reads():
     m = mem.FlatMemory()
     m.write(0, 8, 0x0a1b2c3d4e5f6789)
@@ -108,3 +153,279 @@ def test_immutable_reads():
     for i in range(512):
         assert m.read(i * 8, 8, True) == i
     assert read_offsets == range(512)
+
+def make_split_memory():
+    m = mem.SplitMemory()
+    m.add_region(r_uint(0x80000000), r_uint(0x100000), TBM())
+    m.add_region(r_uint(0), r_uint(mem.FlatMemory.SIZE), mem.FlatMemory())
+    return m
+
+@pytest.mark.parametrize("memcls", [TBM, mem.FlatMemory, mem.SparseMemory,
+                                    make_split_memory])
+def test_snapshot_restore(memcls):
+    m = memcls()
+    addresses = [r_uint(a) for a in [0, 8, 4096, 4104, 0x10008]]
+    if memcls is make_split_memory:
+        addresses += [r_uint(a) for a in [0x80000000, 0x80001008]]
+    for addr in addresses[:4]:
+        m.write(addr, 8, addr + 1)
+    m.snapshot()
+    before = [m.read(addr, 8) for addr in addresses]
+    for i in range(3):
+        for addr in addresses:
+            m.write(addr, 4, r_uint(0xdeadbeef + i))
+            m.write(addr + 5, 1, r_uint(0x12))
+        m.restore()
+        assert [m.read(addr, 8) for addr in addresses] == before
+        assert m.read(addresses[0] + 5, 1) == 0
+
+@pytest.mark.parametrize("memcls", [TBM, lambda: mem.FlatMemory(False, 0x4000),
+                                    mem.SparseMemory])
+def test_snapshot_restore_translates(memcls):
+    from rpython.rtyper.test.test_llinterp import interpret
+    def f(addr):
+        m = memcls()
+        m.write(r_uint(addr), 8, r_uint(1))
+        m.snapshot()
+        m.write(r_uint(addr), 8, r_uint(2))
+        m.write(r_uint(addr + 0x208), 4, r_uint(3))
+        res = intmask(m.read(r_uint(addr), 8)) * 10 + intmask(m.read(r_uint(addr + 0x208), 4))
+        m.restore()
+        res = res * 10 + intmask(m.read(r_uint(addr), 8))
+        return res * 10 + intmask(m.read(r_uint(addr + 0x208), 4))
+    assert interpret(f, [0x1000]) == 2310
+
+def test_restore_invalidates_immutable_pages():
+    m = mem.FlatMemory()
+    m.write(0, 8, 0x0a1b2c3d4e5f6789)
+    m.snapshot()
+    m.mark_page_executable(0)
+    assert m.read(0, 8, True) == 0x0a1b2c3d4e5f6789
+    v1 = m.pages[0].version
+    m.restore() # nothing was written
+    assert m.pages[0].version is v1
+    m.write(4096, 8, 1) # another page
+    m.restore()
+    assert m.pages[0].version is v1
+    m.mark_page_executable(4096)
+    v2 = m.pages[1].version
+    m.write(4096, 8, 1)
+    m.restore()
+    assert m.pages[1].version is not v2
+    assert m.pages[0].version is v1
+    assert m.read(4096, 8, True) == 0
+
+def test_sparse_memory_pages():
+    m = mem.SparseMemory()
+    assert m.read(r_uint(0x123456789000), 8) == 0
+    assert m.pages == {} # reading doesn't allocate
+    # two pages that map to the same TLB entry
+    addr1 = r_uint(0x80000000)
+    addr2 = addr1 + (mem.SparseMemory.TLB_SIZE << mem.SparseMemory.PAGE_BITS)
+    m.write(addr1, 8, r_uint(1))
+    m.write(addr2 + 8, 4, r_uint(2))
+    assert len(m.pages) == 2
+    for i in range(3):
+        assert m.read(addr1, 8) == 1
+        assert m.read(addr2 + 8, 8) == 2
+    m.snapshot()
+    m.write(r_uint(0x1000), 1, r_uint(3))
+    m.write(addr1, 8, r_uint(4))
+    assert len(m.pages) == 3
+    m.restore()
+    assert len(m.pages) == 2
+    assert m.read(r_uint(0x1000), 1) == 0
+    assert m.read(addr1, 8) == 1
+
+def test_sparse_memory_invalidation():
+    m = mem.SparseMemory()
+    m.write(r_uint(0), 8, r_uint(0x0a1b2c3d4e5f6789))
+    page = m.get_page(r_uint(0), False)
+    v1 = page.version
+    m.mark_page_executable(r_uint(0))
+    v2 = page.version
+    assert v1 is not v2
+    m.mark_page_executable(r_uint(0x1000))
+    other = m.get_page(r_uint(1), False)
+    otherversion = other.version
+    assert other.status == mem.MEM_STATUS_IMMUTABLE
+    assert m.read(r_uint(0), 8, True) == 0x0a1b2c3d4e5f6789
+    m.write(r_uint(0), 8, r_uint(0x0a1b2c3d4e5f6789)) # same value!
+    assert page.version is v2
+    m.write(r_uint(8), 8, r_uint(1))
+    assert page.version is not v2
+    assert page.status == mem.MEM_STATUS_MUTABLE
+    assert m.read(r_uint(8), 8, True) == 1
+    # only the written page is invalidated
+    assert other.version is otherversion
+    assert other.status == mem.MEM_STATUS_IMMUTABLE
+
+def test_sparse_memory_restore_versions():
+    m = mem.SparseMemory()
+    m.write(r_uint(0), 8, r_uint(1))
+    m.write(r_uint(0x1000), 8, r_uint(2))
+    m.mark_page_executable(r_uint(0))
+    page, other = m.get_page(r_uint(0), False), m.get_page(r_uint(1), False)
+    v1, otherversion = page.version, other.version
+    pages_version = m.pages_version
+    m.snapshot()
+    m.write(r_uint(0x1000), 8, r_uint(3))
+    m.restore()
+    # restoring a page that isn't immutable invalidates nothing
+    assert page.version is v1
+    assert other.version is otherversion
+    assert m.pages_version is pages_version
+    # the written page became immutable after the snapshot
+    m.snapshot()
+    m.write(r_uint(0x1000), 8, r_uint(4))
+    m.mark_page_executable(r_uint(0x1000))
+    otherversion = other.version
+    m.restore()
+    assert other.version is not otherversion
+    assert page.version is v1
+    assert m.pages_version is pages_version
+    assert m.read(r_uint(0x1000), 8, True) == 2
+    # removing a page changes the pages_version
+    m.snapshot()
+    m.write(r_uint(0x2000), 8, r_uint(5))
+    m.restore()
+    assert m.pages_version is not pages_version
+    assert m.read(r_uint(0x2000), 8, True) == 0
+
+def test_sparse_memory_translates():
+    from rpython.rtyper.test.test_llinterp import interpret
+    def f(addr):
+        m = mem.SparseMemory()
+        m.write(r_uint(addr), 8, r_uint(addr + 1))
+        m.snapshot()
+        m.mark_page_executable(r_uint(addr))
+        res = intmask(m.read(r_uint(addr), 8, True))
+        m.write(r_uint(addr), 4, r_uint(7)) # invalidates the page
+        res = res * 100 + intmask(m.read(r_uint(addr), 8, True))
+        m.write(r_uint(addr + 0x1000), 8, r_uint(3))
+        m.restore() # removes the second page
+        res = res * 100 + intmask(m.read(r_uint(addr), 8, True))
+        return res * 100 + intmask(m.read(r_uint(addr + 0x1000), 8, True))
+    assert interpret(f, [8]) == 9070900
+
+class Device(mem.MMIOHandler):
+    def __init__(self):
+        self.accesses = []
+
+    def _aligned_read(self, start_addr, num_bytes, executable_flag):
+        self.accesses.append(("read", start_addr, num_bytes))
+        return r_uint(0x42)
+
+    def _aligned_write(self, start_addr, num_bytes, value):
+        self.accesses.append(("write", start_addr, num_bytes, value))
+
+def test_split_memory_regions():
+    m = mem.SplitMemory()
+    rom = mem.FlatMemory(False, 0x10000)
+    ram = mem.SparseMemory()
+    device = Device()
+    m.add_region(r_uint(0x80000000), r_uint(0x1000000), ram)
+    m.add_region(r_uint(0x1000), r_uint(0x10000), rom)
+    m.add_region(r_uint(0x2000000), r_uint(0xc0000), device)
+    assert [region.address_base for region in m.regionmap.regions] == [
+        0x1000, 0x2000000, 0x80000000]
+    m.write(r_uint(0x1008), 8, r_uint(0x1234))
+    assert rom.read(r_uint(8), 8) == 0x1234
+    m.write(r_uint(0x80000010), 4, r_uint(0x5678))
+    assert ram.read(r_uint(0x10), 4) == 0x5678
+    assert m.read(r_uint(0x80000010), 4) == 0x5678
+    m.write(r_uint(0x2004000), 8, r_uint(7))
+    assert m.read(r_uint(0x2000008), 4) == 0x42
+    assert device.accesses == [("write", 0x4000, 8, 7), ("read", 8, 4)]
+    for addr in [0, 0xff8, 0x11000, 0x20c0000, 0x81000000, r_uint(-8)]:
+        with pytest.raises(ValueError):
+            m.read(r_uint(addr), 8)
+        with pytest.raises(ValueError):
+            m.write(r_uint(addr), 8, r_uint(0))
+    with pytest.raises(AssertionError):
+        m.add_region(r_uint(0x10000), r_uint(0x2000), mem.FlatMemory(False, 0x2000))
+    with pytest.raises(AssertionError):
+        m.add_region(r_uint(0), r_uint(0x2000), mem.FlatMemory(False, 0x2000))
+
+@pytest.mark.parametrize("memcls", [TBM, mem.FlatMemory, mem.SparseMemory,
+                                    make_split_memory])
+def test_write_bytes_fill(memcls):
+    import random
+    rng = random.Random(1)
+    m = memcls()
+    # crosses the 4 KB pages of FlatMemory and the 1 KB blocks of TBM
+    base = r_uint(0x3ffd)
+    data = "".join([chr(rng.randrange(256)) for i in range(10000)])
+    m.write_bytes(base, data)
+    assert "".join([chr(m.read(base + i, 1)) for i in range(len(data))]) == data
+    assert m.read(base - 1, 1) == 0
+    assert m.read(base + len(data), 1) == 0
+    m.fill(base + 3, 5000)
+    m.fill(base + 5003, 11, 0xab)
+    expected = data[:3] + "\0" * 5000 + "\xab" * 11 + data[5014:]
+    assert "".join([chr(m.read(base + i, 1)) for i in range(len(data))]) == expected
+    m.write_bytes(base + 5, "")
+    m.write_bytes(base + 5, "\x01\x02")
+    assert m.read(base + 4, 4) == 0x00020100
+
+@pytest.mark.parametrize("memcls", [TBM, mem.FlatMemory, make_split_memory])
+def test_write_bytes_snapshot(memcls):
+    m = memcls()
+    m.write_bytes(r_uint(0), "\x11" * 20000)
+    m.snapshot()
+    m.write_bytes(r_uint(8), "\x22" * 10000)
+    m.fill(r_uint(12000), 4096)
+    m.restore()
+    assert m.read(r_uint(8), 8) == 0x1111111111111111
+    assert m.read(r_uint(12000), 8) == 0x1111111111111111
+
+def test_write_bytes_invalidates():
+    m = mem.FlatMemory()
+    m.write_bytes(r_uint(0), "\x11" * 16)
+    m.mark_page_executable(r_uint(0))
+    v1 = m.pages[0].version
+    m.write_bytes(r_uint(0), "\x11" * 16) # same bytes
+    assert m.pages[0].version is v1
+    assert m.status[0] == mem.MEM_STATUS_IMMUTABLE
+    m.fill(r_uint(8), 8)
+    assert m.pages[0].version is not v1
+    assert m.status[0] == mem.MEM_STATUS_MUTABLE
+
+def test_write_bytes_fill_translates():
+    from rpython.rtyper.test.test_llinterp import interpret
+    def f(addr, size):
+        m = mem.SplitMemory()
+        m.add_region(r_uint(0), r_uint(0x2000), mem.FlatMemory(False, 0x2000))
+        m.add_region(r_uint(0x2000), r_uint(0x2000), TBM())
+        m.add_region(r_uint(0x4000), r_uint(0x2000), mem.SparseMemory())
+        # the single writes and the bulk writes go through the same
+        # snapshot and invalidation code
+        m.write(r_uint(addr & ~7), 8, r_uint(0x0123456789abcdef))
+        m.mark_page_executable(r_uint(addr & ~7))
+        res = intmask(m.read(r_uint(addr & ~7), 8, True))
+        m.snapshot()
+        m.write_bytes(r_uint(addr), "abcdefghijklmnopqrstuvwxyz" * size)
+        m.fill(r_uint(addr + 3), 26 * size - 6, 0x21)
+        for i in range(26 * size):
+            res = intmask(res * 31 + intmask(m.read(r_uint(addr + i), 1)))
+        m.restore()
+        for i in range(26 * size):
+            res = intmask(res * 31 + intmask(m.read(r_uint(addr + i), 1)))
+        return res
+    def check(addr, size):
+        assert interpret(f, [addr, size]) == f(addr, size)
+    check(0x1ff3, 2) # crosses from the FlatMemory to the BlockMemory
+    check(0x3fe9, 3) # crosses from the BlockMemory to the SparseMemory
+
+def test_split_memory_write_bytes_crosses_regions():
+    m = mem.SplitMemory()
+    low = mem.FlatMemory(False, 0x2000)
+    high = TBM()
+    m.add_region(r_uint(0), r_uint(0x2000), low)
+    m.add_region(r_uint(0x2000), r_uint(0x100000), high)
+    m.write_bytes(r_uint(0x1ff0), "abcdefghijklmnopqrstuvwxyz")
+    assert low.read(r_uint(0x1ff0), 8) == 0x6867666564636261
+    assert high.read(r_uint(0), 8) == 0x7877767574737271
+    m.fill(r_uint(0x1ffc), 8, 0xff)
+    assert low.read(r_uint(0x1ff8), 8) == 0xffffffff6c6b6a69
+    assert high.read(r_uint(0), 8) == 0x78777675ffffffff
@@ -0,0 +1,277 @@
+from pydrofoil import parse
+from pydrofoil.optimize import (uses, defines, compute_liveness,
+        remove_dead_code, propagate_values, coalesce_temporaries,
+        unbox_bitvectors, narrow_int_locals)
+
+def decl(name, value=None):
+    return parse.LocalVarDeclaration(name, parse.NamedType("%i"), value)
+
+def assign(name, value):
+    return parse.Assignment(name, parse.Var(value))
+
+def jump(var, target):
+    return parse.ConditionalJump(parse.ExprCondition(parse.Var(var)), target, "")
+
+def test_uses_defines():
+    op = parse.Operation("x", "zadd", [parse.Var("a"), parse.Number(1), parse.Var("b")])
+    assert uses(op) == {"a", "b"}
+    assert defines(op) == "x"
+    op = parse.TupleElementAssignment("t", 0, parse.Var("a"))
+    assert uses(op) == {"t", "a"}
+    assert defines(op) is None
+    assert uses(parse.End()) == {"return"}
+
+def test_liveness():
+    blocks = {0: [assign("a", "arg"), jump("c", 3), assign("return", "a"), parse.End()],
+              3: [assign("return", "b"), parse.End()]}
+    livein = compute_liveness(blocks)
+    assert livein == {0: {"arg", "b", "c"}, 3: {"b"}}
+
+def test_remove_dead_assignment():
+    blocks = {0: [decl("a"), decl("b"), assign("a", "arg"), assign("b", "a"),
+                  assign("return", "arg"), parse.End()]}
+    res = remove_dead_code(blocks)
+    assert res == {0: [assign("return", "arg"), parse.End()]}
+
+def test_dead_default_init():
+    blocks = {0: [decl("a"), jump("c", 3), assign("a", "arg"), parse.Goto(4)],
+              3: [assign("a", "arg2"), parse.Goto(4)],
+              4: [assign("return", "a"), parse.End()]}
+    res = remove_dead_code(blocks)
+    op = res[0][0]
+    assert op.name == "a"
+    assert not op.need_default_init
+    assert blocks[0][0].need_default_init # not mutated
+    assert res[0][1:] == blocks[0][1:]
+    assert res[3] == blocks[3]
+
+def test_loop_keeps_assignments():
+    blocks = {0: [decl("i", parse.Number(0)), parse.Goto(1)],
+              1: [jump("c", 3), parse.Operation("i", "zadd", [parse.Var("i")]), parse.Goto(1)],
+              3: [parse.End()]}
+    res = remove_dead_code(blocks)
+    assert res == blocks
+
+def _codegen(**localtypes):
+    from pydrofoil import makecode
+    codegen = makecode.Codegen()
+    codegen.localnames = {}
+    for name, typ in localtypes.items():
+        codegen.add_local(name, name, typ, None)
+    return codegen
+
+def test_propagate_values():
+    from pydrofoil import types
+    codegen = _codegen(a=types.FixedBitVector(8), b=types.FixedBitVector(8),
+                       c=types.Bool(), arg=types.FixedBitVector(8),
+                       **{"return": types.FixedBitVector(8)})
+    bv8 = parse.NamedType("%bv8")
+    blocks = {0: [parse.LocalVarDeclaration("a", bv8, parse.BitVectorConstant("0x0f")),
+                  parse.LocalVarDeclaration("b", bv8),
+                  parse.LocalVarDeclaration("c", parse.NamedType("%bool")),
+                  parse.Operation("b", "@bvadd", [parse.Var("a"), parse.BitVectorConstant("0x01")]),
+                  parse.Operation("c", "@eq", [parse.Var("b"), parse.BitVectorConstant("0x10")]),
+                  parse.ConditionalJump(parse.ExprCondition(parse.Var("c")), 3, ""),
+                  assign("return", "arg"), parse.End()],
+              3: [parse.Operation("return", "@bvadd", [parse.Var("b"), parse.Var("arg")]), parse.End()]}
+    res = propagate_values(blocks, codegen)
+    block = res[0]
+    assert block[3] == parse.Assignment("b", parse.BitVectorConstant("0x10"))
+    assert block[4] == parse.Assignment("c", parse.Var("true"))
+    assert block[5] == parse.Goto(3)
+    assert len(block) == 6
+    assert res[3][0] == parse.Operation("return", "@bvadd", [parse.BitVectorConstant("0x10"), parse.Var("arg")])
+    # block 3 is not mutated
+    assert blocks[3][0].args[0] == parse.Var("b")
+
+def test_propagate_values_merge():
+    from pydrofoil import types
+    codegen = _codegen(a=types.MachineInt(), c=types.Bool(),
+                       **{"return": types.MachineInt()})
+    blocks = {0: [parse.LocalVarDeclaration("a", parse.NamedType("%i64"), parse.Number(1)),
+                  parse.ConditionalJump(parse.ExprCondition(parse.Var("c")), 2, ""),
+                  parse.Assignment("a", parse.Number(2)), parse.Goto(2)],
+              2: [parse.Assignment("return", parse.Var("a")), parse.End()]}
+    res = propagate_values(blocks, codegen)
+    # a is 1 or 2 at the start of block 2
+    assert res[2] == blocks[2]
+
+def test_propagate_values_pure_function():
+    from pydrofoil import types
+    codegen = _codegen(c=types.Bool(), **{"return": types.Bool()})
+    codegen.add_global("znot_bool", "supportcode.not_")
+    blocks = {0: [parse.LocalVarDeclaration("c", parse.NamedType("%bool"), parse.Var("false")),
+                  parse.Operation("return", "znot_bool", [parse.Var("c")]), parse.End()]}
+    res = propagate_values(blocks, codegen)
+    assert res[0][1] == parse.Assignment("return", parse.Var("true"))
+
+def test_propagate_copies():
+    from pydrofoil import types
+    i = types.MachineInt()
+    codegen = _codegen(a=i, b=i, arg=i, **{"return": i})
+    blocks = {0: [decl("a"), decl("b"), assign("a", "arg"), assign("b", "a"),
+                  parse.Operation("return", "@iadd", [parse.Var("b"), parse.Var("a")]),
+                  assign("arg", "return"), assign("return", "b"), parse.End()]}
+    res = propagate_values(blocks, codegen)
+    assert res[0][4] == parse.Operation("return", "@iadd", [parse.Var("arg"), parse.Var("arg")])
+    # arg is overwritten, so b is not a copy of it any more
+    assert res[0][6] == assign("return", "b")
+    res = remove_dead_code(res)
+    assert [op.name for op in res[0] if isinstance(op, parse.LocalVarDeclaration)] == ["b"]
+    assert assign("a", "arg") not in res[0]
+
+def test_coalesce_temporaries():
+    from pydrofoil import types
+    i = types.MachineInt()
+    codegen = _codegen(a=i, b=i, arg=i, **{"return": i})
+    op = parse.Operation("a", "zf", [parse.Var("arg")])
+    blocks = {0: [decl("a"), decl("b"), op, assign("b", "a"),
+                  assign("return", "b"), parse.End()]}
+    res = coalesce_temporaries(blocks, codegen)
+    assert res[0][2:] == [parse.Operation("return", "zf", [parse.Var("arg")]), parse.End()]
+    assert op.result == "a" # not mutated
+    # a is still needed
+    blocks[0][4] = assign("return", "a")
+    res = coalesce_temporaries(blocks, codegen)
+    assert res == blocks
+
+def test_unbox_bitvectors():
+    from pydrofoil import types
+    bv = types.GenericBitVector()
+    bv8 = types.FixedBitVector(8)
+    codegen = _codegen(a=bv, b=bv, n=types.Int(), res=bv, arg=bv8, x=bv8,
+                       **{"return": bv8})
+    codegen.add_global("zxor_vec", "supportcode.xor_bits")
+    codegen.add_global("zshiftl", "supportcode.shiftl")
+    xor = parse.Operation("res", "zxor_vec", [parse.Var("a"), parse.Var("b")])
+    blocks = {0: [parse.LocalVarDeclaration("a", parse.NamedType("%bv"), parse.Var("arg")),
+                  parse.LocalVarDeclaration("b", parse.NamedType("%bv"), parse.BitVectorConstant("0x0f")),
+                  parse.LocalVarDeclaration("n", parse.NamedType("%i"), parse.Number(2)),
+                  parse.LocalVarDeclaration("res", parse.NamedType("%bv")),
+                  xor,
+                  parse.Operation("res", "zshiftl", [parse.Var("res"), parse.Var("n")]),
+                  parse.Assignment("return", parse.Var("res")), parse.End()]}
+    res = unbox_bitvectors(blocks, codegen)
+    # the results are computed into fixed-width locals and boxed afterwards
+    assert res[0][4:] == [
+        parse.LocalVarDeclaration("res_unboxed0", parse.NamedType("%bv8")),
+        parse.Operation("res_unboxed0", "zxor_vec", [parse.Var("arg"), parse.BitVectorConstant("0x0f")]),
+        assign("res", "res_unboxed0"),
+        parse.LocalVarDeclaration("res_unboxed1", parse.NamedType("%bv8")),
+        parse.Operation("res_unboxed1", "zshiftl", [parse.Var("res_unboxed0"), parse.Number(2)]),
+        assign("res", "res_unboxed1"),
+        assign("return", "res_unboxed1"), parse.End()]
+    assert codegen.gettyp("res_unboxed1") is bv8
+    assert xor.args[0] == parse.Var("a") # not mutated
+    # none of the boxings escape
+    res = remove_dead_code(coalesce_temporaries(remove_dead_code(res), codegen))
+    assert res[0][1:] == [
+        parse.Operation("res_unboxed0", "zxor_vec", [parse.Var("arg"), parse.BitVectorConstant("0x0f")]),
+        parse.Operation("return", "zshiftl", [parse.Var("res_unboxed0"), parse.Number(2)]),
+        parse.End()]
+    assert res[0][0].name == "res_unboxed0"
+    # arg is overwritten between the boxing and the use
+    blocks[0].insert(3, assign("arg", "x"))
+    res = unbox_bitvectors(blocks, codegen)
+    assert res[0][5] == xor
+
+def test_unbox_ints():
+    from pydrofoil import types
+    i = types.Int()
+    mi = types.MachineInt()
+    codegen = _codegen(a=i, b=i, res=i, cond=types.Bool(), arg=mi,
+                       **{"return": mi})
+    codegen.add_global("zadd_int", "supportcode.add_int")
+    codegen.add_global("zlt_int", "supportcode.lt")
+    blocks = {0: [parse.LocalVarDeclaration("a", parse.NamedType("%i"), parse.Var("arg")),
+                  parse.LocalVarDeclaration("b", parse.NamedType("%i"), parse.Number(1)),
+                  parse.Operation("cond", "zlt_int", [parse.Var("a"), parse.Var("b")]),
+                  decl("res"),
+                  parse.Operation("res", "zadd_int", [parse.Var("a"), parse.Var("b")]),
+                  assign("return", "res"), parse.End()]}
+    res = unbox_bitvectors(blocks, codegen)
+    # the Int results stay Ints, but the arguments are machine ints
+    assert res[0][2:5] == [
+        parse.Operation("cond", "zlt_int", [parse.Var("arg"), parse.Number(1)]),
+        decl("res"),
+        parse.Operation("res", "zadd_int", [parse.Var("arg"), parse.Number(1)])]
+    # the result is converted to a machine int right away, so it is computed
+    # on machine ints
+    res = remove_dead_code(coalesce_temporaries(remove_dead_code(res), codegen))
+    assert res[0] == [
+        parse.Operation("cond", "zlt_int", [parse.Var("arg"), parse.Number(1)]),
+        parse.Operation("return", "zadd_int", [parse.Var("arg"), parse.Number(1)]),
+        parse.End()]
+    # not if the arguments aren't machine ints
+    blocks[0][0] = parse.LocalVarDeclaration("a", parse.NamedType("%i"))
+    res = coalesce_temporaries(unbox_bitvectors(blocks, codegen), codegen)
+    assert res[0][4:6] == blocks[0][4:6]
+
+def test_narrow_int_locals():
+    from pydrofoil import types
+    i = types.Int()
+    mi = types.MachineInt()
+    bv8 = types.FixedBitVector(8)
+    codegen = _codegen(a=i, b=i, c=i, d=i, cond=types.Bool(), x=bv8, arg=i,
+                       **{"return": i})
+    codegen.add_global("zadd_int", "supportcode.add_int")
+    codegen.add_global("zlt_int", "supportcode.lt")
+    codegen.add_global("zunsigned", "supportcode.sail_unsigned")
+    codegen.add_global("zf", "func_zf")
+    blocks = {0: [decl("a", parse.Number(5)),
+                  decl("b"),
+                  parse.Operation("b", "zunsigned", [parse.Var("x")]),
+                  decl("c"),
+                  parse.Operation("c", "zadd_int", [parse.Var("a"), parse.Var("b")]),
+                  parse.Operation("cond", "zlt_int", [parse.Var("c"), parse.Number(1000)]),
+                  decl("d"),
+                  parse.Operation("d", "zadd_int", [parse.Var("arg"), parse.Number(1)]),
+                  assign("return", "d"), parse.End()]}
+    res = narrow_int_locals(blocks, codegen)
+    # d is unbounded, because arg is
+    assert [op.name for op in res[0] if isinstance(op, parse.LocalVarDeclaration)
+            and op.typ == parse.NamedType("%i64")] == ["a", "b", "c"]
+    assert codegen.gettyp("c") is mi
+    assert codegen.gettyp("d") is i
+    assert codegen.int_locals == 4
+    assert codegen.narrowed_int_locals == 3
+    # c is not narrowed if it is passed to a function that needs an Integer,
+    # it is then computed from a and b as an Integer
+    codegen = _codegen(a=i, b=i, c=i, d=i, cond=types.Bool(), x=bv8, arg=i,
+                       **{"return": i})
+    codegen.add_global("zadd_int", "supportcode.add_int")
+    codegen.add_global("zlt_int", "supportcode.lt")
+    codegen.add_global("zunsigned", "supportcode.sail_unsigned")
+    codegen.add_global("zf", "func_zf")
+    blocks[0].insert(6, parse.Operation("cond", "zf", [parse.Var("c")]))
+    res = narrow_int_locals(blocks, codegen)
+    assert [op.name for op in res[0] if isinstance(op, parse.LocalVarDeclaration)
+            and op.typ == parse.NamedType("%i64")] == ["a", "b"]
+    assert codegen.gettyp("c") is i
+
+def test_narrow_int_locals_loop():
+    from pydrofoil import types
+    i = types.Int()
+    codegen = _codegen(n=i, cond=types.Bool())
+    codegen.add_global("zadd_int", "supportcode.add_int")
+    codegen.add_global("zlt_int", "supportcode.lt")
+    # a counter that is incremented in a loop is unbounded
+    blocks = {0: [decl("n", parse.Number(0)), parse.Goto(1)],
+              1: [parse.Operation("n", "zadd_int", [parse.Var("n"), parse.Number(1)]),
+                  parse.Operation("cond", "zlt_int", [parse.Var("n"), parse.Number(10)]),
+                  parse.ConditionalJump(parse.ExprCondition(parse.Var("cond")), 1, ""),
+                  parse.End()]}
+    res = narrow_int_locals(blocks, codegen)
+    assert res[0] == blocks[0]
+
+def test_coalesce_moves_declaration():
+    from pydrofoil import types
+    i = types.MachineInt()
+    codegen = _codegen(a=i, b=i, arg=i, **{"return": i})
+    op = parse.Operation("a", "zf", [parse.Var("arg")])
+    blocks = {0: [decl("a"), op, decl("b"), assign("b", "a"),
+                  assign("return", "b"), parse.End()]}
+    res = coalesce_temporaries(blocks, codegen)
+    # the result is coalesced into return in the next step
+    assert res[0][1:] == [decl("b"), parse.Operation("return", "zf", [parse.Var("arg")]),
+                          parse.End()]
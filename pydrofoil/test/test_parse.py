@@ -19,6 +19,36 @@ def test_lex_full():
 def test_lex_binary():
     tok, = lexer.lex("0b0100101")
 
+def test_lex_keywords_need_whole_word():
+    toks = list(lexer.lex("end endx %enum %enumx is"))
+    assert [tok.gettokentype() for tok in toks] == [
+        "END", "NAME", "PERCENTENUM", "NAME", "IS"]
+
+def test_lex_is_lazy():
+    toks = lexer.lex("fn zf(zx) { end; } ?")
+    assert next(toks).gettokentype() == "FN"
+
+def test_lex_error_position():
+    try:
+        list(lexer.lex("enum zjump {\n  zJDONT ?"))
+    except LexingError as e:
+        pos = e.getsourcepos()
+        assert pos.idx == 22
+        assert pos.lineno == 2
+        assert pos.colno == 10
+    else:
+        assert 0
+
+def test_parse_error_position():
+    try:
+        parser.parse(lexer.lex("enum zjump {\n  zJDONT zJGT }"))
+    except ParsingError as e:
+        pos = e.getsourcepos()
+        assert pos.lineno == 2
+        assert pos.colno == 10
+    else:
+        assert 0
+
 def test_parse_enum():
     res = parser.parse(lexer.lex("""
 enum zjump {
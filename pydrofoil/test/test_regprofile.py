@@ -0,0 +1,22 @@
+from pydrofoil.regprofile import RegisterProfile
+
+def test_write_read(tmpdir):
+    profile = RegisterProfile(10, {"zPC": 30, "zx_array": 50}, {"zPC": 10})
+    fn = str(tmpdir.join("profile"))
+    profile.write(fn)
+    res = RegisterProfile.read(fn)
+    assert res.steps == 10
+    assert res.reads == {"zPC": 30, "zx_array": 50}
+    assert res.writes == {"zPC": 10, "zx_array": 0}
+
+def test_choose():
+    profile = RegisterProfile(
+        100,
+        {"zPC": 300, "zmode": 150, "zcounter": 100, "zrare": 3, "zx_array": 500},
+        {"zPC": 100, "zcounter": 100, "zrare": 1, "zx_array": 200, "zother": 10})
+    promoted, quasi_immutable, virtualizable = profile.choose(
+        {"zPC", "zmode", "zcounter", "zrare"}, {"zx_array"})
+    assert promoted == {"zPC"}
+    assert quasi_immutable == {"zmode"}
+    # zother is not a register
+    assert virtualizable == {"zPC", "zcounter", "zx_array[*]"}
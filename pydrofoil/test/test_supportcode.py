@@ -8,7 +8,7 @@ from rpython.rlib.rarithmetic import r_uint, intmask
 from rpython.rlib.rbigint import rbigint
 
 def gbv(size, val):
-    return bitvector.GenericBitVector(size, rbigint.fromlong(val))
+    return bitvector.GenericBitVector.frombigint(size, rbigint.fromlong(val))
 
 def bv(size, val):
     return bitvector.from_ruint(size, r_uint(val))
@@ -174,6 +174,64 @@ def test_vector_shift_bits():
         assert res.size == 8
         assert res.toint() == 0
 
+def test_fixed_fast_paths():
+    # the fast paths on r_uints agree with the bitvector methods
+    u = r_uint
+    x = 0b10001101
+    for width in [8, 64]:
+        for i in [0, 5, 65]:
+            assert supportcode.shiftl_fixed(width, u(x), i) == bv(width, x).lshift(i).touint()
+            assert supportcode.shiftr_fixed(u(x), i) == bv(width, x).rshift(i).touint()
+        assert supportcode.vector_subrange_fixed(u(x), 3, 2) == bv(width, x).subrange(3, 2).touint()
+        assert supportcode.vector_access_fixed(u(x), 2) == bv(width, x).read_bit(2)
+        res = supportcode.vector_update_subrange_fixed(width, u(x), 5, 2, u(0b1010))
+        assert res == bv(width, x).update_subrange(5, 2, bv(4, 0b1010)).touint()
+    res = supportcode.vector_update_subrange_fixed(64, u(x), 63, 0, u(0b1101))
+    assert res == 0b1101
+    assert supportcode.vector_subrange_fixed(u(-1), 63, 0) == u(-1)
+
+def test_fixed_fast_paths_translate():
+    from rpython.rtyper.test.test_llinterp import interpret
+    def f(x, i):
+        val = r_uint(x)
+        res = supportcode.shiftl_fixed(8, val, i)
+        res ^= supportcode.shiftr_fixed(val, i)
+        # like the code that operations.py emits for bvaccess
+        res ^= r_uint(1) & supportcode.safe_rshift(val, r_uint(i))
+        res ^= supportcode.vector_subrange_fixed(val, 6, i)
+        res ^= supportcode.vector_access_fixed(val, i)
+        res ^= supportcode.vector_update_subrange_fixed(8, val, 5, i, r_uint(3))
+        return intmask(res)
+    for i in [0, 2, 5]:
+        assert interpret(f, [0b10001101, i]) == f(0b10001101, i)
+
+def test_machine_int_fast_paths():
+    # the fast paths on machine ints agree with the Integer methods, also
+    # when the result overflows
+    import sys
+    maxint = sys.maxint
+    minint = -sys.maxint - 1
+    ops = [("add", "add"), ("sub", "sub"), ("mult", "mul"), ("tdiv", "tdiv"),
+           ("tmod", "tmod")]
+    for a, b in [(5, 3), (-7, 2), (maxint, 1), (minint, 1), (minint, -1),
+                 (maxint, maxint), (minint, 2)]:
+        for name, meth in ops:
+            expected = getattr(si(a), meth)(si(b))
+            res = getattr(supportcode, name + "_i_i")(a, b)
+            assert res.tobigint().eq(expected.tobigint())
+            toint = getattr(supportcode, name + "_i_i_toint")
+            try:
+                value = expected.toint()
+            except OverflowError:
+                with pytest.raises(OverflowError):
+                    toint(a, b)
+            else:
+                assert toint(a, b) == value
+    with pytest.raises(ZeroDivisionError):
+        supportcode.tdiv_i_i(1, 0)
+    with pytest.raises(ZeroDivisionError):
+        supportcode.tmod_i_i_toint(1, 0)
+
 def test_bitvector_touint():
     for size in [6, 6000]:
         assert bv(size, 0b11).touint() == r_uint(0b11)
@@ -260,3 +318,61 @@ def test_string_of_bits():
         assert c(64, 0x1245ab).string_of_bits() == "0x00000000001245AB"
         assert c(3, 0b1).string_of_bits() == "0b001"
         assert c(9, 0b1101).string_of_bits() == "0b000001101"
+
+def test_wide_bitvectors():
+    # compare the limb operations of wide bitvectors with python longs
+    import random
+    r = random.Random(42)
+    for size in [65, 100, 128, 130, 200]:
+        mask = (1 << size) - 1
+        for i in range(20):
+            a = r.getrandbits(size)
+            b = r.getrandbits(size)
+            x = gbv(size, a)
+            y = gbv(size, b)
+            assert x.tolong() == a
+            assert x.xor(y).tolong() == a ^ b
+            assert x.and_(y).tolong() == a & b
+            assert x.or_(y).tolong() == a | b
+            assert x.invert().tolong() == ~a & mask
+            assert x.eq(y) == (a == b)
+            assert x.eq(gbv(size, a))
+            shift = r.randrange(size + 70)
+            assert x.lshift(shift).tolong() == (a << shift) & mask
+            assert x.rshift(shift).tolong() == a >> shift
+            small = r.getrandbits(60)
+            assert x.add_int(si(small)).tolong() == (a + small) & mask
+            assert x.sub_int(si(small)).tolong() == (a - small) & mask
+            assert x.add_int(bi(b)).tolong() == (a + b) & mask
+            assert x.sub_int(bi(b)).tolong() == (a - b) & mask
+            assert x.add_int(si(-small)).tolong() == (a - small) & mask
+            m = r.randrange(size)
+            n = r.randrange(m, size)
+            res = x.subrange(n, m)
+            assert res.size == n - m + 1
+            assert res.tolong() == (a >> m) & ((1 << (n - m + 1)) - 1)
+            s = r.getrandbits(n - m + 1)
+            for c in gbv, bv:
+                if n - m + 1 > 64 and c is bv:
+                    continue
+                res = x.update_subrange(n, m, c(n - m + 1, s))
+                assert res.tolong() == (a & ~(((1 << (n - m + 1)) - 1) << m)) | (s << m)
+            assert x.read_bit(m) == (a >> m) & 1
+            assert x.update_bit(m, 1).tolong() == a | (1 << m)
+            assert x.update_bit(m, 0).tolong() == a & ~(1 << m)
+            signed = a - (1 << size) if a >> (size - 1) else a
+            assert x.signed().tolong() == signed
+            assert x.unsigned().tolong() == a
+            assert x.sign_extend(size + 70).tolong() == signed & ((1 << (size + 70)) - 1)
+            res = x.append(y)
+            assert res.size == 2 * size
+            assert res.tolong() == (a << size) | b
+            res = x.append_64(r_uint(small))
+            assert res.tolong() == (a << 64) | small
+            res = bv(7, 0b1011011).append(x)
+            assert res.tolong() == (0b1011011 << size) | a
+    assert gbv(128, 5).touint() == 5
+    assert gbv(128, 5).toint() == 5
+    with pytest.raises(OverflowError):
+        gbv(128, 1 << 64).touint()
+    assert bv(8, 0b10).append(bv(8, 0b11)).touint() == 0b1000000011